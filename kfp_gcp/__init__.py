@@ -1 +1,15 @@
-from .orchestration.google_cloud._pipeline_runner import run_pipeline, compile_pipeline
+import sys
+
+__all__ = ['run_pipeline', 'compile_pipeline']
+
+if sys.version_info < (3, 7):
+    # Module __getattr__ (PEP 562) is not available
+    from .orchestration.google_cloud._pipeline_runner import run_pipeline, compile_pipeline
+else:
+    # The pipeline runner imports the KFP SDK which is slow to import.
+    # Importing it lazily keeps the job submission CLI fast.
+    def __getattr__(name):
+        if name in __all__:
+            from .orchestration.google_cloud import _pipeline_runner
+            return getattr(_pipeline_runner, name)
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,5 @@
+import sys
+
+from .orchestration.google_cloud._cli import main
+
+sys.exit(main())
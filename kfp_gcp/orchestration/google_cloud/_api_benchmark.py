@@ -0,0 +1,95 @@
+'''Benchmark of the job GET throughput with and without the access token caching and the keep-alive connections.
+
+Runs against the pipelineJobs API emulator. The token fetch is a forked process that sleeps, standing in for gcloud.
+
+Usage: python -m kfp_gcp.orchestration.google_cloud._api_benchmark --requests 200 --token-fetch-seconds 0.2
+'''
+import argparse
+import collections
+import json
+import subprocess
+import time
+from typing import List
+
+from . import _load_test
+from . import _pipeline_jobs_api
+from . import _pipeline_jobs_emulator
+
+
+def _create_slow_token_fetcher(token_fetch_seconds: float):
+    def get_token() -> str:
+        return subprocess.run(
+            ['sh', '-c', 'sleep {}; echo emulator-token'.format(token_fetch_seconds)],
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout.decode('utf-8').strip()
+    return get_token
+
+
+class _UncachedAccessTokenProvider:
+    '''Fetches a new token for every request like the client did before the token caching.'''
+    def __init__(self, get_token):
+        self._get_token = get_token
+
+    def get_access_token(self) -> str:
+        return self._get_token()
+
+
+def run_api_benchmark(
+    api_endpoint: str,
+    request_count: int = 100,
+    token_fetch_seconds: float = 0.2,
+) -> dict:
+    '''Gets the same job request_count times in every mode. Returns the throughput and the latency percentiles of every mode.'''
+    get_token = _create_slow_token_fetcher(token_fetch_seconds)
+    job_api = _pipeline_jobs_api.PipelineJobApi(
+        project_id='benchmark',
+        api_endpoint=api_endpoint,
+        access_token_provider=_pipeline_jobs_api._CachingAccessTokenProvider(get_token=get_token),
+    )
+    job_name = 'api-benchmark-{}'.format(int(time.time() * 1000))
+    job_api.submit_job(_load_test._create_load_test_pipeline_job(1), job_name)
+    job_url = job_api.get_job_url(job_name)
+    uncached_access_token_provider = _UncachedAccessTokenProvider(get_token)
+
+    modes = collections.OrderedDict([
+        # A new connection and a new token for every request
+        ('uncached', lambda: _pipeline_jobs_api._gcloud_http_get_json(url=job_url, access_token_provider=uncached_access_token_provider)),
+        ('cached_token', lambda: _pipeline_jobs_api._gcloud_http_get_json(url=job_url, access_token_provider=job_api.access_token_provider)),
+        ('cached_token_keep_alive', lambda: job_api.get_job_json(job_name)),
+    ])
+    report = collections.OrderedDict()
+    for mode, get_job in modes.items():
+        latencies = []
+        start_time = time.perf_counter()
+        for _ in range(request_count):
+            request_start_time = time.perf_counter()
+            get_job()
+            latencies.append(time.perf_counter() - request_start_time)
+        duration_seconds = time.perf_counter() - start_time
+        latencies.sort()
+        report[mode] = collections.OrderedDict(
+            requests_per_second=request_count / duration_seconds,
+            p50_ms=_load_test._get_percentile(latencies, 50) * 1000,
+            p99_ms=_load_test._get_percentile(latencies, 99) * 1000,
+        )
+    return report
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description='Benchmarks the job GET throughput with and without the token caching and the keep-alive connections.')
+    parser.add_argument('--requests', type=int, default=50, help='Number of requests in every mode.')
+    parser.add_argument('--token-fetch-seconds', type=float, default=0.2, help='Duration of the emulated gcloud token fetch.')
+    args = parser.parse_args(argv)
+
+    with _pipeline_jobs_emulator._PipelineJobsEmulator() as emulator:
+        report = run_api_benchmark(
+            api_endpoint=emulator.endpoint,
+            request_count=args.requests,
+            token_fetch_seconds=args.token_fetch_seconds,
+        )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
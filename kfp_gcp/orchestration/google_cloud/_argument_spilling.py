@@ -0,0 +1,166 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import pathlib
+from typing import Tuple
+
+from . import _image_mirroring
+from . import _pipeline_jobs_api
+from . import _tool_staging
+
+
+_SPILLED_ARGUMENTS_KEY = 'spilledArguments'
+_SPILLED_ARGUMENT_PLACEHOLDER = '__kfp_gcp_spilled_{}__'
+_WRAPPER_PROGRAM_LINE = '\n"$0" "$@"\n'
+
+# Replaces the placeholder arguments with the contents of the spilled arguments.
+# The positional parameters are rebuilt in place since POSIX shell has no arrays.
+_spilled_arguments_code = '''
+kfp_spilled_arguments_dir=/tmp/kfp_spilled_arguments
+mkdir -p "$kfp_spilled_arguments_dir"
+kfp_argument_count=$#
+while [ "$kfp_argument_count" -gt 0 ]; do
+  kfp_argument=$1
+  shift
+  case "$kfp_argument" in
+    __kfp_gcp_spilled_*__)
+      kfp_argument_hash=${kfp_argument#__kfp_gcp_spilled_}
+      kfp_argument_hash=${kfp_argument_hash%__}
+      if [ ! -f "$kfp_spilled_arguments_dir/$kfp_argument_hash" ]; then
+        gcs_copy "$kfp_spilled_arguments_uri/$kfp_argument_hash" "$kfp_spilled_arguments_dir/$kfp_argument_hash"
+      fi
+      # Preserving the trailing newlines
+      kfp_argument=$(cat "$kfp_spilled_arguments_dir/$kfp_argument_hash"; echo x)
+      kfp_argument=${kfp_argument%x}
+      ;;
+  esac
+  set -- "$@" "$kfp_argument"
+  kfp_argument_count=$((kfp_argument_count - 1))
+done
+'''
+
+
+_SpillReport = collections.namedtuple(
+    '_SpillReport',
+    ['spilled_argument_count', 'unique_spilled_argument_count', 'original_payload_size', 'payload_size'],
+)
+
+
+def _get_spilled_arguments_uri(pipeline_root: str) -> str:
+    return pipeline_root.rstrip('/') + '/kfp_gcp/arguments'
+
+
+def _get_payload_size(pipeline_job: dict) -> int:
+    submitted_job = {key: value for key, value in pipeline_job.items() if key != _pipeline_jobs_api._CLIENT_METADATA_KEY}
+    return len(json.dumps(submitted_job, separators=(',', ':')).encode('utf-8'))
+
+
+def _is_spillable(argument) -> bool:
+    # The runtime placeholders must stay in the command line where the backend resolves them
+    return isinstance(argument, str) and '{{$.' not in argument
+
+
+def spill_large_arguments(
+    pipeline_job: dict,
+    pipeline_root: str,
+    min_size: int = 4096,
+    bootstrap_code: str = '',
+) -> Tuple[dict, _SpillReport]:
+    '''Moves the large constant arguments out of the step command lines.
+
+    The arguments are deduplicated by their content hash.
+    The steps download the arguments from pipeline_root at runtime.
+    The argument contents are recorded in the job client metadata and must be uploaded using upload_spilled_arguments before the job is submitted.
+    bootstrap_code makes gcs_copy available in the steps that do not have the artifact transfer wrapper.
+    Returns the new job and the report on the payload size reduction.
+    '''
+    spilled_arguments = {}
+    spilled_argument_count = 0
+    spilled_arguments_uri = _get_spilled_arguments_uri(pipeline_root)
+    new_steps = {}
+    for step_name, step in pipeline_job['spec']['steps'].items():
+        container = step.get('task', {}).get('container')
+        if not container:
+            new_steps[step_name] = step
+            continue
+        command = container['command']
+        is_wrapped = (
+            command[:3] == ['sh', '-e', '-c']
+            and len(command) > 4
+            and _WRAPPER_PROGRAM_LINE in command[3]
+            and 'gcs_copy' in command[3]
+        )
+        # The wrapper runs the program as "$0" "$@"
+        first_argument_index = 5 if is_wrapped else 1
+        new_arguments = []
+        for argument in command[first_argument_index:]:
+            if _is_spillable(argument) and len(argument.encode('utf-8')) >= min_size:
+                argument_hash = hashlib.sha256(argument.encode('utf-8')).hexdigest()
+                spilled_arguments[argument_hash] = argument
+                spilled_argument_count += 1
+                argument = _SPILLED_ARGUMENT_PLACEHOLDER.format(argument_hash)
+            new_arguments.append(argument)
+        if new_arguments == command[first_argument_index:]:
+            new_steps[step_name] = step
+            continue
+
+        spilling_code = "kfp_spilled_arguments_uri='{}'\n".format(spilled_arguments_uri.replace("'", "'\\''")) + _spilled_arguments_code
+        if is_wrapped:
+            script = command[3].replace(_WRAPPER_PROGRAM_LINE, '\n' + spilling_code + _WRAPPER_PROGRAM_LINE.lstrip('\n'), 1)
+            new_command = command[:3] + [script, command[4]] + new_arguments
+        else:
+            script = bootstrap_code + spilling_code + 'exec "$0" "$@"\n'
+            new_command = ['sh', '-e', '-c', script, command[0]] + new_arguments
+        new_steps[step_name] = dict(
+            step,
+            task=dict(
+                step['task'],
+                container=dict(container, command=new_command),
+            ),
+        )
+
+    new_pipeline_job = dict(pipeline_job, spec=dict(pipeline_job['spec'], steps=new_steps))
+    if spilled_arguments:
+        client_metadata = dict(new_pipeline_job.get(_pipeline_jobs_api._CLIENT_METADATA_KEY, {}))
+        spilled_argument_uris = dict(client_metadata.get(_SPILLED_ARGUMENTS_KEY, {}))
+        for argument_hash, argument in spilled_arguments.items():
+            spilled_argument_uris[spilled_arguments_uri + '/' + argument_hash] = argument
+        client_metadata[_SPILLED_ARGUMENTS_KEY] = spilled_argument_uris
+        new_pipeline_job[_pipeline_jobs_api._CLIENT_METADATA_KEY] = client_metadata
+
+    report = _SpillReport(
+        spilled_argument_count=spilled_argument_count,
+        unique_spilled_argument_count=len(spilled_arguments),
+        original_payload_size=_get_payload_size(pipeline_job),
+        payload_size=_get_payload_size(new_pipeline_job),
+    )
+    return new_pipeline_job, report
+
+
+def upload_spilled_arguments(
+    pipeline_job: dict,
+    max_parallelism: int = 16,
+    access_token_provider: _pipeline_jobs_api._CachingAccessTokenProvider = None,
+) -> None:
+    '''Uploads the arguments that were spilled by spill_large_arguments. The existing arguments are not uploaded again.'''
+    spilled_arguments = pipeline_job.get(_pipeline_jobs_api._CLIENT_METADATA_KEY, {}).get(_SPILLED_ARGUMENTS_KEY, {})
+    if not spilled_arguments:
+        return
+
+    def upload(uri: str):
+        data = spilled_arguments[uri].encode('utf-8')
+        if uri.startswith('gs://'):
+            _tool_staging._upload_gcs_object_if_missing(uri, data=data, access_token_provider=access_token_provider)
+            return
+        # Local pipeline root
+        path = pathlib.Path(uri)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = path.with_name(path.name + '.{}.tmp'.format(os.getpid()))
+            temp_path.write_bytes(data)
+            os.replace(str(temp_path), str(path))
+
+    _image_mirroring._map_concurrently(upload, spilled_arguments.keys(), max_parallelism)
+    logging.info('Uploaded {} spilled arguments'.format(len(spilled_arguments)))
@@ -0,0 +1,137 @@
+import asyncio
+import datetime
+import functools
+import logging
+from concurrent import futures
+
+import requests
+
+from . import _pipeline_jobs_api
+
+
+class _AsyncPipelineJob:
+    def __init__(
+        self,
+        api: 'AsyncPipelineJobApi',
+        job_name: str,
+    ):
+        self.api = api
+        self.job_name = job_name
+        self.current_state = {}
+
+    async def cancel(self) -> None:
+        await self.api.cancel(self.job_name)
+
+    async def refresh(self, fields: str = None) -> None:
+        self.current_state = await self.api.get_job_json(self.job_name, fields=fields)
+
+    async def watch(
+        self,
+        timeout: datetime.timedelta = datetime.timedelta.max,
+        interval_seconds: float = 20,
+        fields: str = _pipeline_jobs_api._JOB_STATE_FIELDS,
+    ):
+        '''Async iterator of the job and task state change events. Stops when the job stops.'''
+        start_time = datetime.datetime.utcnow()
+        while True:
+            current_time = datetime.datetime.utcnow()
+            if current_time - start_time > timeout:
+                raise TimeoutError()
+
+            previous_state = self.current_state
+            try:
+                await self.refresh(fields=fields)
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logging.debug('Failed to refresh the job {}: {}'.format(self.job_name, ex))
+                await asyncio.sleep(interval_seconds)
+                continue
+
+            for event in _pipeline_jobs_api._get_state_change_events(self.job_name, previous_state, self.current_state, datetime.datetime.utcnow()):
+                yield event
+
+            job_state = self.current_state.get('state')
+            if not job_state or job_state not in _pipeline_jobs_api._ACTIVE_JOB_STATES:
+                return
+            await asyncio.sleep(interval_seconds)
+
+    async def wait_for_completion(
+        self,
+        timeout: datetime.timedelta = datetime.timedelta.max,
+        interval_seconds: float = 20,
+    ) -> dict:
+        '''Waits for the job to stop and returns the final job state.
+        The waiting does not block any threads. Cancelling the waiting task stops the polling.
+        '''
+        # The full job state is requested, so that it can be returned
+        async for event in self.watch(timeout=timeout, interval_seconds=interval_seconds, fields=None):
+            logging.debug(str(event))
+        return self.current_state
+
+    def __str__(self):
+        return '_AsyncPipelineJob(job_name={})'.format(self.job_name)
+
+
+class AsyncPipelineJobApi:
+    '''Asyncio counterpart of PipelineJobApi.
+
+    All requests share one keep-alive connection pool with at most max_concurrency connections.
+    The requests are made by a small pool of worker threads, so thousands of jobs can be tracked
+    concurrently while only max_concurrency requests are in flight.
+    '''
+    def __init__(
+        self,
+        project_id: str = 'managed-pipeline-test',
+        api_host: str = 'test-ml.sandbox.googleapis.com',
+        access_token_provider: _pipeline_jobs_api._CachingAccessTokenProvider = None,
+        max_concurrency: int = 8,
+        max_retries: int = 3,
+        api_endpoint: str = None,
+    ):
+        self._sync_api = _pipeline_jobs_api.PipelineJobApi(
+            project_id=project_id,
+            api_host=api_host,
+            access_token_provider=access_token_provider,
+            max_retries=max_retries,
+            api_endpoint=api_endpoint,
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_concurrency,
+            pool_block=True,
+        )
+        self._sync_api._session.mount('https://', adapter)
+        self._sync_api._session.mount('http://', adapter)
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_concurrency)
+        self.api_host = api_host
+        self.project_id = project_id
+        self.url_prefix = self._sync_api.url_prefix
+        self.max_retries = max_retries
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def get_job_object(self, job_name: str) -> _AsyncPipelineJob:
+        return _AsyncPipelineJob(api=self, job_name=job_name)
+
+    async def get_job_json(self, job_name: str, fields: str = None) -> dict:
+        return await self._run(self._sync_api.get_job_json, job_name, fields=fields)
+
+    async def cancel(self, job_name: str) -> dict:
+        return await self._run(self._sync_api.cancel, job_name)
+
+    async def submit_job(self, pipeline_job_dict: dict, job_name: str) -> _AsyncPipelineJob:
+        await self._run(self._sync_api.submit_job, pipeline_job_dict=pipeline_job_dict, job_name=job_name)
+        return _AsyncPipelineJob(api=self, job_name=job_name)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+        self._sync_api._session.close()
+
+    async def __aenter__(self) -> 'AsyncPipelineJobApi':
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
@@ -0,0 +1,252 @@
+'''Command-line interface for submitting and managing the compiled pipeline jobs.
+
+Only the compile command imports the KFP SDK, so that the job submission starts fast.
+'''
+import argparse
+import datetime
+import importlib.util
+import json
+import logging
+import os
+import re
+import sys
+from typing import Callable, List
+
+from . import _compact_job_format
+from . import _pipeline_jobs_api
+from . import _run_profiler
+
+
+_DEFAULT_PROJECT_ID = 'managed-pipeline-test'
+_DEFAULT_API_HOST = 'alpha-ml.googleapis.com'
+_SUCCEEDED_JOB_STATE = 'SUCCEEDED'
+
+
+def _create_job_api(args: argparse.Namespace) -> _pipeline_jobs_api.PipelineJobApi:
+    return _pipeline_jobs_api.PipelineJobApi(
+        project_id=args.project_id,
+        api_host=args.api_host,
+        api_endpoint=args.api_endpoint,
+    )
+
+
+def _generate_job_name() -> str:
+    job_name = 'job-' + datetime.datetime.now().isoformat()
+    return re.sub('[^-a-zA-Z0-9]', '-', job_name.lower()).strip('-')
+
+
+def _wait_for_jobs(jobs: List[_pipeline_jobs_api._PipelineJob], timeout_seconds: float = None) -> int:
+    '''Waits for the jobs to stop. Returns the exit code which is non-zero unless all jobs have succeeded.'''
+    timeout = datetime.timedelta(seconds=timeout_seconds) if timeout_seconds else datetime.timedelta.max
+    done, not_done = _pipeline_jobs_api.wait_for_all(jobs, timeout=timeout)
+    exit_code = 0
+    for job in done:
+        job_state = job.current_state.get('state')
+        print('{}: {}'.format(job.job_name, job_state))
+        if job_state != _SUCCEEDED_JOB_STATE:
+            exit_code = 1
+    for job in not_done:
+        print('{}: {} (timed out)'.format(job.job_name, job.current_state.get('state')))
+        exit_code = 1
+    return exit_code
+
+
+def _submit(args: argparse.Namespace) -> int:
+    pipeline_job = _compact_job_format.read_job_file(args.job_file)
+    if pipeline_job.get(_pipeline_jobs_api._CLIENT_METADATA_KEY, {}).get('spilledArguments'):
+        # The uploader is only imported when the job has spilled arguments
+        from . import _argument_spilling
+        _argument_spilling.upload_spilled_arguments(pipeline_job)
+
+    job_api = _create_job_api(args)
+    job = job_api.submit_job(
+        pipeline_job_dict=pipeline_job,
+        job_name=args.job_name or _generate_job_name(),
+    )
+    print(job.job_name)
+    if args.wait:
+        return _wait_for_jobs([job], timeout_seconds=args.timeout)
+    return 0
+
+
+def _wait(args: argparse.Namespace) -> int:
+    job_api = _create_job_api(args)
+    jobs = [job_api.get_job_object(job_name) for job_name in args.job_names]
+    return _wait_for_jobs(jobs, timeout_seconds=args.timeout)
+
+
+def _cancel(args: argparse.Namespace) -> int:
+    job_api = _create_job_api(args)
+    for job_name in args.job_names:
+        job_api.cancel(job_name)
+        print('Cancelled ' + job_name)
+    return 0
+
+
+def _run_local(args: argparse.Namespace) -> int:
+    from . import _local_runner
+
+    pipeline_job = _compact_job_format.read_job_file(args.job_file)
+    job = _local_runner.run_pipeline_job_locally(
+        pipeline_job=pipeline_job,
+        local_root=args.local_root,
+        job_name=args.job_name,
+        max_parallelism=args.max_parallelism,
+    )
+    try:
+        job.wait_for_completion()
+    except KeyboardInterrupt:
+        job.cancel()
+        job.wait_for_completion()
+    print('{}: {}'.format(job.job_name, job.current_state.get('state')))
+    print('Outputs: ' + job.run_dir)
+    return 0 if job.current_state.get('state') == _SUCCEEDED_JOB_STATE else 1
+
+
+def _profile(args: argparse.Namespace) -> int:
+    if os.path.isfile(args.job):
+        # Profiling the saved job offline
+        with open(args.job, 'r') as job_file:
+            job_json = json.load(job_file)
+    else:
+        job_json = _create_job_api(args).get_job_json(args.job)
+        if args.save_job:
+            with open(args.save_job, 'w') as job_file:
+                json.dump(job_json, job_file, indent=2)
+    pipeline_job = None
+    if args.compiled_job:
+        pipeline_job = _compact_job_format.read_job_file(args.compiled_job)
+
+    report = _run_profiler.profile_job(job_json, pipeline_job)
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    if args.trace:
+        with open(args.trace, 'w') as trace_file:
+            json.dump(_run_profiler.to_chrome_trace(report), trace_file)
+    return 0
+
+
+def _load_pipeline_func(pipeline_func_path: str) -> Callable:
+    '''Loads the pipeline function from the "module:function" or "path/to/file.py:function" path.'''
+    module_name, _, func_name = pipeline_func_path.rpartition(':')
+    if not module_name or not func_name:
+        raise ValueError('The pipeline function must be specified as "module:function" or "file.py:function". Got "{}".'.format(pipeline_func_path))
+    if module_name.endswith('.py'):
+        spec = importlib.util.spec_from_file_location('_kfp_gcp_pipeline_module', module_name)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(module_name)
+    return getattr(module, func_name)
+
+
+def _compile(args: argparse.Namespace) -> int:
+    # Importing the compiler and the KFP SDK only when compiling
+    from . import _pipeline_runner
+
+    gcs_copy_uri = None
+    gcs_copy_sha256 = None
+    if args.gcs_copy_bootstrap == 'pipeline_root':
+        gcs_copy_uri, gcs_copy_sha256 = _pipeline_runner._tool_staging.stage_gcs_copy(args.pipeline_root, expected_sha256=args.gcs_copy_sha256)
+
+    pipeline_job = _pipeline_runner.compile_pipeline(
+        pipeline_func=_load_pipeline_func(args.pipeline_func),
+        arguments=json.loads(args.arguments),
+        pipeline_root=args.pipeline_root,
+        pipeline_context=args.pipeline_context,
+        max_parallel_transfers=args.max_parallel_transfers,
+        gcs_copy_bootstrap=args.gcs_copy_bootstrap,
+        gcs_copy_uri=gcs_copy_uri,
+        gcs_copy_sha256=gcs_copy_sha256,
+        artifact_compression=args.artifact_compression,
+        spill_arguments_larger_than=args.spill_arguments_larger_than,
+    )
+    if args.compact and args.output == '-':
+        sys.stdout.buffer.write(_compact_job_format.serialize_job(pipeline_job))
+    elif args.compact:
+        _compact_job_format.write_job_file(pipeline_job, args.output)
+    elif args.output == '-':
+        json.dump(pipeline_job, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output_file:
+            json.dump(pipeline_job, output_file, indent=2)
+    return 0
+
+
+def _add_api_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--project-id', default=_DEFAULT_PROJECT_ID)
+    parser.add_argument('--api-host', default=_DEFAULT_API_HOST)
+    parser.add_argument('--api-endpoint', help='Overrides https://<api-host>. For example, the address of the local API emulator.')
+
+
+def _create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='kfp-gcp', description='Compiles and runs Kubeflow Pipelines on Google Cloud AI Platform.')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enables the info logging.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    submit_parser = subparsers.add_parser('submit', help='Submits the compiled job.')
+    submit_parser.add_argument('job_file', help='Path to the compiled job JSON or compact job.')
+    submit_parser.add_argument('--job-name', help='Name of the new job. Generated from the current time by default.')
+    submit_parser.add_argument('--wait', action='store_true', help='Waits for the job to stop.')
+    submit_parser.add_argument('--timeout', type=float, help='Timeout for waiting in seconds.')
+    _add_api_arguments(submit_parser)
+    submit_parser.set_defaults(handler=_submit)
+
+    wait_parser = subparsers.add_parser('wait', help='Waits for the jobs to stop. Exits with an error unless all jobs have succeeded.')
+    wait_parser.add_argument('job_names', nargs='+')
+    wait_parser.add_argument('--timeout', type=float, help='Timeout in seconds.')
+    _add_api_arguments(wait_parser)
+    wait_parser.set_defaults(handler=_wait)
+
+    cancel_parser = subparsers.add_parser('cancel', help='Cancels the jobs.')
+    cancel_parser.add_argument('job_names', nargs='+')
+    _add_api_arguments(cancel_parser)
+    cancel_parser.set_defaults(handler=_cancel)
+
+    run_local_parser = subparsers.add_parser('run-local', help='Runs the compiled job on the local machine as subprocesses.')
+    run_local_parser.add_argument('job_file', help='Path to the compiled job JSON or compact job.')
+    run_local_parser.add_argument('--local-root', help='Local directory that replaces the pipeline root. A new temporary directory by default.')
+    run_local_parser.add_argument('--job-name')
+    run_local_parser.add_argument('--max-parallelism', type=int, help='Maximum number of steps running at the same time. Defaults to the CPU count.')
+    run_local_parser.set_defaults(handler=_run_local)
+
+    profile_parser = subparsers.add_parser('profile', help='Reports the step timings, the critical path and the step slack of a finished job.')
+    profile_parser.add_argument('job', help='Job name or path to the saved job JSON.')
+    profile_parser.add_argument('--compiled-job', help='Path to the compiled job JSON or compact job. Only needed when the job JSON has no spec.')
+    profile_parser.add_argument('--output', '-o', default='-', help='Path of the report JSON. Defaults to stdout.')
+    profile_parser.add_argument('--trace', help='Path of the Chrome trace JSON.')
+    profile_parser.add_argument('--save-job', help='Saves the fetched job JSON for profiling it offline later.')
+    _add_api_arguments(profile_parser)
+    profile_parser.set_defaults(handler=_profile)
+
+    compile_parser = subparsers.add_parser('compile', help='Compiles the pipeline function to the job JSON.')
+    compile_parser.add_argument('pipeline_func', help='The pipeline function as "module:function" or "file.py:function".')
+    compile_parser.add_argument('--pipeline-root', required=True)
+    compile_parser.add_argument('--arguments', default='{}', help='The pipeline arguments as a JSON object.')
+    compile_parser.add_argument('--pipeline-context', default='Default')
+    compile_parser.add_argument('--output', '-o', default='-', help='Path of the job JSON. Defaults to stdout.')
+    compile_parser.add_argument('--max-parallel-transfers', type=int, default=1)
+    compile_parser.add_argument('--gcs-copy-bootstrap', default='download', choices=['download', 'pipeline_root', 'python'])
+    compile_parser.add_argument('--gcs-copy-sha256', help='Overrides the pinned SHA-256 of the gcs_copy binary staged in the pipeline_root mode.')
+    compile_parser.add_argument('--artifact-compression', choices=['gzip', 'zstd'])
+    compile_parser.add_argument('--spill-arguments-larger-than', type=int)
+    compile_parser.add_argument('--compact', action='store_true', help='Writes the job in the compact compressed format that the other commands read.')
+    compile_parser.set_defaults(handler=_compile)
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    args = _create_parser().parse_args(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO)
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+'''Compact compressed format of the compiled jobs.
+
+The steps of a compiled job repeat the same bootstrap scripts, images and artifact properties.
+The format stores every repeated string and every repeated dict or list once.
+
+Layout: the header line, then the zlib-compressed payload with three JSON lines:
+1. The string table.
+2. The shared values. Every value only refers to the earlier values.
+3. The job.
+Encoding of the references:
+{"#": i} is the string i.
+{"@": i} is the shared value i.
+{"$v": value} is an entry of the shared value list.
+{"=": [[key, value]]} is a literal dict with a single key that would look like a reference.
+'''
+import json
+import os
+import zlib
+
+
+_HEADER = b'kfp_gcp.compact_job.v1\n'
+_SPECIAL_KEYS = ('#', '@', '$v', '=')
+_MIN_INTERNED_STRING_LENGTH = 16
+
+
+def _get_structure_ids(obj, node_ids: dict, structure_ids: dict, counts: dict) -> int:
+    '''Assigns the same id to the structurally equal dicts and lists and counts how many times every structure is used.'''
+    if isinstance(obj, dict):
+        node_id = node_ids.get(id(obj))
+        if node_id is None:
+            key = ('d', tuple((name, _get_structure_ids(value, node_ids, structure_ids, counts)) for name, value in obj.items()))
+            node_id = structure_ids.setdefault(key, len(structure_ids))
+            node_ids[id(obj)] = node_id
+    elif isinstance(obj, list):
+        node_id = node_ids.get(id(obj))
+        if node_id is None:
+            key = ('l', tuple(_get_structure_ids(item, node_ids, structure_ids, counts) for item in obj))
+            node_id = structure_ids.setdefault(key, len(structure_ids))
+            node_ids[id(obj)] = node_id
+    else:
+        # bool is a subclass of int, so the type is a part of the key
+        node_id = structure_ids.setdefault((type(obj), obj), len(structure_ids))
+    counts[node_id] = counts.get(node_id, 0) + 1
+    return node_id
+
+
+def _copy_value(value):
+    '''Copies the decoded dicts and lists. The strings are immutable and stay shared.'''
+    if isinstance(value, dict):
+        return {key: _copy_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy_value(item) for item in value]
+    return value
+
+
+def serialize_job(pipeline_job: dict, compression_level: int = 6) -> bytes:
+    '''Serializes the compiled job to the compact format. deserialize_job restores the exact job.'''
+    node_ids = {}
+    counts = {}
+    _get_structure_ids(pipeline_job, node_ids, {}, counts)
+
+    strings = []
+    string_indices = {}
+    values = []
+    # Structure id -> shared value index
+    value_indices = {}
+
+    def encode(obj):
+        if isinstance(obj, str):
+            if len(obj) < _MIN_INTERNED_STRING_LENGTH:
+                return obj
+            index = string_indices.get(obj)
+            if index is None:
+                index = len(strings)
+                strings.append(obj)
+                string_indices[obj] = index
+            return {'#': index}
+        if isinstance(obj, dict):
+            if not obj:
+                return obj
+            node_id = node_ids[id(obj)]
+            if counts[node_id] > 1:
+                return share(node_id, obj)
+            return encode_dict(obj)
+        if isinstance(obj, list):
+            if not obj:
+                return obj
+            node_id = node_ids[id(obj)]
+            if counts[node_id] > 1:
+                return share(node_id, obj)
+            return [encode(item) for item in obj]
+        return obj
+
+    def encode_dict(obj: dict):
+        encoded = {key: encode(value) for key, value in obj.items()}
+        if len(encoded) == 1 and next(iter(encoded)) in _SPECIAL_KEYS:
+            return {'=': [[key, value] for key, value in encoded.items()]}
+        return encoded
+
+    def share(node_id: int, obj):
+        index = value_indices.get(node_id)
+        if index is None:
+            # The nested shared values are added first
+            encoded = encode_dict(obj) if isinstance(obj, dict) else [encode(item) for item in obj]
+            index = len(values)
+            values.append({'$v': encoded})
+            value_indices[node_id] = index
+        return {'@': index}
+
+    encoded_job = encode(pipeline_job)
+    payload = b'\n'.join(
+        json.dumps(part, separators=(',', ':')).encode('utf-8')
+        for part in [strings, values, encoded_job]
+    )
+    return _HEADER + zlib.compress(payload, compression_level)
+
+
+def deserialize_job(data: bytes) -> dict:
+    '''Restores the compiled job serialized by serialize_job.
+
+    The job is expanded eagerly. Every occurrence of a repeated dict or list gets its own copy,
+    so the loaded job can be edited like a job parsed from JSON. Only the strings are shared.
+    '''
+    if not data.startswith(_HEADER):
+        raise ValueError('The data is not a compact compiled job or its format version is not supported.')
+    strings_json, values_json, job_json = zlib.decompress(data[len(_HEADER):]).split(b'\n')
+    strings = json.loads(strings_json.decode('utf-8'))
+    values = []
+
+    def decode_object(obj: dict):
+        if len(obj) != 1:
+            return obj
+        if '#' in obj:
+            return strings[obj['#']]
+        if '@' in obj:
+            return _copy_value(values[obj['@']])
+        if '$v' in obj:
+            values.append(obj['$v'])
+            return obj['$v']
+        if '=' in obj:
+            return dict(obj['='])
+        return obj
+
+    # The JSON parser calls the hook for the inner objects first, so every value is decoded before it is used
+    json.loads(values_json.decode('utf-8'), object_hook=decode_object)
+    return json.loads(job_json.decode('utf-8'), object_hook=decode_object)
+
+
+def write_job_file(pipeline_job: dict, path: str) -> None:
+    temp_path = path + '.{}.tmp'.format(os.getpid())
+    with open(temp_path, 'wb') as job_file:
+        job_file.write(serialize_job(pipeline_job))
+    os.replace(temp_path, path)
+
+
+def read_job_file(path: str) -> dict:
+    '''Reads the compiled job from the compact or the JSON file.'''
+    with open(path, 'rb') as job_file:
+        data = job_file.read()
+    if data.startswith(_HEADER):
+        return deserialize_job(data)
+    return json.loads(data.decode('utf-8'))
@@ -0,0 +1,84 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import threading
+import weakref
+
+
+def _get_hash(obj) -> str:
+    data = json.dumps(obj, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class _CompiledJobCache:
+    '''Cache of the compiled pipeline jobs.
+
+    Keeps up to max_size entries in memory (LRU) and optionally stores them in cache_dir.
+    Also memoizes the component specs created from the pipeline functions.
+    '''
+    def __init__(
+        self,
+        max_size: int = 128,
+        cache_dir: str = None,
+    ):
+        self.max_size = max_size
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir else None
+        self._entries = collections.OrderedDict()
+        self._component_specs = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def get_component_spec(self, pipeline_func):
+        try:
+            return self._component_specs.get(pipeline_func)
+        except TypeError:
+            # Some callables cannot be weakly referenced
+            return None
+
+    def put_component_spec(self, pipeline_func, component_spec) -> None:
+        try:
+            self._component_specs[pipeline_func] = component_spec
+        except TypeError:
+            pass
+
+    def get(self, key: str) -> dict:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        if self.cache_dir:
+            entry_path = self.cache_dir / (key + '.json')
+            try:
+                with entry_path.open('r') as entry_file:
+                    entry = json.load(entry_file)
+            except FileNotFoundError:
+                return None
+            except (OSError, ValueError) as ex:
+                logging.warning('Could not read the compilation cache entry {}: {}'.format(entry_path, ex))
+                return None
+            self._put_in_memory(key, entry)
+            return entry
+        return None
+
+    def put(self, key: str, entry: dict) -> None:
+        self._put_in_memory(key, entry)
+        if self.cache_dir:
+            entry_path = self.cache_dir / (key + '.json')
+            temp_path = entry_path.with_name(entry_path.name + '.{}.tmp'.format(os.getpid()))
+            try:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                with temp_path.open('w') as entry_file:
+                    json.dump(entry, entry_file)
+                os.replace(str(temp_path), str(entry_path))
+            except OSError as ex:
+                logging.warning('Could not write the compilation cache entry {}: {}'.format(entry_path, ex))
+
+    def _put_in_memory(self, key: str, entry: dict) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
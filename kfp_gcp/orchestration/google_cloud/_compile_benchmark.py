@@ -0,0 +1,115 @@
+'''Scaling benchmark of the pipeline compilation with and without the memoized container command-line templates.
+
+Usage: python -m kfp_gcp.orchestration.google_cloud._compile_benchmark --tasks 100 1000 10000
+'''
+import argparse
+import collections
+import json
+import time
+import tracemalloc
+from typing import List
+
+from kfp import components
+
+from . import _pipeline_runner
+
+
+_producer_component_text = '''
+name: Produce
+inputs:
+- {name: text, type: String}
+outputs:
+- {name: data, type: CSV}
+implementation:
+  container:
+    image: alpine
+    command: [sh, -c, 'echo "$0" > "$1"', {inputValue: text}, {outputPath: data}]
+'''
+
+_consumer_component_text = '''
+name: Consume
+inputs:
+- {name: data, type: CSV}
+- {name: suffix, type: String, optional: true}
+outputs:
+- {name: result}
+implementation:
+  container:
+    image: python:3.7
+    command:
+    - sh
+    - -c
+    - 'cat "$0" > "$1"'
+    - {inputPath: data}
+    - {outputPath: result}
+    - if:
+        cond: {isPresent: suffix}
+        then: [--suffix, {inputValue: suffix}]
+'''
+
+
+def _create_benchmark_component_spec(task_count: int):
+    '''Returns a graph of task_count / 2 producer -> consumer pairs.'''
+    produce_op = components.load_component_from_text(_producer_component_text)
+    consume_op = components.load_component_from_text(_consumer_component_text)
+
+    def pipeline():
+        for index in range(task_count // 2):
+            producer_task = produce_op(text='text {}'.format(index))
+            consume_op(data=producer_task.outputs['data'], suffix=str(index))
+
+    return _pipeline_runner._create_component_spec_from_pipeline_func(pipeline)
+
+
+def _compile(component_spec, memoize_templates: bool) -> dict:
+    _pipeline_runner._container_task_templates.clear()
+    get_container_component_digest = _pipeline_runner._get_container_component_digest
+    if not memoize_templates:
+        # The components without a digest are resolved for every task
+        _pipeline_runner._get_container_component_digest = lambda component_spec: None
+    try:
+        return _pipeline_runner._compile_component_spec(
+            component_spec=component_spec,
+            arguments={},
+            pipeline_root='gs://benchmark/root',
+            pipeline_context='Default',
+            command_line_options=dict(max_parallel_transfers=1, gcs_copy_bootstrap='download'),
+        )
+    finally:
+        _pipeline_runner._get_container_component_digest = get_container_component_digest
+
+
+def run_compile_benchmark(task_counts: List[int], repeat_count: int = 3) -> List[dict]:
+    '''Compiles the benchmark graphs with and without the template memoization. Reports the best time and the peak memory.'''
+    results = []
+    for task_count in task_counts:
+        component_spec = _create_benchmark_component_spec(task_count)
+        result = collections.OrderedDict(tasks=task_count)
+        compiled_jobs = []
+        for mode, memoize_templates in [('per_task', False), ('memoized', True)]:
+            durations = []
+            for _ in range(repeat_count):
+                start_time = time.perf_counter()
+                _compile(component_spec, memoize_templates)
+                durations.append(time.perf_counter() - start_time)
+            tracemalloc.start()
+            compiled_jobs.append(_compile(component_spec, memoize_templates))
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result[mode + '_seconds'] = min(durations)
+            result[mode + '_peak_mb'] = peak_memory / 1e6
+        result['identical_output'] = json.dumps(compiled_jobs[0]) == json.dumps(compiled_jobs[1])
+        results.append(result)
+    return results
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description='Benchmarks the pipeline compilation with and without the memoized command-line templates.')
+    parser.add_argument('--tasks', type=int, nargs='+', default=[100, 1000], help='Task counts of the benchmark graphs.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed compilations. The best time is reported.')
+    args = parser.parse_args(argv)
+    print(json.dumps(run_compile_benchmark(args.tasks, args.repeat), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,420 @@
+import hashlib
+import json
+import re
+import threading
+import urllib
+from concurrent import futures
+from typing import List, Tuple
+
+import requests
+
+from . import _instrumentation
+from . import _pipeline_jobs_api
+
+
+_DOCKER_HUB_REGISTRY = 'registry-1.docker.io'
+
+_MANIFEST_LIST_MEDIA_TYPES = [
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+]
+
+_MANIFEST_MEDIA_TYPES = [
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.oci.image.manifest.v1+json',
+]
+
+
+def _parse_image_reference(image: str) -> Tuple[str, str, str]:
+    '''Splits the image name into (registry, repository, reference).
+    The reference is either a tag or a digest. Follows the Docker image name normalization rules.
+    '''
+    name = image
+    digest = None
+    tag = None
+    if '@' in name:
+        name, digest = name.split('@', 1)
+    last_component = name.rsplit('/', 1)[-1]
+    if ':' in last_component:
+        name, tag = name.rsplit(':', 1)
+    # The digest takes precedence over the tag
+    reference = digest or tag or 'latest'
+
+    parts = name.split('/', 1)
+    if len(parts) == 2 and ('.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+        registry, repository = parts
+    else:
+        registry, repository = _DOCKER_HUB_REGISTRY, name
+    if registry in ['docker.io', 'index.docker.io']:
+        registry = _DOCKER_HUB_REGISTRY
+    if registry == _DOCKER_HUB_REGISTRY and '/' not in repository:
+        repository = 'library/' + repository
+    return registry, repository, reference
+
+
+def _is_google_registry(registry: str) -> bool:
+    return registry == 'gcr.io' or registry.endswith('.gcr.io') or registry.endswith('-docker.pkg.dev')
+
+
+def _parse_www_authenticate_header(header: str) -> Tuple[str, dict]:
+    scheme, _, params_str = header.partition(' ')
+    params = dict(re.findall(r'(\w+)="([^"]*)"', params_str))
+    return scheme.lower(), params
+
+
+class _RegistryClient:
+    '''Minimal client for the Docker Registry HTTP API V2 (OCI distribution API).
+
+    Talks plain HTTP to the localhost registries (like Docker does) which makes it possible to use a local registry stand-in.
+    The Google registries are accessed using the gcloud access token.
+    '''
+    def __init__(
+        self,
+        session: requests.Session = None,
+        access_token_provider: _pipeline_jobs_api._CachingAccessTokenProvider = None,
+        insecure_registries: list = None,
+    ):
+        self._session = session or requests.Session()
+        self._access_token_provider = access_token_provider or _pipeline_jobs_api._default_access_token_provider
+        self._insecure_registries = set(insecure_registries or [])
+        # (registry, scope) -> Authorization header value
+        self._authorization_cache = {}
+        self._lock = threading.Lock()
+
+    def _get_registry_url(self, registry: str) -> str:
+        host = registry.split(':', 1)[0]
+        if registry in self._insecure_registries or host in ['localhost', '127.0.0.1']:
+            return 'http://' + registry
+        return 'https://' + registry
+
+    def _authenticate(self, registry: str, scope: str, www_authenticate: str) -> str:
+        scheme, params = _parse_www_authenticate_header(www_authenticate)
+        basic_auth = None
+        if _is_google_registry(registry):
+            basic_auth = ('oauth2accesstoken', self._access_token_provider.get_access_token())
+        if scheme == 'basic':
+            if not basic_auth:
+                raise RuntimeError('Registry {} requires credentials.'.format(registry))
+            return requests.auth._basic_auth_str(*basic_auth)
+        token_params = {}
+        if 'service' in params:
+            token_params['service'] = params['service']
+        token_params['scope'] = params.get('scope', scope)
+        response = _pipeline_jobs_api._send_instrumented_request(
+            session=self._session,
+            method='GET',
+            url=params['realm'],
+            params=token_params,
+            auth=basic_auth,
+        )
+        response.raise_for_status()
+        token_json = response.json()
+        return 'Bearer ' + (token_json.get('token') or token_json['access_token'])
+
+    def request(
+        self,
+        method: str,
+        registry: str,
+        repository: str,
+        path: str = None,
+        url: str = None,
+        scope_actions: str = 'pull',
+        extra_scopes: list = None,
+        **kwargs
+    ) -> requests.Response:
+        '''Sends a request to the registry. Path is relative to /v2/<repository>/.
+        The url (possibly relative to the registry, like the upload locations) can be specified instead of the path.
+        Handles the registry authentication challenges and caches the resulting credentials.
+        Requests with a streamed body must be authenticated beforehand, since the body cannot be re-sent.
+        '''
+        scope = 'repository:{}:{}'.format(repository, scope_actions)
+        scope = ' '.join([scope] + list(extra_scopes or []))
+        registry_url = self._get_registry_url(registry)
+        if url:
+            url = urllib.parse.urljoin(registry_url + '/', url)
+        else:
+            url = '{}/v2/{}/{}'.format(registry_url, repository, path)
+        cache_key = (registry, scope)
+        headers = dict(kwargs.pop('headers', None) or {})
+        authorization = self._authorization_cache.get(cache_key)
+        if authorization:
+            headers['Authorization'] = authorization
+        response = _pipeline_jobs_api._send_instrumented_request(self._session, method=method, url=url, headers=headers, **kwargs)
+        if response.status_code == 401 and 'WWW-Authenticate' in response.headers:
+            _instrumentation.increment('http_retries', method=method, reason='unauthorized')
+            authorization = self._authenticate(registry, scope, response.headers['WWW-Authenticate'])
+            with self._lock:
+                self._authorization_cache[cache_key] = authorization
+            headers['Authorization'] = authorization
+            response = _pipeline_jobs_api._send_instrumented_request(self._session, method=method, url=url, retry_number=1, headers=headers, **kwargs)
+        return response
+
+    def _head_manifest(self, image: str) -> requests.Response:
+        registry, repository, reference = _parse_image_reference(image)
+        response = self.request(
+            method='HEAD',
+            registry=registry,
+            repository=repository,
+            path='manifests/' + reference,
+            headers={'Accept': ', '.join(_MANIFEST_MEDIA_TYPES)},
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response
+
+    def get_manifest_digest(self, image: str) -> str:
+        '''Returns the digest of the image manifest or None if the image does not exist.'''
+        response = self._head_manifest(image)
+        if response is None:
+            return None
+        digest = response.headers.get('Docker-Content-Digest')
+        if not digest:
+            reference = _parse_image_reference(image)[2]
+            if reference.startswith('sha256:'):
+                digest = reference
+        return digest
+
+    def image_exists(self, image: str) -> bool:
+        return self._head_manifest(image) is not None
+
+    def get_manifest(self, registry: str, repository: str, reference: str) -> Tuple[str, bytes]:
+        '''Returns the manifest media type and the manifest bytes (the digest is computed from the exact bytes).'''
+        response = self.request(
+            method='GET',
+            registry=registry,
+            repository=repository,
+            path='manifests/' + reference,
+            headers={'Accept': ', '.join(_MANIFEST_MEDIA_TYPES)},
+        )
+        response.raise_for_status()
+        media_type = response.headers.get('Content-Type', '').split(';')[0]
+        if not media_type or media_type in ['application/json', 'text/plain']:
+            media_type = json.loads(response.content).get('mediaType', _MANIFEST_MEDIA_TYPES[1])
+        return media_type, response.content
+
+    def put_manifest(self, registry: str, repository: str, reference: str, media_type: str, manifest: bytes) -> None:
+        response = self.request(
+            method='PUT',
+            registry=registry,
+            repository=repository,
+            path='manifests/' + reference,
+            scope_actions='pull,push',
+            headers={'Content-Type': media_type},
+            data=manifest,
+        )
+        response.raise_for_status()
+
+    def blob_exists(self, registry: str, repository: str, digest: str) -> bool:
+        response = self.request(
+            method='HEAD',
+            registry=registry,
+            repository=repository,
+            path='blobs/' + digest,
+            scope_actions='pull,push',
+        )
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        return True
+
+    def start_blob_upload(self, registry: str, repository: str, mount_digest: str = None, mount_from: str = None) -> str:
+        '''Starts the blob upload and returns the upload location.
+        When mount_digest and mount_from are specified, tries to mount the blob from another repository first.
+        Returns None if the blob was mounted.
+        '''
+        params = None
+        extra_scopes = None
+        if mount_digest and mount_from:
+            params = {'mount': mount_digest, 'from': mount_from}
+            extra_scopes = ['repository:{}:pull'.format(mount_from)]
+        response = self.request(
+            method='POST',
+            registry=registry,
+            repository=repository,
+            path='blobs/uploads/',
+            scope_actions='pull,push',
+            extra_scopes=extra_scopes,
+            params=params,
+        )
+        response.raise_for_status()
+        if response.status_code == 201:
+            return None
+        return response.headers['Location']
+
+    def upload_blob(self, registry: str, repository: str, upload_location: str, digest: str, data, size: int) -> None:
+        '''Finishes the blob upload with a single streamed PUT request.'''
+        upload_url = upload_location + ('&' if '?' in upload_location else '?') + urllib.parse.urlencode({'digest': digest})
+        response = self.request(
+            method='PUT',
+            registry=registry,
+            repository=repository,
+            url=upload_url,
+            scope_actions='pull,push',
+            headers={
+                'Content-Type': 'application/octet-stream',
+                'Content-Length': str(size),
+            },
+            data=data,
+        )
+        response.raise_for_status()
+
+    def open_blob(self, registry: str, repository: str, digest: str) -> requests.Response:
+        '''Returns the streaming response. The blob data can be read from response.raw'''
+        response = self.request(
+            method='GET',
+            registry=registry,
+            repository=repository,
+            path='blobs/' + digest,
+            stream=True,
+        )
+        response.raise_for_status()
+        return response
+
+
+class _SizedStream:
+    '''Wraps a stream, so that requests sends it with Content-Length instead of the chunked encoding.'''
+    def __init__(self, stream, size: int):
+        self._stream = stream
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size: int = -1) -> bytes:
+        return self._stream.read(size)
+
+
+class _ImageCopier:
+    '''Copies images between registries using the registry API without pulling them.
+
+    Blobs that already exist in the destination repository are skipped.
+    Blobs that exist in another repository of the destination registry are mounted instead of being uploaded.
+    Blobs are streamed from the source to the destination with bounded parallelism.
+    Manifest lists (multi-arch images) are copied together with all the referenced manifests.
+    '''
+    def __init__(
+        self,
+        registry_client: _RegistryClient = None,
+        max_parallelism: int = 8,
+    ):
+        self._client = registry_client or _RegistryClient()
+        self._max_parallelism = max_parallelism
+        # (registry, repository, digest) -> future
+        self._blob_futures = {}
+        # (registry, digest) -> (repository, future) of the first copy of the blob to that registry
+        self._first_blob_copies = {}
+        self._lock = threading.Lock()
+
+    def copy_images(self, image_mirrors: dict) -> None:
+        with futures.ThreadPoolExecutor(max_workers=self._max_parallelism) as executor:
+            # Scheduling all blob copies first so that they run in parallel across all images
+            manifests_to_put = []
+            for src_image, dst_image in image_mirrors.items():
+                manifests_to_put.append(self._schedule_image_copy(src_image, dst_image, executor))
+            for blob_future in list(self._blob_futures.values()):
+                blob_future.result()
+        for image_manifests in manifests_to_put:
+            # The referenced manifests must be uploaded before the manifest list
+            for registry, repository, reference, media_type, manifest in image_manifests:
+                self._client.put_manifest(registry, repository, reference, media_type, manifest)
+
+    def copy_image(self, src_image: str, dst_image: str) -> None:
+        self.copy_images({src_image: dst_image})
+
+    def _schedule_image_copy(self, src_image: str, dst_image: str, executor: futures.Executor) -> List[tuple]:
+        src_registry, src_repository, src_reference = _parse_image_reference(src_image)
+        dst_registry, dst_repository, dst_reference = _parse_image_reference(dst_image)
+        manifests_to_put = []
+        self._schedule_manifest_copy(
+            src_registry, src_repository, src_reference,
+            dst_registry, dst_repository, dst_reference,
+            executor, manifests_to_put,
+        )
+        return manifests_to_put
+
+    def _schedule_manifest_copy(
+        self,
+        src_registry: str, src_repository: str, src_reference: str,
+        dst_registry: str, dst_repository: str, dst_reference: str,
+        executor: futures.Executor,
+        manifests_to_put: list,
+    ) -> None:
+        media_type, manifest_bytes = self._client.get_manifest(src_registry, src_repository, src_reference)
+        manifest_digest = 'sha256:' + hashlib.sha256(manifest_bytes).hexdigest()
+        dst_image = '{}/{}{}{}'.format(dst_registry, dst_repository, '@' if ':' in dst_reference else ':', dst_reference)
+        if self._client.get_manifest_digest(dst_image) == manifest_digest:
+            return
+        manifest = json.loads(manifest_bytes)
+        if media_type in _MANIFEST_LIST_MEDIA_TYPES or 'manifests' in manifest:
+            for child_descriptor in manifest.get('manifests', []):
+                self._schedule_manifest_copy(
+                    src_registry, src_repository, child_descriptor['digest'],
+                    dst_registry, dst_repository, child_descriptor['digest'],
+                    executor, manifests_to_put,
+                )
+        else:
+            blob_descriptors = list(manifest.get('layers', []))
+            if manifest.get('config'):
+                blob_descriptors.append(manifest['config'])
+            for blob_descriptor in blob_descriptors:
+                # Skipping the foreign layers (e.g. Windows base layers) which cannot be pushed
+                if blob_descriptor.get('urls'):
+                    continue
+                digest = blob_descriptor['digest']
+                key = (dst_registry, dst_repository, digest)
+                with self._lock:
+                    if key in self._blob_futures:
+                        continue
+                    # The blobs shared between the images are transferred once and then mounted to other repositories
+                    first_copy = self._first_blob_copies.get((dst_registry, digest))
+                    blob_future = executor.submit(
+                        self._copy_blob,
+                        src_registry, src_repository,
+                        dst_registry, dst_repository,
+                        digest, blob_descriptor.get('size'),
+                        first_copy,
+                    )
+                    self._blob_futures[key] = blob_future
+                    if not first_copy:
+                        self._first_blob_copies[(dst_registry, digest)] = (dst_repository, blob_future)
+        manifests_to_put.append((dst_registry, dst_repository, dst_reference, media_type, manifest_bytes))
+
+    def _copy_blob(
+        self,
+        src_registry: str, src_repository: str,
+        dst_registry: str, dst_repository: str,
+        digest: str, size: int = None,
+        first_copy: Tuple[str, futures.Future] = None,
+    ) -> None:
+        if self._client.blob_exists(dst_registry, dst_repository, digest):
+            return
+
+        mount_from = None
+        if first_copy:
+            # The first copy was scheduled earlier, so it's already running and waiting for it cannot deadlock the pool.
+            first_copy_repository, first_copy_future = first_copy
+            if not first_copy_future.exception():
+                mount_from = first_copy_repository
+        elif src_registry == dst_registry:
+            mount_from = src_repository
+        upload_location = self._client.start_blob_upload(
+            dst_registry, dst_repository,
+            mount_digest=digest if mount_from else None,
+            mount_from=mount_from,
+        )
+        if not upload_location:
+            return
+        blob_response = self._client.open_blob(src_registry, src_repository, digest)
+        with blob_response:
+            if size is None:
+                size = int(blob_response.headers['Content-Length'])
+            self._client.upload_blob(
+                dst_registry, dst_repository,
+                upload_location=upload_location,
+                digest=digest,
+                data=_SizedStream(blob_response.raw, size),
+                size=size,
+            )
@@ -0,0 +1,340 @@
+import json
+import logging
+import pathlib
+import re
+import sqlite3
+import subprocess
+import threading
+import time
+import uuid
+from typing import Dict, List
+
+import requests
+from kfp.components import structures
+
+from . import _compilation_cache
+from . import _image_mirror_index
+from . import _pipeline_jobs_api
+
+
+_EXECUTION_CACHE_KEYS_KEY = 'executionCacheKeys'
+_EXECUTION_CACHE_ANNOTATION = 'kfp_gcp.execution_cache'
+_DURATION_PATTERN = re.compile(r'^P(?:([0-9]+)D)?(?:T(?:([0-9]+)H)?(?:([0-9]+)M)?(?:([0-9]+(?:\.[0-9]+)?)S)?)?$')
+
+
+def _parse_duration_seconds(duration: str) -> float:
+    '''Parses the ISO 8601 durations like "P7D" or "PT1H30M".'''
+    match = _DURATION_PATTERN.match(duration)
+    if not match or duration in ['P', 'PT']:
+        raise ValueError('Unsupported duration: "{}"'.format(duration))
+    days, hours, minutes, seconds = match.groups()
+    return float(days or 0) * 86400 + float(hours or 0) * 3600 + float(minutes or 0) * 60 + float(seconds or 0)
+
+
+class _SqliteExecutionCacheIndex:
+    '''Local SQLite index of the step executions.
+
+    Any object with the same get, put, delete, put_pending, get_pending and delete_pending methods can be used as the index.
+    The entries are dicts {cache_key, output_uris, job_name, step_name, succeeded, timestamp}.
+    The succeeded executions are keyed by cache_key. The pending executions are keyed by (cache_key, job_name),
+    so the concurrent runs of the same step do not replace each other or the last succeeded execution.
+    '''
+    def __init__(self, path: str = None):
+        self.path = pathlib.Path(path) if path else _image_mirror_index._get_user_cache_dir() / 'execution_cache.sqlite'
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS executions ('
+                'cache_key TEXT PRIMARY KEY, output_uris TEXT NOT NULL, job_name TEXT, step_name TEXT, '
+                'succeeded INTEGER NOT NULL, timestamp REAL NOT NULL)'
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS pending_executions ('
+                'cache_key TEXT NOT NULL, output_uris TEXT NOT NULL, job_name TEXT NOT NULL, step_name TEXT, '
+                'succeeded INTEGER NOT NULL, timestamp REAL NOT NULL, PRIMARY KEY (cache_key, job_name))'
+            )
+            self._connection.commit()
+        return self._connection
+
+    @staticmethod
+    def _row_to_entry(row) -> dict:
+        cache_key, output_uris, job_name, step_name, succeeded, timestamp = row
+        return dict(
+            cache_key=cache_key,
+            output_uris=json.loads(output_uris),
+            job_name=job_name,
+            step_name=step_name,
+            succeeded=bool(succeeded),
+            timestamp=timestamp,
+        )
+
+    def get(self, cache_key: str) -> dict:
+        with self._lock:
+            row = self._get_connection().execute(
+                'SELECT cache_key, output_uris, job_name, step_name, succeeded, timestamp FROM executions WHERE cache_key = ? AND succeeded = 1',
+                (cache_key,),
+            ).fetchone()
+        return self._row_to_entry(row) if row else None
+
+    def _insert(self, table: str, entry: dict) -> None:
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                'INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?, ?)'.format(table),
+                (
+                    entry['cache_key'],
+                    json.dumps(entry['output_uris'], sort_keys=True),
+                    entry.get('job_name'),
+                    entry.get('step_name'),
+                    int(entry['succeeded']),
+                    entry['timestamp'],
+                ),
+            )
+            connection.commit()
+
+    def put(self, entry: dict) -> None:
+        '''Records a succeeded execution. Replaces the previous execution with the same cache key.'''
+        self._insert('executions', dict(entry, succeeded=True))
+
+    def delete(self, cache_key: str) -> None:
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute('DELETE FROM executions WHERE cache_key = ?', (cache_key,))
+            connection.commit()
+
+    def put_pending(self, entry: dict) -> None:
+        self._insert('pending_executions', dict(entry, succeeded=False))
+
+    def get_pending(self) -> List[dict]:
+        with self._lock:
+            rows = self._get_connection().execute(
+                'SELECT cache_key, output_uris, job_name, step_name, succeeded, timestamp FROM pending_executions',
+            ).fetchall()
+        return [self._row_to_entry(row) for row in rows]
+
+    def delete_pending(self, cache_key: str, job_name: str) -> None:
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute('DELETE FROM pending_executions WHERE cache_key = ? AND job_name = ?', (cache_key, job_name))
+            connection.commit()
+
+
+class _ExecutionCache:
+    '''Cache of the step execution results that is shared between the pipeline runs.
+
+    The cached steps are removed from the compiled job and their consumers read the cached outputs.
+    The executions are recorded as pending when the job is submitted and become cached once the step has succeeded.
+    Every job writes the outputs of its executions to its own locations, so a re-run never overwrites the cached outputs.
+    '''
+    def __init__(
+        self,
+        index=None,
+        max_age_seconds: float = None,
+    ):
+        self.index = index or _SqliteExecutionCacheIndex()
+        self.max_age_seconds = max_age_seconds
+
+    def get_cached_output_uris(self, cache_key: str, max_age_seconds: float = None) -> Dict[str, str]:
+        entry = self.index.get(cache_key)
+        if not entry or not entry['succeeded']:
+            return None
+        max_ages = [max_age for max_age in [self.max_age_seconds, max_age_seconds] if max_age is not None]
+        if max_ages and time.time() - entry['timestamp'] > min(max_ages):
+            return None
+        return entry['output_uris']
+
+    def add_pending_executions(self, job_name: str, pipeline_job: dict) -> None:
+        step_cache_keys = pipeline_job.get(_pipeline_jobs_api._CLIENT_METADATA_KEY, {}).get(_EXECUTION_CACHE_KEYS_KEY, {})
+        for step_name, step_cache_key in step_cache_keys.items():
+            self.index.put_pending(dict(
+                cache_key=step_cache_key['cacheKey'],
+                output_uris=step_cache_key['outputUris'],
+                job_name=job_name,
+                step_name=step_name,
+                succeeded=False,
+                timestamp=time.time(),
+            ))
+
+    def update_pending_executions(self, job_api: _pipeline_jobs_api.PipelineJobApi) -> None:
+        '''Checks the jobs of the pending executions. Records the succeeded steps and forgets the steps of the finished and missing jobs.
+
+        The bookkeeping is best-effort, so the errors are logged and the remaining entries are checked during the next run.
+        '''
+        pending_entries_by_job = {}
+        for entry in self.index.get_pending():
+            pending_entries_by_job.setdefault(entry['job_name'], []).append(entry)
+        for job_name, entries in pending_entries_by_job.items():
+            try:
+                job_json = job_api.get_job_json(job_name, fields='state,jobDetail/taskExecutions(step,state)')
+            except requests.HTTPError as ex:
+                if ex.response is not None and ex.response.status_code == 404:
+                    # The job was deleted or was never created
+                    for entry in entries:
+                        self.index.delete_pending(entry['cache_key'], job_name)
+                else:
+                    logging.warning('Could not get the state of the job {}: {}'.format(job_name, ex))
+                continue
+            except (requests.RequestException, subprocess.SubprocessError, OSError) as ex:
+                # The connection and access token errors affect all jobs
+                logging.warning('Could not update the pending executions: {}'.format(ex))
+                return
+            step_states = {
+                task_execution.get('step'): task_execution.get('state')
+                for task_execution in job_json.get('jobDetail', {}).get('taskExecutions', [])
+            }
+            for entry in entries:
+                if step_states.get(entry['step_name']) == 'SUCCEEDED':
+                    self.index.put(dict(entry, succeeded=True, timestamp=time.time()))
+                    self.index.delete_pending(entry['cache_key'], job_name)
+                elif job_json.get('state') not in _pipeline_jobs_api._ACTIVE_JOB_STATES:
+                    self.index.delete_pending(entry['cache_key'], job_name)
+
+
+def _get_max_age_seconds(task_spec: structures.TaskSpec) -> float:
+    '''Returns the max cache staleness of the task (0 disables caching) or None.'''
+    component_spec = task_spec.component_ref.spec
+    annotations = (component_spec.metadata.annotations if component_spec.metadata else None) or {}
+    if str(annotations.get(_EXECUTION_CACHE_ANNOTATION, '')).lower() == 'false':
+        return 0
+    caching_strategy = task_spec.execution_options.caching_strategy if task_spec.execution_options else None
+    if caching_strategy and caching_strategy.max_cache_staleness:
+        return _parse_duration_seconds(caching_strategy.max_cache_staleness)
+    return None
+
+
+def _replace_in_command(command: List[str], replacements: Dict[str, str]) -> List[str]:
+    new_command = []
+    for part in command:
+        for old, new in replacements.items():
+            part = part.replace(old, new)
+        new_command.append(part)
+    return new_command
+
+
+def apply_execution_cache(
+    pipeline_job: dict,
+    component_spec: structures.ComponentSpec,
+    root_arguments: Dict[str, str],
+    pipeline_root: str,
+    execution_cache: _ExecutionCache,
+    job_name: str = None,
+) -> dict:
+    '''Removes the steps that have cached results and rewires their consumers to the cached outputs.
+
+    The cache key of a step is derived from the component digest, the container image, the constant arguments, the output compression and the cache keys of the upstream steps.
+    Pin the image digests before applying the cache, so that a moved image tag does not reuse the old results.
+    The cacheable steps write their outputs to pipeline_root/kfp_gcp/executions/<cache key>/<job name>/, so that the later runs can reuse them.
+    Without job_name, a random execution id is used instead.
+    The steps whose outputs are consumed as values (not as files) and their downstream steps are not cached.
+    '''
+    if not isinstance(component_spec.implementation, structures.GraphImplementation):
+        return pipeline_job
+    graph_spec = component_spec.implementation.graph
+    steps = pipeline_job['spec']['steps']
+
+    # The outputs that are consumed as values are resolved by the backend from the original output locations
+    value_consumed_steps = set()
+    for step in steps.values():
+        command = step['task'].get('container', {}).get('command', [])
+        for input_name, input_reference in step['task'].get('inputs', {}).items():
+            value_placeholder = "{{{{$.inputs['{}'].value}}}}".format(input_name)
+            if any(value_placeholder in part for part in command):
+                value_consumed_steps.add(input_reference['step_output']['step'])
+
+    cache_keys = {}
+
+    def get_cache_key(task_id: str) -> str:
+        if task_id in cache_keys:
+            return cache_keys[task_id]
+        cache_keys[task_id] = None
+        task_spec = graph_spec.tasks[task_id]
+        step = steps.get(task_id)
+        if not step or 'container' not in step['task'] or task_id in value_consumed_steps or _get_max_age_seconds(task_spec) == 0:
+            return None
+        argument_keys = {}
+        for input_name, argument in (task_spec.arguments or {}).items():
+            if isinstance(argument, str):
+                argument_keys[input_name] = argument
+            elif isinstance(argument, structures.GraphInputArgument):
+                argument_keys[input_name] = root_arguments[argument.graph_input.input_name]
+            elif isinstance(argument, structures.TaskOutputArgument):
+                upstream_cache_key = get_cache_key(argument.task_output.task_id)
+                if upstream_cache_key is None:
+                    return None
+                argument_keys[input_name] = dict(cache_key=upstream_cache_key, output=argument.task_output.output_name)
+            else:
+                return None
+        cache_key_obj = dict(
+            component_digest=_compilation_cache._get_hash(task_spec.component_ref.spec.to_dict()),
+            image=step['task']['container']['image'],
+            arguments=argument_keys,
+        )
+        # The consumers decompress the inputs according to the compression of the producer in the same run,
+        # so the outputs stored with a different compression must not be reused
+        output_compressions = {
+            output_name: output['artifact']['custom_properties']['kfp_gcp.compression']['string_value']
+            for output_name, output in step['task'].get('outputs', {}).items()
+            if 'kfp_gcp.compression' in output.get('artifact', {}).get('custom_properties', {})
+        }
+        if output_compressions:
+            cache_key_obj['output_compressions'] = output_compressions
+        cache_keys[task_id] = _compilation_cache._get_hash(cache_key_obj)
+        return cache_keys[task_id]
+
+    execution_id = job_name or uuid.uuid4().hex
+    cached_output_uris = {}
+    step_output_uris = {}
+    for task_id, task_spec in graph_spec.tasks.items():
+        cache_key = get_cache_key(task_id)
+        if cache_key is None:
+            continue
+        output_uris = execution_cache.get_cached_output_uris(cache_key, _get_max_age_seconds(task_spec))
+        if output_uris is not None:
+            cached_output_uris[task_id] = output_uris
+        else:
+            step_output_uris[task_id] = {
+                output.name: '{}/kfp_gcp/executions/{}/{}/{}'.format(pipeline_root.rstrip('/'), cache_key, execution_id, output.name)
+                for output in task_spec.component_ref.spec.outputs or []
+            }
+
+    new_steps = {}
+    for step_name, step in steps.items():
+        if step_name in cached_output_uris:
+            continue
+        task = step['task']
+        replacements = {}
+        for output_name, output_uri in step_output_uris.get(step_name, {}).items():
+            replacements["{{{{$.outputs['{}'].uri}}}}".format(output_name)] = output_uri
+        new_inputs = {}
+        for input_name, input_reference in task.get('inputs', {}).items():
+            upstream_step_name = input_reference['step_output']['step']
+            upstream_output_name = input_reference['step_output']['output']
+            upstream_output_uris = cached_output_uris.get(upstream_step_name) or step_output_uris.get(upstream_step_name)
+            if upstream_output_uris is not None:
+                replacements["{{{{$.inputs['{}'].uri}}}}".format(input_name)] = upstream_output_uris[upstream_output_name]
+            # The dependencies on the cached steps are removed together with the steps
+            if upstream_step_name not in cached_output_uris:
+                new_inputs[input_name] = input_reference
+        if not replacements:
+            new_steps[step_name] = step
+            continue
+        new_task = dict(task, inputs=new_inputs)
+        if 'container' in task:
+            new_task['container'] = dict(task['container'], command=_replace_in_command(task['container']['command'], replacements))
+        new_steps[step_name] = dict(step, task=new_task)
+
+    logging.info('Execution cache: {} of {} steps are cached.'.format(len(cached_output_uris), len(steps)))
+    new_pipeline_job = dict(pipeline_job, spec=dict(pipeline_job['spec'], steps=new_steps))
+    if step_output_uris:
+        client_metadata = dict(new_pipeline_job.get(_pipeline_jobs_api._CLIENT_METADATA_KEY, {}))
+        client_metadata[_EXECUTION_CACHE_KEYS_KEY] = {
+            step_name: dict(cacheKey=cache_keys[step_name], outputUris=output_uris)
+            for step_name, output_uris in step_output_uris.items()
+        }
+        new_pipeline_job[_pipeline_jobs_api._CLIENT_METADATA_KEY] = client_metadata
+    return new_pipeline_job
@@ -0,0 +1,169 @@
+import collections
+from typing import Dict
+
+from kfp.components import structures
+
+
+# tasks: Flattened task id -> (container task, arguments). The arguments refer to the graph inputs and to the flattened task ids.
+# output_values: Graph output name -> argument.
+_FlattenedGraph = collections.namedtuple('_FlattenedGraph', ['tasks', 'output_values'])
+# Lightweight stand-in for TaskOutputArgument which is expensive to construct
+_TaskOutput = collections.namedtuple('_TaskOutput', ['task_id', 'output_name'])
+
+
+def _get_unique_task_id(task_id: str, used_task_ids: set) -> str:
+    unique_task_id = task_id
+    index = 2
+    while unique_task_id in used_task_ids:
+        unique_task_id = '{} {}'.format(task_id, index)
+        index += 1
+    used_task_ids.add(unique_task_id)
+    return unique_task_id
+
+
+def _make_task_output_argument(task_id: str, output_name: str) -> structures.TaskOutputArgument:
+    return structures.TaskOutputArgument(
+        task_output=structures.TaskOutputReference(
+            task_id=task_id,
+            output_name=output_name,
+        ),
+    )
+
+
+def _to_structures_argument(argument):
+    if isinstance(argument, _TaskOutput):
+        return _make_task_output_argument(argument.task_id, argument.output_name)
+    return argument
+
+
+def _flatten_graph(graph_spec: structures.GraphSpec, memo: dict) -> _FlattenedGraph:
+    '''Inlines the nested graph tasks recursively.
+
+    The inlined tasks get the "<graph task id>/<inner task id>" ids.
+    The flattened graphs are memoized, so a reused nested graph is only flattened once.
+    '''
+    memo_entry = memo.get(id(graph_spec))
+    if memo_entry is not None:
+        return memo_entry[1]
+
+    flat_tasks = collections.OrderedDict()
+    # The own task ids take precedence over the inlined task ids
+    used_task_ids = set(graph_spec.tasks.keys())
+    # Task id -> output name -> argument
+    task_outputs = {}
+
+    def resolve_argument(argument):
+        if isinstance(argument, structures.TaskOutputArgument):
+            return get_task_outputs(argument.task_output.task_id)[argument.task_output.output_name]
+        if isinstance(argument, _TaskOutput):
+            return get_task_outputs(argument.task_id)[argument.output_name]
+        return argument
+
+    def get_task_outputs(task_id: str) -> Dict[str, object]:
+        if task_id in task_outputs:
+            return task_outputs[task_id]
+        task_spec = graph_spec.tasks[task_id]
+        component_spec = task_spec.component_ref.spec
+        # The upstream tasks are added first, so the flattened tasks are topologically sorted
+        arguments = {
+            input_name: resolve_argument(argument)
+            for input_name, argument in (task_spec.arguments or {}).items()
+        }
+        if isinstance(component_spec.implementation, structures.GraphImplementation):
+            flat_subgraph = _flatten_graph(component_spec.implementation.graph, memo)
+            input_defaults = {
+                input_spec.name: input_spec.default
+                for input_spec in component_spec.inputs or []
+                if input_spec.default is not None
+            }
+            for input_spec in component_spec.inputs or []:
+                if input_spec.name not in arguments and input_spec.default is None and not input_spec.optional:
+                    raise ValueError('Missing argument for input "{}" of the graph task "{}"'.format(input_spec.name, task_id))
+            subtask_ids = {
+                subtask_id: _get_unique_task_id(task_id + '/' + subtask_id, used_task_ids)
+                for subtask_id in flat_subgraph.tasks.keys()
+            }
+
+            def rebind_argument(argument):
+                if isinstance(argument, structures.GraphInputArgument):
+                    input_name = argument.graph_input.input_name
+                    return arguments.get(input_name, input_defaults.get(input_name))
+                if isinstance(argument, _TaskOutput):
+                    return _TaskOutput(subtask_ids[argument.task_id], argument.output_name)
+                return argument
+
+            for subtask_id, (subtask_spec, subtask_arguments) in flat_subgraph.tasks.items():
+                new_subtask_arguments = {}
+                for input_name, argument in subtask_arguments.items():
+                    argument = rebind_argument(argument)
+                    # The optional graph inputs that were not passed
+                    if argument is not None:
+                        new_subtask_arguments[input_name] = argument
+                flat_tasks[subtask_ids[subtask_id]] = (subtask_spec, new_subtask_arguments)
+            outputs = {
+                output_name: rebind_argument(output_value)
+                for output_name, output_value in (flat_subgraph.output_values or {}).items()
+            }
+        elif isinstance(component_spec.implementation, structures.ContainerImplementation):
+            flat_tasks[task_id] = (task_spec, arguments)
+            outputs = {
+                output_spec.name: _TaskOutput(task_id, output_spec.name)
+                for output_spec in component_spec.outputs or []
+            }
+        else:
+            raise TypeError('Unsupported implementation of the task "{}": {}'.format(task_id, component_spec.implementation))
+        task_outputs[task_id] = outputs
+        return outputs
+
+    for task_id in graph_spec.tasks.keys():
+        get_task_outputs(task_id)
+    output_values = {
+        output_name: resolve_argument(output_value)
+        for output_name, output_value in (graph_spec.output_values or {}).items()
+    }
+    flat_graph = _FlattenedGraph(tasks=flat_tasks, output_values=output_values)
+    # Keeping the graph alive so that its id is not reused
+    memo[id(graph_spec)] = (graph_spec, flat_graph)
+    return flat_graph
+
+
+def flatten_graph_component(component_spec: structures.ComponentSpec) -> structures.ComponentSpec:
+    '''Returns the component with all nested graph tasks inlined. CAIP Pipelines do not support sub-DAGs.'''
+    if not isinstance(component_spec.implementation, structures.GraphImplementation):
+        return component_spec
+    graph_spec = component_spec.implementation.graph
+    if all(
+        not isinstance(task_spec.component_ref.spec.implementation, structures.GraphImplementation)
+        for task_spec in graph_spec.tasks.values()
+    ):
+        return component_spec
+    flat_graph = _flatten_graph(graph_spec, memo={})
+    return structures.ComponentSpec(
+        name=component_spec.name,
+        description=component_spec.description,
+        metadata=component_spec.metadata,
+        inputs=component_spec.inputs,
+        outputs=component_spec.outputs,
+        implementation=structures.GraphImplementation(
+            graph=structures.GraphSpec(
+                tasks={
+                    task_id: structures.TaskSpec(
+                        component_ref=task_spec.component_ref,
+                        arguments={
+                            input_name: _to_structures_argument(argument)
+                            for input_name, argument in arguments.items()
+                        },
+                        is_enabled=task_spec.is_enabled,
+                        execution_options=task_spec.execution_options,
+                        annotations=task_spec.annotations,
+                    )
+                    for task_id, (task_spec, arguments) in flat_graph.tasks.items()
+                },
+                output_values={
+                    output_name: _to_structures_argument(output_value)
+                    for output_name, output_value in flat_graph.output_values.items()
+                },
+            ),
+        ),
+        version=component_spec.version,
+    )
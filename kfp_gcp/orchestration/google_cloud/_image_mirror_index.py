@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import pathlib
+import time
+
+
+def _get_user_cache_dir() -> pathlib.Path:
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return pathlib.Path(cache_dir) / 'kfp_gcp'
+
+
+class _JsonLinesIndex:
+    '''Persistent index stored as a JSON-lines file. Later lines override the earlier ones.
+
+    The entries are dicts keyed by the key_name field. Every entry gets a timestamp.
+    The entries that are older than ttl_seconds are treated as missing unless include_expired is set.
+    '''
+    key_name = None
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        ttl_seconds: float = 24 * 60 * 60,
+    ):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._entries = None
+        self._line_count = 0
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            self._entries = {}
+            self._line_count = 0
+            try:
+                with self.path.open('r') as index_file:
+                    for line in index_file:
+                        self._line_count += 1
+                        try:
+                            entry = json.loads(line)
+                            self._entries[entry[self.key_name]] = entry
+                        except (ValueError, KeyError):
+                            # Skipping the lines that were corrupted by interrupted writes
+                            continue
+            except FileNotFoundError:
+                pass
+            except OSError as ex:
+                logging.warning('Could not read the index {}: {}'.format(self.path, ex))
+        return self._entries
+
+    def get(self, key: str, include_expired: bool = False) -> dict:
+        entry = self._load().get(key)
+        if entry is None:
+            return None
+        if not include_expired and time.time() - entry['timestamp'] > self.ttl_seconds:
+            return None
+        return entry
+
+    def _put_entries(self, entries: list) -> None:
+        if not entries:
+            return
+        index = self._load()
+        timestamp = time.time()
+        new_lines = []
+        for entry in entries:
+            entry = dict(entry, timestamp=timestamp)
+            index[entry[self.key_name]] = entry
+            new_lines.append(json.dumps(entry, sort_keys=True) + '\n')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Compacting the file once it accumulates too many outdated lines
+            if self._line_count + len(new_lines) > 2 * len(index) + 100:
+                temp_path = self.path.with_name(self.path.name + '.{}.tmp'.format(os.getpid()))
+                with temp_path.open('w') as index_file:
+                    index_file.writelines(json.dumps(entry, sort_keys=True) + '\n' for entry in index.values())
+                os.replace(str(temp_path), str(self.path))
+                self._line_count = len(index)
+            else:
+                with self.path.open('a') as index_file:
+                    index_file.write(''.join(new_lines))
+                self._line_count += len(new_lines)
+        except OSError as ex:
+            logging.warning('Could not update the index {}: {}'.format(self.path, ex))
+
+
+class _ImageMirrorIndex(_JsonLinesIndex):
+    '''Persistent index of the mirrored container images.
+
+    Maps source image to the mirror image and the digest of the source image at the time of mirroring.
+    The entries that are older than ttl_seconds must be re-validated against the registry.
+    '''
+    key_name = 'source_image'
+
+    def __init__(
+        self,
+        path: str = None,
+        ttl_seconds: float = 24 * 60 * 60,
+    ):
+        super().__init__(
+            path=pathlib.Path(path) if path else _get_user_cache_dir() / 'image_mirror_index.jsonl',
+            ttl_seconds=ttl_seconds,
+        )
+
+    def get(self, source_image: str, include_expired: bool = False) -> dict:
+        '''Returns the index entry {source_image, mirror_image, digest, timestamp} or None.'''
+        return super().get(source_image, include_expired=include_expired)
+
+    def put_many(self, entries: list) -> None:
+        '''Records the entries. Each entry is a (source_image, mirror_image, digest) tuple.'''
+        self._put_entries([
+            dict(source_image=source_image, mirror_image=mirror_image, digest=digest)
+            for source_image, mirror_image, digest in entries
+        ])
+
+
+class _ImageDigestIndex(_JsonLinesIndex):
+    '''Persistent cache of the resolved container image digests.
+
+    Maps image (usually a tag) to its digest. The tags can be moved, so the entries expire after ttl_seconds.
+    '''
+    key_name = 'image'
+
+    def __init__(
+        self,
+        path: str = None,
+        ttl_seconds: float = 24 * 60 * 60,
+    ):
+        super().__init__(
+            path=pathlib.Path(path) if path else _get_user_cache_dir() / 'image_digest_index.jsonl',
+            ttl_seconds=ttl_seconds,
+        )
+
+    def get(self, image: str, include_expired: bool = False) -> dict:
+        '''Returns the index entry {image, digest, timestamp} or None.'''
+        return super().get(image, include_expired=include_expired)
+
+    def put_many(self, entries: list) -> None:
+        '''Records the entries. Each entry is an (image, digest) tuple.'''
+        self._put_entries([dict(image=image, digest=digest) for image, digest in entries])
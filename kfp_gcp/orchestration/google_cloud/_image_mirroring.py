@@ -1,9 +1,29 @@
 import json
 import logging
 import subprocess
+from concurrent import futures
+from typing import Callable, Dict, Iterable
 
+from . import _container_registry
+from . import _image_mirror_index
+from . import _instrumentation
+from . import _job_passes
+from . import _pipeline_jobs_api
 
-def mirror_and_replace_container_images(pipeline_job: dict, mirror_prefix: str, project_id: str = None)-> dict:
+
+_PINNED_IMAGES_KEY = 'pinnedImages'
+
+
+@_instrumentation.traced('mirror_images')
+def mirror_and_replace_container_images(
+    pipeline_job: dict,
+    mirror_prefix: str,
+    project_id: str = None,
+    max_parallelism: int = 16,
+    registry_client: _container_registry._RegistryClient = None,
+    mirror_index: _image_mirror_index._ImageMirrorIndex = None,
+    in_place: bool = False,
+)-> dict:
     container_images = _get_all_used_images(pipeline_job)
     replacement_images = {
         image: mirror_prefix + image
@@ -11,18 +31,67 @@ def mirror_and_replace_container_images(pipeline_job: dict, mirror_prefix: str,
         if not image.startswith('gcr.io/')
     }
 
+    # The recently mirrored images do not need to be checked again
+    images_to_check = {}
+    for image, replacement in replacement_images.items():
+        index_entry = mirror_index.get(image) if mirror_index else None
+        if not index_entry or index_entry['mirror_image'] != replacement:
+            images_to_check[image] = replacement
+
     # Mirror the images
     logging.debug('Mirroring container images: Checking for existing mirrors.')
+    registry_client = registry_client or _container_registry._RegistryClient()
+    existing_images = _check_images_exist(
+        images=images_to_check.values(),
+        project_id=project_id,
+        max_parallelism=max_parallelism,
+        registry_client=registry_client,
+    )
+    source_image_digests = {}
+    if mirror_index:
+        source_image_digests = _get_image_digests(
+            images=images_to_check.keys(),
+            max_parallelism=max_parallelism,
+            registry_client=registry_client,
+        )
+
     images_to_mirror = {}
-    for image, replacement in replacement_images.items():
-        if not _inspect_google_container_registry_image(replacement):
+    for image, replacement in images_to_check.items():
+        if not existing_images[replacement]:
+            images_to_mirror[image] = replacement
+            continue
+        # The source tag might have been moved to a different image since it was mirrored
+        index_entry = mirror_index.get(image, include_expired=True) if mirror_index else None
+        source_image_digest = source_image_digests.get(image)
+        if (index_entry and index_entry['mirror_image'] == replacement
+            and index_entry['digest'] and source_image_digest
+            and index_entry['digest'] != source_image_digest
+        ):
             images_to_mirror[image] = replacement
-    
+
     if images_to_mirror:
-        _mirror_images_using_gcloud_build(images_to_mirror, project_id)
-    
-    patched_pipeline_job = _replace_used_images(pipeline_job, replacement_images)
-    return patched_pipeline_job
+        try:
+            _mirror_images_using_registry_api(
+                image_mirrors=images_to_mirror,
+                max_parallelism=max_parallelism,
+                registry_client=registry_client,
+            )
+        except Exception as ex:
+            logging.warning('Failed to mirror the images using the registry API. Falling back to Cloud Build. Error: {}'.format(ex))
+            _mirror_images_using_gcloud_build(images_to_mirror, project_id)
+
+    if mirror_index:
+        mirror_index.put_many([
+            (image, replacement, source_image_digests.get(image))
+            for image, replacement in images_to_check.items()
+        ])
+
+    # The pins recorded by pin_container_image_digests must describe the images that actually run
+    return _job_passes.apply_passes(
+        pipeline_job,
+        [_get_image_replacement_pass(replacement_images), _get_pinned_images_replacement_pass(replacement_images)],
+        in_place=in_place,
+    )
 
 
 def _get_all_used_images(pipeline_job_dict: dict) -> set:
@@ -34,16 +103,102 @@ def _get_all_used_images(pipeline_job_dict: dict) -> set:
     return images
 
 
-def _replace_used_images(pipeline_job_dict: dict, replacement_map: dict) -> set:
-    import copy
-    pipeline_job_dict = copy.deepcopy(pipeline_job_dict)
-    steps = pipeline_job_dict['spec']['steps']
-    for step in steps.values():
-        image = step['task']['container']['image']
-        step['task']['container']['image'] = replacement_map.get(image, image)
-    return pipeline_job_dict
+def _get_image_replacement_pass(replacement_map: dict) -> Callable[[_job_passes._JobEditor], None]:
+    def replace_images(editor: _job_passes._JobEditor) -> None:
+        for step_name, step in editor.get(['spec', 'steps']).items():
+            image = step['task']['container']['image']
+            if image in replacement_map:
+                editor.set(['spec', 'steps', step_name, 'task', 'container', 'image'], replacement_map[image])
+    return replace_images
+
+
+def _get_pinned_images_replacement_pass(replacement_map: dict) -> Callable[[_job_passes._JobEditor], None]:
+    def replace_pinned_images(editor: _job_passes._JobEditor) -> None:
+        pinned_images = editor.get([_pipeline_jobs_api._CLIENT_METADATA_KEY, _PINNED_IMAGES_KEY])
+        if pinned_images and any(image in replacement_map for image in pinned_images):
+            editor.set(
+                [_pipeline_jobs_api._CLIENT_METADATA_KEY, _PINNED_IMAGES_KEY],
+                {replacement_map.get(image, image): source_image for image, source_image in pinned_images.items()},
+            )
+    return replace_pinned_images
+
+
+def _replace_used_images(pipeline_job_dict: dict, replacement_map: dict, in_place: bool = False) -> dict:
+    # Only the edited steps are copied. The rest of the job is shared with the original.
+    return _job_passes.apply_passes(pipeline_job_dict, [_get_image_replacement_pass(replacement_map)], in_place=in_place)
+
+
+@_instrumentation.traced('pin_image_digests')
+def pin_container_image_digests(
+    pipeline_job: dict,
+    image_digests: Dict[str, str] = None,
+    digest_index: _image_mirror_index._ImageDigestIndex = None,
+    max_parallelism: int = 16,
+    registry_client: _container_registry._RegistryClient = None,
+    in_place: bool = False,
+) -> dict:
+    '''Replaces the container image tags with the immutable digests.
+
+    image_digests memoizes the resolved digests. Pass the same dict to reuse them between calls.
+    digest_index optionally persists the resolved digests between runs.
+    The job client metadata maps the pinned images to the original images.
+    mirror_and_replace_container_images updates the mapping, so that it is keyed by the images that actually run.
+    Unless in_place is True, the original job is not modified and the result shares the unchanged parts with it.
+    '''
+    if image_digests is None:
+        image_digests = {}
+    container_images = _get_all_used_images(pipeline_job)
+    images_to_resolve = set()
+    for image in container_images:
+        if '@' in image or image in image_digests:
+            continue
+        index_entry = digest_index.get(image) if digest_index else None
+        if index_entry and index_entry['digest']:
+            image_digests[image] = index_entry['digest']
+        else:
+            images_to_resolve.add(image)
+
+    resolved_digests = _get_image_digests(
+        images=images_to_resolve,
+        max_parallelism=max_parallelism,
+        registry_client=registry_client,
+    )
+    unresolved_images = sorted(image for image, digest in resolved_digests.items() if not digest)
+    if unresolved_images:
+        raise RuntimeError('Could not resolve the digests of the container images: {}'.format(unresolved_images))
+    image_digests.update(resolved_digests)
+
+    pinned_images = {
+        image: _get_image_name_without_tag(image) + '@' + image_digests[image]
+        for image in container_images
+        if '@' not in image
+    }
+    if digest_index:
+        digest_index.put_many([(image, resolved_digests[image]) for image in images_to_resolve])
 
+    def record_pinned_images(editor: _job_passes._JobEditor) -> None:
+        client_metadata = dict(editor.get([_pipeline_jobs_api._CLIENT_METADATA_KEY], {}))
+        client_metadata[_PINNED_IMAGES_KEY] = dict(
+            client_metadata.get(_PINNED_IMAGES_KEY, {}),
+            **{pinned_image: image for image, pinned_image in pinned_images.items()}
+        )
+        editor.set([_pipeline_jobs_api._CLIENT_METADATA_KEY], client_metadata)
+
+    return _job_passes.apply_passes(
+        pipeline_job,
+        [_get_image_replacement_pass(pinned_images), record_pinned_images],
+        in_place=in_place,
+    )
 
+
+def _get_image_name_without_tag(image: str) -> str:
+    name = image.split('@', 1)[0]
+    if ':' in name.rsplit('/', 1)[-1]:
+        name = name.rsplit(':', 1)[0]
+    return name
+
+
+@_instrumentation.traced('gcloud_container_images_describe')
 def _inspect_google_container_registry_image(image: str, project_id: str = None) -> dict:
     command_line = ['gcloud', 'container', 'images', 'describe', image, '--format', 'json']
     if project_id:
@@ -58,6 +213,64 @@ def _inspect_google_container_registry_image(image: str, project_id: str = None)
     return json.loads(process_run.stdout)
 
 
+def _check_image_exists(
+    image: str,
+    project_id: str = None,
+    registry_client: _container_registry._RegistryClient = None,
+) -> bool:
+    # The registry API is much faster than spawning gcloud, but gcloud knows more ways to authenticate.
+    if registry_client:
+        try:
+            return registry_client.image_exists(image)
+        except Exception as ex:
+            logging.debug('Failed to check image {} using the registry API. Falling back to gcloud. Error: {}'.format(image, ex))
+    return bool(_inspect_google_container_registry_image(image, project_id))
+
+
+def _map_concurrently(func: Callable, items: Iterable, max_parallelism: int = 16) -> dict:
+    items = list(items)
+    if not items:
+        return {}
+    with futures.ThreadPoolExecutor(max_workers=max(1, min(max_parallelism, len(items)))) as executor:
+        item_futures = {item: executor.submit(func, item) for item in items}
+        return {item: future.result() for item, future in item_futures.items()}
+
+
+def _check_images_exist(
+    images: Iterable[str],
+    project_id: str = None,
+    max_parallelism: int = 16,
+    registry_client: _container_registry._RegistryClient = None,
+) -> Dict[str, bool]:
+    registry_client = registry_client or _container_registry._RegistryClient()
+    return _map_concurrently(
+        func=lambda image: _check_image_exists(image, project_id, registry_client),
+        items=images,
+        max_parallelism=max_parallelism,
+    )
+
+
+def _get_image_digests(
+    images: Iterable[str],
+    max_parallelism: int = 16,
+    registry_client: _container_registry._RegistryClient = None,
+) -> Dict[str, str]:
+    registry_client = registry_client or _container_registry._RegistryClient()
+
+    def get_image_digest(image: str) -> str:
+        try:
+            return registry_client.get_manifest_digest(image)
+        except Exception as ex:
+            logging.debug('Failed to get the digest of image {}. Error: {}'.format(image, ex))
+            return None
+
+    return _map_concurrently(
+        func=get_image_digest,
+        items=images,
+        max_parallelism=max_parallelism,
+    )
+
+
 def _prepare_cloudbuild_config_that_mirrors_images(image_mirrors: dict) -> dict:
     build_steps = []
     build_images = []
@@ -82,9 +295,24 @@ def _prepare_cloudbuild_config_that_mirrors_images(image_mirrors: dict) -> dict:
         )
         build_steps.append(build_step)
 
-        return build_config
+    return build_config
+
+
+@_instrumentation.traced('mirror_images_using_registry_api')
+def _mirror_images_using_registry_api(
+    image_mirrors: dict,
+    max_parallelism: int = 16,
+    registry_client: _container_registry._RegistryClient = None,
+) -> None:
+    logging.info('Mirroring container images: ' + str(image_mirrors))
+    image_copier = _container_registry._ImageCopier(
+        registry_client=registry_client,
+        max_parallelism=max_parallelism,
+    )
+    image_copier.copy_images(image_mirrors)
 
 
+@_instrumentation.traced('gcloud_builds_submit')
 def _mirror_images_using_gcloud_build(image_mirrors: dict, project_id: str = None) -> None:
     logging.info('Mirroring container images: ' + str(image_mirrors))
     build_config = _prepare_cloudbuild_config_that_mirrors_images(image_mirrors)
@@ -0,0 +1,244 @@
+'''Pluggable timing spans and counters for the compilation, image mirroring, job submission and polling.
+
+The instrumentation is disabled by default. Enable it with set_instrumentation:
+
+    metrics = _instrumentation._MetricsInstrumentation()
+    _instrumentation.set_instrumentation(metrics)
+    ...
+    print(metrics.to_prometheus_text())
+
+The labels are aggregated in the metrics, so they must have few distinct values.
+The span attributes are only logged, so they can have any values.
+'''
+import collections
+import functools
+import json
+import logging
+import re
+import threading
+import time
+from typing import Callable, Iterable
+
+
+class _NoOpSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+
+_NO_OP_SPAN = _NoOpSpan()
+
+
+class _Instrumentation:
+    '''The instrumentation that does nothing. The base class of the exporters.'''
+    def span(self, name: str, **labels):
+        return _NO_OP_SPAN
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        pass
+
+
+class _Span:
+    def __init__(self, instrumentation: '_RecordingInstrumentation', name: str, labels: dict):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.labels = labels
+        self.attributes = {}
+        self.start_time = None
+        self.duration_seconds = None
+        self.error = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.duration_seconds = time.perf_counter() - self.start_time
+        if exception_type is not None:
+            self.error = exception_type.__name__
+        self.instrumentation._record_span(self)
+        return False
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+
+class _RecordingInstrumentation(_Instrumentation):
+    def span(self, name: str, **labels):
+        return _Span(self, name, labels)
+
+    def _record_span(self, span: _Span) -> None:
+        raise NotImplementedError()
+
+
+class _StructuredLogInstrumentation(_RecordingInstrumentation):
+    '''Logs every span and counter increment as a single-line JSON event.'''
+    def __init__(self, logger: logging.Logger = None, level: int = logging.INFO):
+        self.logger = logger or logging.getLogger('kfp_gcp.instrumentation')
+        self.level = level
+
+    def _record_span(self, span: _Span) -> None:
+        if not self.logger.isEnabledFor(self.level):
+            return
+        event = collections.OrderedDict(
+            event='span',
+            name=span.name,
+            duration_ms=round(span.duration_seconds * 1000, 3),
+        )
+        event.update(span.labels)
+        event.update(span.attributes)
+        if span.error:
+            event['error'] = span.error
+        self.logger.log(self.level, json.dumps(event, default=str))
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        if not self.logger.isEnabledFor(self.level):
+            return
+        event = collections.OrderedDict(event='counter', name=name, value=value)
+        event.update(labels)
+        self.logger.log(self.level, json.dumps(event, default=str))
+
+
+def _get_metric_key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted(labels.items())))
+
+
+def _format_prometheus_labels(labels: Iterable[tuple]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            _sanitize_prometheus_name(key),
+            str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'),
+        )
+        for key, value in labels
+    ) + '}'
+
+
+def _sanitize_prometheus_name(name: str) -> str:
+    return re.sub('[^a-zA-Z0-9_]', '_', name)
+
+
+class _MetricsInstrumentation(_RecordingInstrumentation):
+    '''Aggregates the span durations and the counters in memory. to_prometheus_text dumps them in the Prometheus text format.'''
+    def __init__(self, prefix: str = 'kfp_gcp_'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # (name, labels) -> [count, total seconds, max seconds]
+        self.span_durations = {}
+        # (name, labels) -> value
+        self.counters = collections.Counter()
+
+    def _record_span(self, span: _Span) -> None:
+        labels = dict(span.labels, error=span.error) if span.error else span.labels
+        key = _get_metric_key(span.name, labels)
+        with self._lock:
+            stats = self.span_durations.get(key)
+            if stats is None:
+                self.span_durations[key] = [1, span.duration_seconds, span.duration_seconds]
+            else:
+                stats[0] += 1
+                stats[1] += span.duration_seconds
+                stats[2] = max(stats[2], span.duration_seconds)
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = _get_metric_key(name, labels)
+        with self._lock:
+            self.counters[key] += value
+
+    def to_prometheus_text(self) -> str:
+        lines = []
+        with self._lock:
+            span_durations = sorted((key, list(stats)) for key, stats in self.span_durations.items())
+            counters = sorted(self.counters.items())
+        if span_durations:
+            # The lines of every metric family must be grouped together
+            metric_name = self.prefix + 'span_duration_seconds'
+            lines.append('# TYPE {} summary'.format(metric_name))
+            for (name, labels), (count, total_seconds, _) in span_durations:
+                formatted_labels = _format_prometheus_labels((('span', name),) + labels)
+                lines.append('{}_count{} {}'.format(metric_name, formatted_labels, count))
+                lines.append('{}_sum{} {:.6f}'.format(metric_name, formatted_labels, total_seconds))
+            lines.append('# TYPE {}_max gauge'.format(metric_name))
+            for (name, labels), (_, _, max_seconds) in span_durations:
+                formatted_labels = _format_prometheus_labels((('span', name),) + labels)
+                lines.append('{}_max{} {:.6f}'.format(metric_name, formatted_labels, max_seconds))
+        previous_name = None
+        for (name, labels), value in counters:
+            metric_name = self.prefix + _sanitize_prometheus_name(name) + '_total'
+            if name != previous_name:
+                lines.append('# TYPE {} counter'.format(metric_name))
+                previous_name = name
+            lines.append('{}{} {}'.format(metric_name, _format_prometheus_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+class _MultiInstrumentation(_Instrumentation):
+    '''Sends the spans and counters to several instrumentations. For example, to both log and aggregate them.'''
+    def __init__(self, instrumentations: Iterable[_Instrumentation]):
+        self.instrumentations = list(instrumentations)
+
+    def span(self, name: str, **labels):
+        return _MultiSpan([instrumentation.span(name, **labels) for instrumentation in self.instrumentations])
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        for instrumentation in self.instrumentations:
+            instrumentation.increment(name, value, **labels)
+
+
+class _MultiSpan:
+    def __init__(self, spans: list):
+        self.spans = spans
+
+    def __enter__(self):
+        for span in self.spans:
+            span.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        for span in reversed(self.spans):
+            span.__exit__(*args)
+        return False
+
+    def set_attribute(self, key: str, value) -> None:
+        for span in self.spans:
+            span.set_attribute(key, value)
+
+
+_NO_OP_INSTRUMENTATION = _Instrumentation()
+_current_instrumentation = _NO_OP_INSTRUMENTATION
+
+
+def set_instrumentation(instrumentation: _Instrumentation = None) -> _Instrumentation:
+    '''Sets the process-wide instrumentation. None disables the instrumentation. Returns the previous instrumentation.'''
+    global _current_instrumentation
+    previous_instrumentation = _current_instrumentation
+    _current_instrumentation = instrumentation or _NO_OP_INSTRUMENTATION
+    return previous_instrumentation
+
+
+def span(name: str, **labels):
+    '''Returns a context manager that times the enclosed code.'''
+    return _current_instrumentation.span(name, **labels)
+
+
+def increment(name: str, value: float = 1, **labels) -> None:
+    _current_instrumentation.increment(name, value, **labels)
+
+
+def traced(name: str) -> Callable[[Callable], Callable]:
+    '''Decorator that times every call of the function.'''
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_instrumentation is _NO_OP_INSTRUMENTATION:
+                return func(*args, **kwargs)
+            with _current_instrumentation.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,81 @@
+from typing import Callable, Iterable, Sequence
+
+
+_MISSING = object()
+
+
+class _JobEditor:
+    '''Edits a compiled pipeline job without copying the whole job.
+
+    In the copy-on-write mode (the default), an edit shallow-copies only the dicts and lists along the edited path.
+    The unchanged subtrees are shared with the original job which is never modified.
+    Each container is copied at most once, so many edits of the same step cost about as much as one.
+    In the in-place mode, the original job is modified directly.
+    '''
+    def __init__(self, pipeline_job: dict, in_place: bool = False):
+        self.job = pipeline_job
+        self.in_place = in_place
+        # The ids of the containers that were copied by this editor and can be modified.
+        # The copies are referenced by the job, so their ids are not reused.
+        self._owned_ids = set()
+        if not in_place:
+            self.job = dict(pipeline_job)
+        self._owned_ids.add(id(self.job))
+
+    def get(self, path: Sequence, default=None):
+        obj = self.job
+        for key in path:
+            try:
+                obj = obj[key]
+            except (KeyError, IndexError, TypeError):
+                return default
+        return obj
+
+    def _get_writable(self, path: Sequence):
+        '''Returns the container at the path, copying it and its parents if they are shared with the original job.'''
+        obj = self.job
+        for key in path:
+            child = obj[key]
+            if not self.in_place and id(child) not in self._owned_ids:
+                if isinstance(child, dict):
+                    child = dict(child)
+                elif isinstance(child, list):
+                    child = list(child)
+                else:
+                    raise TypeError('Cannot edit inside {} at {}'.format(type(child).__name__, list(path)))
+                obj[key] = child
+                self._owned_ids.add(id(child))
+            obj = child
+        return obj
+
+    def set(self, path: Sequence, value) -> None:
+        if not path:
+            raise ValueError('The path must not be empty.')
+        if self.get(path, _MISSING) is value:
+            return
+        self._get_writable(path[:-1])[path[-1]] = value
+
+    def update(self, path: Sequence, func: Callable) -> None:
+        '''Replaces the value at the path with func(value).'''
+        self.set(path, func(self.get(path)))
+
+    def delete(self, path: Sequence) -> None:
+        if self.get(path, _MISSING) is _MISSING:
+            return
+        del self._get_writable(path[:-1])[path[-1]]
+
+
+def apply_passes(
+    pipeline_job: dict,
+    passes: Iterable[Callable[[_JobEditor], None]],
+    in_place: bool = False,
+) -> dict:
+    '''Applies the transformation passes to the job and returns the transformed job.
+
+    Each pass is a function that edits the job through the _JobEditor it receives.
+    Unless in_place is True, the original job is not modified and the result shares the unchanged subtrees with it.
+    '''
+    editor = _JobEditor(pipeline_job, in_place=in_place)
+    for job_pass in passes:
+        job_pass(editor)
+    return editor.job
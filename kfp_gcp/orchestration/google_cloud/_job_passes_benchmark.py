@@ -0,0 +1,97 @@
+'''Benchmark of the container image replacement with a full job deepcopy versus the copy-on-write and in-place job passes.
+
+Usage: python -m kfp_gcp.orchestration.google_cloud._job_passes_benchmark --steps 1000 5000
+'''
+import argparse
+import collections
+import copy
+import json
+import time
+import tracemalloc
+from typing import Callable, List
+
+from . import _image_mirroring
+
+
+_benchmark_images = ['python:3.{}'.format(index) for index in range(4)]
+
+
+def _create_benchmark_job(step_count: int, script_size: int = 3000, argument_count: int = 20) -> dict:
+    '''Returns a chain of step_count steps with command lines about as large as the compiled wrapper commands.'''
+    steps = {}
+    for index in range(step_count):
+        step = dict(task=dict(
+            container=dict(
+                image=_benchmark_images[index % len(_benchmark_images)],
+                command=['sh', '-e', '-c', 'x' * script_size + str(index), 'prog'] + ['--arg{}'.format(number) for number in range(argument_count)],
+            ),
+            inputs={},
+            outputs=dict(data=dict(artifact=dict(custom_properties={}))),
+        ))
+        if index:
+            step['task']['inputs']['data'] = dict(step_output=dict(step='step-{}'.format(index - 1), output='data'))
+        steps['step-{}'.format(index)] = step
+    return dict(spec=dict(steps=steps), clientMetadata={})
+
+
+def _replace_used_images_using_deepcopy(pipeline_job_dict: dict, replacement_map: dict) -> dict:
+    '''The image replacement before the job passes. Copies the whole job.'''
+    pipeline_job_dict = copy.deepcopy(pipeline_job_dict)
+    for step in pipeline_job_dict['spec']['steps'].values():
+        image = step['task']['container']['image']
+        step['task']['container']['image'] = replacement_map.get(image, image)
+    return pipeline_job_dict
+
+
+def _measure(func: Callable, create_job: Callable, repeat_count: int) -> tuple:
+    '''Returns the best time, the retained and the peak memory of func(create_job()). The job creation is not measured.'''
+    durations = []
+    for _ in range(repeat_count):
+        job = create_job()
+        start_time = time.perf_counter()
+        func(job)
+        durations.append(time.perf_counter() - start_time)
+    job = create_job()
+    tracemalloc.start()
+    result = func(job)
+    retained_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(durations), retained_memory, peak_memory, result
+
+
+def run_job_passes_benchmark(step_counts: List[int], repeat_count: int = 3) -> List[dict]:
+    '''Replaces all images of the benchmark jobs in every mode. Reports the best time, the retained and the peak memory.'''
+    replacement_map = {image: 'gcr.io/benchmark/mirror/' + image for image in _benchmark_images}
+    modes = [
+        ('deepcopy', lambda job: _replace_used_images_using_deepcopy(job, replacement_map)),
+        ('copy_on_write', lambda job: _image_mirroring._replace_used_images(job, replacement_map)),
+        ('in_place', lambda job: _image_mirroring._replace_used_images(job, replacement_map, in_place=True)),
+    ]
+    results = []
+    for step_count in step_counts:
+        original_job = _create_benchmark_job(step_count)
+        result = collections.OrderedDict(steps=step_count)
+        outputs = []
+        for mode, func in modes:
+            # The in-place mode modifies the job, so it gets a fresh copy for every run
+            create_job = (lambda: copy.deepcopy(original_job)) if mode == 'in_place' else (lambda: original_job)
+            duration, retained_memory, peak_memory, output = _measure(func, create_job, repeat_count)
+            result[mode + '_ms'] = duration * 1000
+            result[mode + '_retained_mb'] = retained_memory / 1e6
+            result[mode + '_peak_mb'] = peak_memory / 1e6
+            outputs.append(json.dumps(output, sort_keys=True))
+        result['identical_output'] = len(set(outputs)) == 1
+        results.append(result)
+    return results
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description='Benchmarks the container image replacement with a deepcopy versus the copy-on-write job passes.')
+    parser.add_argument('--steps', type=int, nargs='+', default=[1000, 5000], help='Step counts of the benchmark jobs.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs. The best time is reported.')
+    args = parser.parse_args(argv)
+    print(json.dumps(run_job_passes_benchmark(args.steps, args.repeat), indent=2))
+
+
+if __name__ == '__main__':
+    main()
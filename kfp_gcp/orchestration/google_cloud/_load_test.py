@@ -0,0 +1,211 @@
+'''Load test of the job submission and monitoring against the pipelineJobs API emulator.
+
+Usage: python -m kfp_gcp.orchestration.google_cloud._load_test --jobs 1000 --submitters 16 --pollers 16
+'''
+import argparse
+import collections
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from typing import Callable, Dict, List
+
+from . import _pipeline_jobs_api
+from . import _pipeline_jobs_emulator
+
+
+def _get_percentile(sorted_values: List[float], percentile: float) -> float:
+    '''Returns the nearest-rank percentile.'''
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(percentile / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class _LatencyRecorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Operation -> latencies in seconds
+        self.latencies = collections.defaultdict(list)
+        self.error_counts = collections.Counter()
+
+    def call(self, operation: str, func: Callable, *args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.error_counts[operation] += 1
+            return None
+        finally:
+            latency = time.perf_counter() - start_time
+            with self._lock:
+                self.latencies[operation].append(latency)
+
+    def get_report(self, duration_seconds: float) -> Dict[str, dict]:
+        report = {}
+        for operation, latencies in sorted(self.latencies.items()):
+            sorted_latencies = sorted(latencies)
+            report[operation] = collections.OrderedDict(
+                count=len(latencies),
+                errors=self.error_counts[operation],
+                p50_ms=_get_percentile(sorted_latencies, 50) * 1000,
+                p99_ms=_get_percentile(sorted_latencies, 99) * 1000,
+                max_ms=sorted_latencies[-1] * 1000,
+                per_second=len(latencies) / duration_seconds if duration_seconds else None,
+            )
+        return report
+
+
+def run_load_test(
+    job_api: _pipeline_jobs_api.PipelineJobApi,
+    pipeline_job: dict,
+    job_count: int = 100,
+    submitter_count: int = 8,
+    poller_count: int = 8,
+    poll_interval_seconds: float = 0,
+    list_polling: bool = False,
+    job_name_prefix: str = None,
+) -> dict:
+    '''Submits job_count copies of pipeline_job using submitter_count threads while poller_count threads poll the submitted jobs until they stop.
+
+    Every poller gets the state of one job per request, or the states of all jobs with the list requests when list_polling is True.
+    The operation latencies include the client retries.
+    Returns the latency percentiles and the throughput of every operation.
+    '''
+    job_name_prefix = job_name_prefix or 'load-test-{}-'.format(int(time.time() * 1000))
+    recorder = _LatencyRecorder()
+    job_numbers = itertools.count()
+    submitted_job_names = []
+    active_job_names = set()
+    lock = threading.Lock()
+    submission_done = threading.Event()
+
+    def submit():
+        while True:
+            job_number = next(job_numbers)
+            if job_number >= job_count:
+                return
+            job_name = job_name_prefix + str(job_number)
+            if recorder.call('submit', job_api.submit_job, pipeline_job, job_name) is not None:
+                with lock:
+                    submitted_job_names.append(job_name)
+                    active_job_names.add(job_name)
+
+    def update_job_state(job_json: dict) -> None:
+        if job_json and job_json.get('state') not in _pipeline_jobs_api._ACTIVE_JOB_STATES:
+            with lock:
+                active_job_names.discard(job_json.get('name', '').rsplit('/', 1)[-1])
+
+    def poll(poller_random: random.Random):
+        while True:
+            with lock:
+                if submission_done.is_set() and not active_job_names:
+                    return
+                job_names = list(active_job_names)
+            if not job_names:
+                time.sleep(0.01)
+                continue
+            if list_polling:
+                jobs_json = recorder.call(
+                    'list',
+                    lambda: list(job_api.list_jobs_json(filter=None, fields=_pipeline_jobs_api._JOB_STATE_FIELDS)),
+                )
+                for job_json in jobs_json or []:
+                    update_job_state(job_json)
+            else:
+                job_json = recorder.call('get', job_api.get_job_json, poller_random.choice(job_names), _pipeline_jobs_api._JOB_STATE_FIELDS)
+                update_job_state(job_json)
+            if poll_interval_seconds:
+                time.sleep(poll_interval_seconds)
+
+    start_time = time.perf_counter()
+    submitters = [threading.Thread(target=submit) for _ in range(submitter_count)]
+    pollers = [threading.Thread(target=poll, args=(random.Random(index),)) for index in range(poller_count)]
+    for thread in submitters + pollers:
+        thread.start()
+    for thread in submitters:
+        thread.join()
+    submission_time = time.perf_counter()
+    submission_done.set()
+    for thread in pollers:
+        thread.join()
+    end_time = time.perf_counter()
+
+    operations = recorder.get_report(end_time - start_time)
+    if 'submit' in operations:
+        # The submissions only happen in the first phase
+        operations['submit']['per_second'] = operations['submit']['count'] / (submission_time - start_time)
+    return collections.OrderedDict(
+        submitted_jobs=len(submitted_job_names),
+        duration_seconds=end_time - start_time,
+        submission_seconds=submission_time - start_time,
+        operations=operations,
+    )
+
+
+def _create_load_test_pipeline_job(step_count: int) -> dict:
+    '''Returns a chain of step_count minimal container steps.'''
+    steps = collections.OrderedDict()
+    for index in range(step_count):
+        steps['step-{}'.format(index)] = dict(task=dict(
+            container=dict(image='alpine', command=['sh', '-c', 'echo {}'.format(index)]),
+            inputs=dict(input=dict(step_output=dict(step='step-{}'.format(index - 1), output='output'))) if index else {},
+            outputs=dict(output=dict(artifact=dict(custom_properties={}))),
+        ))
+    return dict(spec=dict(steps=steps), outputPathConfig=dict(pipelineRoot='gs://load-test/root'))
+
+
+def main(argv: List[str] = None) -> None:
+    parser = argparse.ArgumentParser(description='Load-tests the job submission and monitoring against the pipelineJobs API emulator.')
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--steps', type=int, default=3, help='Number of steps in every job.')
+    parser.add_argument('--submitters', type=int, default=8)
+    parser.add_argument('--pollers', type=int, default=8)
+    parser.add_argument('--poll-interval', type=float, default=0)
+    parser.add_argument('--list-polling', action='store_true', help='Polls the job states using the list requests.')
+    parser.add_argument('--latency', type=float, default=0.01, help='Emulated request latency in seconds.')
+    parser.add_argument('--latency-jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of the requests that fail with 429 or 503.')
+    parser.add_argument('--retry-after', type=float, help='Retry-After header value of the injected errors.')
+    parser.add_argument('--pending', type=float, default=0.5, help='Emulated job pending time in seconds.')
+    parser.add_argument('--step-duration', type=float, default=0.5, help='Emulated step duration in seconds.')
+    parser.add_argument('--max-retries', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    emulator = _pipeline_jobs_emulator._PipelineJobsEmulator(
+        latency_seconds=args.latency,
+        latency_jitter_seconds=args.latency_jitter,
+        error_rate=args.error_rate,
+        retry_after_seconds=args.retry_after,
+        pending_seconds=args.pending,
+        step_seconds=args.step_duration,
+        random_seed=0,
+    )
+    with emulator:
+        job_api = _pipeline_jobs_api.PipelineJobApi(
+            project_id='load-test',
+            api_endpoint=emulator.endpoint,
+            access_token_provider=_pipeline_jobs_api._CachingAccessTokenProvider(get_token=lambda: 'emulator-token'),
+            max_retries=args.max_retries,
+        )
+        report = run_load_test(
+            job_api=job_api,
+            pipeline_job=_create_load_test_pipeline_job(args.steps),
+            job_count=args.jobs,
+            submitter_count=args.submitters,
+            poller_count=args.pollers,
+            poll_interval_seconds=args.poll_interval,
+            list_polling=args.list_polling,
+        )
+        report['server_requests'] = {
+            '{} {}'.format(method, status_code): count
+            for (method, status_code), count in sorted(emulator.request_counts.items())
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+import datetime
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent import futures
+from typing import List
+
+from . import _argument_spilling
+from . import _pipeline_jobs_api
+
+
+_PLACEHOLDER_PATTERN = r"\{\{\$\.(?P<kind>inputs|outputs)\['(?P<name>[^']*)'\]\.(?P<property>uri|value)\}\}"
+# The /tmp paths used by the compiled commands: the KFP input and output paths, the wrapper tools and the spilled arguments.
+# The other /tmp paths in the arguments are user data and are not changed.
+_WRAPPER_TMP_PATH_PATTERN = r'(?<![-\w.])/tmp/(?=(?:inputs|outputs|kfp_bin)/|kfp_spilled_arguments\b)'
+_SPILLED_ARGUMENT_PATTERN = re.compile('^' + re.escape(_argument_spilling._SPILLED_ARGUMENT_PLACEHOLDER).replace(r'\{\}', '(?P<hash>[0-9a-f]+)') + '$')
+
+# Local stand-in for gcs_copy. The artifact URIs are local paths in the local runs.
+# cat supports the named pipes used by the streaming artifacts.
+_local_gcs_copy_code = '''#!/bin/sh
+set -e
+mkdir -p "$(dirname "$2")"
+if [ -d "$1" ]; then
+  mkdir -p "$2"
+  cp -R "$1/." "$2"
+else
+  cat "$1" > "$2"
+fi
+'''
+
+
+def _format_timestamp(timestamp: float) -> str:
+    return datetime.datetime.utcfromtimestamp(timestamp).isoformat() + 'Z'
+
+
+class _LocalPipelineJob(_pipeline_jobs_api._PipelineJob):
+    '''Runs the steps of a compiled job as local subprocesses.
+
+    The job state has the same format as the state returned by the API, so the job can be watched and profiled like the remote jobs.
+    '''
+    def __init__(
+        self,
+        pipeline_job: dict,
+        job_name: str,
+        local_root: str,
+        max_parallelism: int = None,
+    ):
+        super().__init__(api=None, job_name=job_name)
+        self.pipeline_job = pipeline_job
+        self.local_root = local_root
+        self.run_dir = os.path.join(local_root, job_name)
+        self.max_parallelism = max_parallelism or os.cpu_count() or 1
+        self.pipeline_root = pipeline_job.get('outputPathConfig', {}).get('pipelineRoot', '').rstrip('/')
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._processes = {}
+        self._task_executions = {}
+        self._state = dict(
+            name='projects/local/pipelineJobs/' + job_name,
+            state='PENDING',
+            createTime=_format_timestamp(time.time()),
+            jobDetail=dict(taskExecutions=[]),
+        )
+        # A single pass, so that the substituted values are not substituted again
+        self._command_pattern = re.compile('{}|(?P<tmp>{})|{}'.format(
+            '(?P<root>{})'.format(re.escape(self.pipeline_root)) if self.pipeline_root else '(?P<root>(?!))',
+            _WRAPPER_TMP_PATH_PATTERN,
+            _PLACEHOLDER_PATTERN,
+        ))
+        # Argument hash -> argument
+        self._spilled_arguments = {
+            uri.rsplit('/', 1)[-1]: argument
+            for uri, argument in pipeline_job.get(_pipeline_jobs_api._CLIENT_METADATA_KEY, {}).get(_argument_spilling._SPILLED_ARGUMENTS_KEY, {}).items()
+        }
+        self._thread = threading.Thread(target=self._run, name='kfp-local-' + job_name, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._cancelled = True
+            if self._state['state'] in _pipeline_jobs_api._ACTIVE_JOB_STATES:
+                self._state['state'] = 'CANCELLING'
+            for process in self._processes.values():
+                process.terminate()
+
+    def refresh(self, fields: str = None) -> None:
+        # The local state is always complete, so the field mask is ignored
+        with self._lock:
+            self.current_state = dict(
+                self._state,
+                jobDetail=dict(taskExecutions=[dict(execution) for execution in self._task_executions.values()]),
+            )
+
+    def wait_for_completion(
+        self,
+        timeout: datetime.timedelta = datetime.timedelta.max,
+        interval_seconds: float = 0.5,
+    ) -> None:
+        super().wait_for_completion(timeout=timeout, interval_seconds=interval_seconds)
+
+    def get_output_uri(self, step_name: str, output_name: str) -> str:
+        return os.path.join(self.run_dir, step_name, output_name)
+
+    def _set_task_state(self, step_name: str, state: str, **times) -> None:
+        with self._lock:
+            execution = self._task_executions.setdefault(step_name, dict(step=step_name))
+            execution['state'] = state
+            execution.update(times)
+
+    def _resolve_command(self, step_name: str, task: dict, sandbox_dir: str) -> List[str]:
+        '''Substitutes the runtime placeholders and maps the pipeline root and the wrapper /tmp paths to the local directories.
+
+        The spilled arguments are inlined, so that the paths inside them are mapped too.
+        '''
+        input_references = task.get('inputs', {})
+
+        def get_uri(kind: str, name: str) -> str:
+            if kind == 'outputs':
+                return self.get_output_uri(step_name, name)
+            step_output = input_references[name]['step_output']
+            return self.get_output_uri(step_output['step'], step_output['output'])
+
+        def replace(match) -> str:
+            if match.group('root'):
+                return self.local_root
+            if match.group('tmp'):
+                # The steps share the host /tmp, so every step gets its own
+                return os.path.join(sandbox_dir, 'tmp') + '/'
+            uri = get_uri(match.group('kind'), match.group('name'))
+            if match.group('property') == 'uri':
+                return uri
+            with open(uri, 'r') as value_file:
+                return value_file.read()
+
+        def inline_spilled_argument(part: str) -> str:
+            match = _SPILLED_ARGUMENT_PATTERN.match(part)
+            if not match:
+                return part
+            if match.group('hash') not in self._spilled_arguments:
+                raise ValueError('The spilled argument {} is missing from the job client metadata.'.format(match.group('hash')))
+            return self._spilled_arguments[match.group('hash')]
+
+        return [self._command_pattern.sub(replace, inline_spilled_argument(part)) for part in task['container']['command']]
+
+    def _run_step(self, step_name: str) -> str:
+        task = self.pipeline_job['spec']['steps'][step_name]['task']
+        # The sandbox path is used in the unquoted shell code, so the step name is sanitized
+        step_index = list(self.pipeline_job['spec']['steps']).index(step_name)
+        sandbox_dir = os.path.join(self.run_dir, '.steps', '{}-{}'.format(step_index, re.sub('[^-_.a-zA-Z0-9]', '_', step_name)))
+        os.makedirs(os.path.join(sandbox_dir, 'tmp'), exist_ok=True)
+        log_path = os.path.join(sandbox_dir, 'log.txt')
+        self._set_task_state(step_name, 'RUNNING', startTime=_format_timestamp(time.time()))
+        try:
+            command = self._resolve_command(step_name, task, sandbox_dir)
+        except Exception as ex:
+            logging.error('Step "{}" failed to resolve its command line: {}'.format(step_name, ex))
+            self._set_task_state(step_name, 'FAILED', endTime=_format_timestamp(time.time()))
+            return 'FAILED'
+        env = dict(
+            os.environ,
+            PATH=os.path.join(self.run_dir, '.bin') + os.pathsep + os.environ.get('PATH', ''),
+            TMPDIR=os.path.join(sandbox_dir, 'tmp'),
+        )
+        with open(log_path, 'wb') as log_file:
+            with self._lock:
+                if self._cancelled:
+                    process = None
+                else:
+                    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, env=env, cwd=sandbox_dir)
+                    self._processes[step_name] = process
+            return_code = process.wait() if process else None
+        with self._lock:
+            self._processes.pop(step_name, None)
+        if return_code == 0:
+            state = 'SUCCEEDED'
+        elif self._cancelled:
+            state = 'CANCELLED'
+        else:
+            state = 'FAILED'
+            logging.error('Step "{}" failed with exit code {}. Log: {}'.format(step_name, return_code, log_path))
+        self._set_task_state(step_name, state, endTime=_format_timestamp(time.time()))
+        return state
+
+    def _prepare_run_dir(self) -> None:
+        bin_dir = os.path.join(self.run_dir, '.bin')
+        os.makedirs(bin_dir, exist_ok=True)
+        gcs_copy_path = os.path.join(bin_dir, 'gcs_copy')
+        with open(gcs_copy_path, 'w') as gcs_copy_file:
+            gcs_copy_file.write(_local_gcs_copy_code)
+        os.chmod(gcs_copy_path, 0o755)
+
+    def _run(self) -> None:
+        steps = self.pipeline_job['spec']['steps']
+        dependencies = {
+            step_name: {
+                input_reference['step_output']['step']
+                for input_reference in step['task'].get('inputs', {}).values()
+                if 'step_output' in input_reference
+            }
+            for step_name, step in steps.items()
+        }
+        downstream_steps = {step_name: [] for step_name in steps}
+        for step_name, upstream_steps in dependencies.items():
+            for upstream_step in upstream_steps:
+                downstream_steps[upstream_step].append(step_name)
+        remaining_dependency_counts = {step_name: len(upstream_steps) for step_name, upstream_steps in dependencies.items()}
+        for step_name in steps:
+            self._set_task_state(step_name, 'PENDING')
+
+        def skip_downstream_steps(step_name: str) -> None:
+            stack = list(downstream_steps[step_name])
+            while stack:
+                downstream_step = stack.pop()
+                if self._task_executions[downstream_step]['state'] == 'PENDING':
+                    self._set_task_state(downstream_step, 'CANCELLED')
+                    stack.extend(downstream_steps[downstream_step])
+
+        with self._lock:
+            self._state.update(state='RUNNING', startTime=_format_timestamp(time.time()))
+        failed = False
+        try:
+            self._prepare_run_dir()
+            ready_steps = [step_name for step_name, count in remaining_dependency_counts.items() if count == 0]
+            with futures.ThreadPoolExecutor(max_workers=self.max_parallelism) as executor:
+                running = {}
+                while ready_steps or running:
+                    while ready_steps and not self._cancelled:
+                        step_name = ready_steps.pop(0)
+                        running[executor.submit(self._run_step, step_name)] = step_name
+                    if not running:
+                        break
+                    done, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                    for future in done:
+                        step_name = running.pop(future)
+                        if future.result() != 'SUCCEEDED':
+                            failed = True
+                            skip_downstream_steps(step_name)
+                            continue
+                        for downstream_step in downstream_steps[step_name]:
+                            remaining_dependency_counts[downstream_step] -= 1
+                            if remaining_dependency_counts[downstream_step] == 0:
+                                ready_steps.append(downstream_step)
+        except Exception as ex:
+            logging.error('Local job {} failed: {}'.format(self.job_name, ex))
+            failed = True
+
+        with self._lock:
+            for execution in self._task_executions.values():
+                if execution['state'] == 'PENDING':
+                    execution['state'] = 'CANCELLED'
+            if self._cancelled:
+                job_state = 'CANCELLED'
+            elif failed:
+                job_state = 'FAILED'
+            else:
+                job_state = 'SUCCEEDED'
+            self._state.update(state=job_state, endTime=_format_timestamp(time.time()))
+
+    def __str__(self):
+        return '_LocalPipelineJob(job_name={}, run_dir={})'.format(self.job_name, self.run_dir)
+
+
+def run_pipeline_job_locally(
+    pipeline_job: dict,
+    local_root: str = None,
+    job_name: str = None,
+    max_parallelism: int = None,
+) -> _LocalPipelineJob:
+    '''Runs the job produced by compile_pipeline on the local machine. Returns the job handle immediately.
+
+    The steps run as subprocesses in the dependency order. The independent steps run in parallel up to max_parallelism.
+    The container images are ignored, so the programs used by the steps must be installed locally.
+    The pipeline root is mapped to local_root and the artifacts are stored in local_root/<job_name>/<step>/<output>.
+    Every step gets its own temporary directory. TMPDIR points to it and the /tmp paths of the artifacts, the wrapper tools
+    and the spilled arguments are mapped to it. The other /tmp paths in the arguments are passed unchanged. The step logs are in local_root/<job_name>/.steps/<index>-<step>/log.txt.
+    local_root must not contain whitespace since it replaces the paths in the step shell code.
+    '''
+    local_root = os.path.abspath(local_root or tempfile.mkdtemp(prefix='kfp_gcp_local_'))
+    job_name = job_name or 'local-' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    job = _LocalPipelineJob(
+        pipeline_job=pipeline_job,
+        job_name=job_name,
+        local_root=local_root,
+        max_parallelism=max_parallelism,
+    )
+    logging.info('Running the job {} locally in {}'.format(job_name, job.run_dir))
+    job.start()
+    return job
@@ -1,8 +1,23 @@
+import calendar
+import collections
 import datetime
+import logging
+import os
+import random
+import re
 import requests
 import subprocess
+import threading
 import time
 import urllib
+from concurrent import futures
+from typing import Callable, Iterator, List, Tuple, Union
+
+from . import _instrumentation
+
+
+# The compiler records the information about the job under this key. It's not sent to the API.
+_CLIENT_METADATA_KEY = 'clientMetadata'
 
 
 def _gcloud_get_access_token():
@@ -14,37 +29,331 @@ def _gcloud_get_access_token():
     return access_token
 
 
-def _gcloud_http_get_json(url: str) -> None:
-    access_token = _gcloud_get_access_token()
+def _get_access_token_from_environment(variable_name: str = 'GOOGLE_OAUTH_ACCESS_TOKEN') -> str:
+    access_token = os.environ.get(variable_name)
+    if not access_token:
+        raise RuntimeError('Environment variable {} is not set.'.format(variable_name))
+    return access_token
+
+
+def _get_access_token_from_metadata_server(
+    metadata_url: str = 'http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token',
+) -> Tuple[str, float]:
+    # The metadata server returns {"access_token": ..., "expires_in": ..., "token_type": "Bearer"}
     response = requests.get(
-        url=url,
-        headers={
-            'Authorization': 'Bearer ' + access_token,
-        },
+        url=metadata_url,
+        headers={'Metadata-Flavor': 'Google'},
+        timeout=10,
     )
+    response.raise_for_status()
+    token_json = response.json()
+    return token_json['access_token'], float(token_json['expires_in'])
+
+
+class _CachingAccessTokenProvider:
+    """Caches the access tokens returned by get_token and refreshes them before they expire.
+
+    get_token can return either the token or a (token, expires_in_seconds) tuple.
+    When the token source does not report the expiration time, default_lifetime_seconds is used.
+    """
+    def __init__(
+        self,
+        get_token: Callable[[], Union[str, Tuple[str, float]]] = _gcloud_get_access_token,
+        default_lifetime_seconds: float = 10 * 60,
+        refresh_margin_seconds: float = 60,
+    ):
+        self._get_token = get_token
+        self._default_lifetime_seconds = default_lifetime_seconds
+        self._refresh_margin_seconds = refresh_margin_seconds
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expiration_time = 0
+
+    def get_access_token(self) -> str:
+        with self._lock:
+            if self._access_token is None or time.monotonic() >= self._expiration_time - self._refresh_margin_seconds:
+                request_time = time.monotonic()
+                with _instrumentation.span('access_token_fetch'):
+                    token = self._get_token()
+                lifetime_seconds = self._default_lifetime_seconds
+                if isinstance(token, tuple):
+                    token, lifetime_seconds = token
+                self._access_token = token
+                self._expiration_time = request_time + lifetime_seconds
+            return self._access_token
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._access_token = None
+
+    def __call__(self) -> str:
+        return self.get_access_token()
+
+
+_default_access_token_provider = _CachingAccessTokenProvider()
+
+
+_RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+def _get_retry_delay_seconds(
+    retry_number: int,
+    retry_after: str = None,
+    initial_delay_seconds: float = 1,
+    max_delay_seconds: float = 60,
+) -> float:
+    # Exponential backoff with full jitter
+    delay_seconds = random.uniform(0, min(max_delay_seconds, initial_delay_seconds * 2 ** (retry_number - 1)))
+    if retry_after:
+        try:
+            delay_seconds = max(delay_seconds, float(retry_after))
+        except ValueError:
+            pass
+    return delay_seconds
+
+
+class _TokenBucketRateLimiter:
+    '''Limits the request rate to requests_per_second on average, allowing bursts of up to burst_size requests.'''
+    def __init__(
+        self,
+        requests_per_second: float,
+        burst_size: int = 1,
+    ):
+        self._requests_per_second = requests_per_second
+        self._burst_size = burst_size
+        self._tokens = burst_size
+        self._last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                current_time = time.monotonic()
+                self._tokens = min(self._burst_size, self._tokens + (current_time - self._last_time) * self._requests_per_second)
+                self._last_time = current_time
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self._requests_per_second
+            time.sleep(wait_seconds)
+
+
+def _send_instrumented_request(
+    session,
+    method: str,
+    url: str,
+    retry_number: int = 0,
+    **kwargs
+) -> requests.Response:
+    '''Sends the request in a http_request span and counts the requests and the transferred bytes.
+    The streamed bodies are counted using their Content-Length, so that they are not consumed.
+    '''
+    request_span = _instrumentation.span('http_request', method=method)
+    with request_span:
+        request_span.set_attribute('url', url)
+        request_span.set_attribute('retry_number', retry_number)
+        response = session.request(method=method, url=url, **kwargs)
+        request_span.set_attribute('status_code', response.status_code)
+    request_body = response.request.body
+    if isinstance(request_body, (bytes, str)):
+        request_size = len(request_body)
+    else:
+        request_size = int(response.request.headers.get('Content-Length') or 0)
+    if kwargs.get('stream'):
+        response_size = int(response.headers.get('Content-Length') or 0)
+    else:
+        response_size = len(response.content)
+    _instrumentation.increment('http_requests', method=method, status_code=response.status_code)
+    _instrumentation.increment('http_request_bytes', request_size, method=method)
+    _instrumentation.increment('http_response_bytes', response_size, method=method)
+    return response
+
+
+def _gcloud_http_request_json(
+    method: str,
+    url: str,
+    json=None,
+    session: requests.Session = None,
+    access_token_provider: _CachingAccessTokenProvider = None,
+    max_retries: int = 0,
+    rate_limiter: _TokenBucketRateLimiter = None,
+    conflict_after_retry_is_success: bool = False,
+):
+    '''Sends the request, retrying the transient errors up to max_retries times.
+
+    A retried create request gets a 409 when the previous attempt has created the resource on the server.
+    With conflict_after_retry_is_success, such a 409 returns None instead of raising.
+    '''
+    session = session or requests
+    access_token_provider = access_token_provider or _default_access_token_provider
+    token_was_refreshed = False
+    retry_number = 0
+    while True:
+        if rate_limiter:
+            rate_limiter.acquire()
+        access_token = access_token_provider.get_access_token()
+        try:
+            response = _send_instrumented_request(
+                session=session,
+                method=method,
+                url=url,
+                retry_number=retry_number,
+                headers={
+                    'Authorization': 'Bearer ' + access_token,
+                },
+                json=json,
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            _instrumentation.increment('http_retries', method=method, reason='connection_error')
+            if retry_number >= max_retries:
+                raise
+            retry_number += 1
+            time.sleep(_get_retry_delay_seconds(retry_number))
+            continue
+        # The cached token might have been revoked. Getting a new one and trying again.
+        if response.status_code == 401 and not token_was_refreshed and hasattr(access_token_provider, 'invalidate'):
+            _instrumentation.increment('http_retries', method=method, reason='unauthorized')
+            token_was_refreshed = True
+            access_token_provider.invalidate()
+            continue
+        if response.status_code in _RETRYABLE_STATUS_CODES and retry_number < max_retries:
+            _instrumentation.increment('http_retries', method=method, reason=str(response.status_code))
+            retry_number += 1
+            time.sleep(_get_retry_delay_seconds(retry_number, response.headers.get('Retry-After')))
+            continue
+        break
+    if response.status_code == 409 and retry_number > 0 and conflict_after_retry_is_success:
+        logging.info('{} {} returned 409 after {} retries. The previous attempt has succeeded.'.format(method, url, retry_number))
+        return None
     if response.status_code >= 400:
-        print('response.status_code=' + str(response.status_code))
-        print('response.content=' + response.content.decode(response.encoding))
-        print('response.json=' + str(response.json()))
+        # The callers handle the missing and the existing resources, so these are not worth a warning
+        logging.log(
+            logging.DEBUG if response.status_code in (404, 409) else logging.WARNING,
+            '{} {} returned {}: {}'.format(method, url, response.status_code, response.content.decode(response.encoding or 'utf-8')),
+        )
     response.raise_for_status()
     return response.json()
 
 
-def _gcloud_http_post_json(url: str, json) -> None:
-    access_token = _gcloud_get_access_token()
-    response = requests.post(
+def _gcloud_http_get_json(
+    url: str,
+    session: requests.Session = None,
+    access_token_provider: _CachingAccessTokenProvider = None,
+    max_retries: int = 0,
+) -> dict:
+    return _gcloud_http_request_json(
+        method='GET',
+        url=url,
+        session=session,
+        access_token_provider=access_token_provider,
+        max_retries=max_retries,
+    )
+
+
+def _gcloud_http_post_json(
+    url: str,
+    json,
+    session: requests.Session = None,
+    access_token_provider: _CachingAccessTokenProvider = None,
+    max_retries: int = 0,
+    rate_limiter: _TokenBucketRateLimiter = None,
+    conflict_after_retry_is_success: bool = False,
+) -> dict:
+    return _gcloud_http_request_json(
+        method='POST',
         url=url,
-        headers={
-            'Authorization': 'Bearer ' + access_token,
-        },
         json=json,
+        session=session,
+        access_token_provider=access_token_provider,
+        max_retries=max_retries,
+        rate_limiter=rate_limiter,
+        conflict_after_retry_is_success=conflict_after_retry_is_success,
     )
-    if response.status_code >= 400:
-        print('response.status_code=' + str(response.status_code))
-        print('response.content=' + response.content.decode(response.encoding))
-        print('response.json=' + str(response.json()))
-    response.raise_for_status()
-    return response.json()
+
+
+#states = ['PENDING', 'RUNNING', 'SUCCEEDED', 'FAILED', 'TIMEOUT', 'CANCELLING', 'CANCELLED']
+_ACTIVE_JOB_STATES = ['PENDING', 'RUNNING', 'CANCELLING']
+
+# Partial response field mask that only requests the job and task states
+_JOB_STATE_FIELDS = 'name,state,createTime,startTime,endTime,updateTime,jobDetail/taskExecutions(step,state,startTime,endTime)'
+
+
+_TIMESTAMP_PATTERN = re.compile(r'^(\d{4})-(\d{2})-(\d{2})[Tt ](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?([Zz]|[+-]\d{2}:\d{2})?$')
+
+
+def _parse_timestamp(timestamp: str) -> float:
+    '''Parses the RFC 3339 timestamp returned by the API. Returns the POSIX time in seconds.
+
+    datetime.fromisoformat does not support the "Z" suffix and the nanosecond precision before Python 3.11.
+    '''
+    if not timestamp:
+        return None
+    match = _TIMESTAMP_PATTERN.match(timestamp)
+    if not match:
+        raise ValueError('Invalid timestamp: "{}"'.format(timestamp))
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    seconds = calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second)))
+    if fraction:
+        seconds += int(fraction[:6].ljust(6, '0')) / 1e6
+    if offset and offset not in ('Z', 'z'):
+        offset_seconds = int(offset[1:3]) * 3600 + int(offset[4:6]) * 60
+        seconds -= offset_seconds if offset[0] == '+' else -offset_seconds
+    return seconds
+
+
+# The server timestamps of the states. The other states use the polling time.
+_JOB_STATE_TIME_FIELDS = {'PENDING': 'createTime', 'RUNNING': 'startTime', 'CANCELLING': 'updateTime'}
+_TASK_STATE_TIME_FIELDS = {'RUNNING': 'startTime'}
+_FINAL_STATE_TIME_FIELD = 'endTime'
+
+
+def _get_state_time(state_json: dict, state: str, state_time_fields: dict, default_time: datetime.datetime) -> datetime.datetime:
+    '''Returns the server time of the state from the job or task JSON or default_time when the timestamp is missing.'''
+    time_field = state_time_fields.get(state) or (_FINAL_STATE_TIME_FIELD if state not in _ACTIVE_JOB_STATES else None)
+    timestamp = _parse_timestamp(state_json.get(time_field)) if time_field else None
+    if timestamp is None:
+        return default_time
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+
+class _JobStateChangeEvent(collections.namedtuple('_JobStateChangeEvent', ['job_name', 'time', 'old_state', 'new_state'])):
+    def __str__(self):
+        return '{} {}: {} -> {}'.format(self.time.isoformat(), self.job_name, self.old_state, self.new_state)
+
+
+class _TaskStateChangeEvent(collections.namedtuple('_TaskStateChangeEvent', ['job_name', 'step', 'time', 'old_state', 'new_state'])):
+    def __str__(self):
+        return '{} {}/{}: {} -> {}'.format(self.time.isoformat(), self.job_name, self.step, self.old_state, self.new_state)
+
+
+def _get_state_change_events(job_name: str, old_job_json: dict, new_job_json: dict, time: datetime.datetime) -> list:
+    '''Compares two job states and returns the job and task state change events.
+
+    The event times come from the job and task timestamps. time (usually the polling time) is used when they are missing.
+    '''
+    def get_task_executions(job_json: dict) -> dict:
+        task_executions = job_json.get('jobDetail', {}).get('taskExecutions', [])
+        return {execution['step']: execution for execution in task_executions}
+
+    events = []
+    old_job_state = old_job_json.get('state')
+    new_job_state = new_job_json.get('state')
+    old_task_executions = get_task_executions(old_job_json)
+    for step, new_task_execution in get_task_executions(new_job_json).items():
+        old_task_state = old_task_executions.get(step, {}).get('state')
+        new_task_state = new_task_execution.get('state')
+        if new_task_state != old_task_state:
+            task_time = _get_state_time(new_task_execution, new_task_state, _TASK_STATE_TIME_FIELDS, time)
+            events.append(_TaskStateChangeEvent(job_name, step, task_time, old_task_state, new_task_state))
+    # The job is finished after all of its tasks
+    if new_job_state != old_job_state:
+        job_time = _get_state_time(new_job_json, new_job_state, _JOB_STATE_TIME_FIELDS, time)
+        job_event = _JobStateChangeEvent(job_name, job_time, old_job_state, new_job_state)
+        if new_job_state in _ACTIVE_JOB_STATES:
+            events.insert(0, job_event)
+        else:
+            events.append(job_event)
+    return events
 
 
 class _PipelineJob:
@@ -60,43 +369,51 @@ class _PipelineJob:
     def cancel(self) -> None:
         self.api.cancel(self.job_name)
     
-    def refresh(self) -> None:
-        self.current_state = self.api.get_job_json(self.job_name)
+    @_instrumentation.traced('refresh_job')
+    def refresh(self, fields: str = None) -> None:
+        self.current_state = self.api.get_job_json(self.job_name, fields=fields)
 
-    def wait_for_completion(
+    def watch(
         self,
         timeout: datetime.timedelta = datetime.timedelta.max,
         interval_seconds: float = 20,
-    ) -> None:
-        #states = ['PENDING', 'RUNNING', 'SUCCEEDED', 'FAILED', 'TIMEOUT', 'CANCELLING', 'CANCELLED']
-        active_states = ['PENDING', 'RUNNING', 'CANCELLING']
-        #stopped_states = ['SUCCEEDED', 'FAILED', 'CANCELLED']
+        fields: str = _JOB_STATE_FIELDS,
+    ) -> Iterator[Union[_JobStateChangeEvent, _TaskStateChangeEvent]]:
+        '''Polls the job and yields the job and task state change events until the job stops.
 
+        Only the state fields are requested, so current_state only has the fields specified in the field mask.
+        '''
         start_time = datetime.datetime.utcnow()
         while True:
             current_time = datetime.datetime.utcnow()
             if current_time - start_time > timeout:
                 raise TimeoutError()
-            
+
+            previous_state = self.current_state
             try:
-                self.refresh()
+                self.refresh(fields=fields)
             except Exception as ex:
-                #print(ex)
+                logging.debug('Failed to refresh the job {}: {}'.format(self.job_name, ex))
                 time.sleep(interval_seconds)
                 continue
 
-            job_state = self.current_state.get('state')
-            if not job_state:
-                print(self.current_state)
-                return
+            for event in _get_state_change_events(self.job_name, previous_state, self.current_state, datetime.datetime.utcnow()):
+                yield event
 
-            task_executions = self.current_state.get('jobDetail', {}).get('taskExecutions', [])
-            execution_states = {execution['step']: execution['state'] for execution in task_executions}
-            print(job_state + ': ' + str(execution_states))
-
-            if job_state not in active_states:
+            job_state = self.current_state.get('state')
+            if not job_state or job_state not in _ACTIVE_JOB_STATES:
                 return
             time.sleep(interval_seconds)
+
+    def wait_for_completion(
+        self,
+        timeout: datetime.timedelta = datetime.timedelta.max,
+        interval_seconds: float = 20,
+    ) -> None:
+        for event in self.watch(timeout=timeout, interval_seconds=interval_seconds):
+            print(event)
+        if not self.current_state.get('state'):
+            print(self.current_state)
     
     def __str__(self):
         return '_PipelineJob(job_name={})'.format(self.job_name)
@@ -107,19 +424,73 @@ class PipelineJobApi:
         self,
         project_id: str = 'managed-pipeline-test',
         api_host: str = 'test-ml.sandbox.googleapis.com',
+        access_token_provider: _CachingAccessTokenProvider = None,
+        max_retries: int = 3,
+        api_endpoint: str = None,
     ):
-        url_prefix = 'https://{api_host}/v1/projects/{project_id}/pipelineJobs'.format(
-            api_host=api_host,
+        # api_endpoint overrides the https://<api_host> endpoint. For example, to use the local emulator.
+        url_prefix = '{api_endpoint}/v1/projects/{project_id}/pipelineJobs'.format(
+            api_endpoint=(api_endpoint or 'https://' + api_host).rstrip('/'),
             project_id=project_id,
         )
         self.api_host = api_host
         self.project_id = project_id
         self.url_prefix = url_prefix
+        self.access_token_provider = access_token_provider or _default_access_token_provider
+        self.max_retries = max_retries
+        # A keep-alive session reuses the connections between the requests
+        self._session = requests.Session()
+
+    def _get_json(self, url: str) -> dict:
+        return _gcloud_http_get_json(
+            url=url,
+            session=self._session,
+            access_token_provider=self.access_token_provider,
+            max_retries=self.max_retries,
+        )
+
+    def _post_json(
+        self,
+        url: str,
+        json,
+        rate_limiter: _TokenBucketRateLimiter = None,
+        conflict_after_retry_is_success: bool = False,
+    ) -> dict:
+        return _gcloud_http_post_json(
+            url=url,
+            json=json,
+            session=self._session,
+            access_token_provider=self.access_token_provider,
+            max_retries=self.max_retries,
+            rate_limiter=rate_limiter,
+            conflict_after_retry_is_success=conflict_after_retry_is_success,
+        )
     
-    def get_all_jobs_json(self) -> dict:
+    def list_jobs_json(self, filter: str = None, page_size: int = 100, fields: str = None, max_pages: int = None) -> Iterator[dict]:
+        '''Lists the jobs, fetching the pages lazily. Stops after max_pages pages when it is set.
+        The fields partial response mask applies to each job.
+        '''
+        page_token = None
+        page_count = 0
+        while True:
+            query = {'pageSize': page_size}
+            if filter:
+                query['filter'] = filter
+            if fields:
+                query['fields'] = 'nextPageToken,pipelineJobs({})'.format(fields)
+            if page_token:
+                query['pageToken'] = page_token
+            response_json = self._get_json(self.url_prefix + '?' + urllib.parse.urlencode(query))
+            page_count += 1
+            for job_json in response_json.get('pipelineJobs', []):
+                yield job_json
+            page_token = response_json.get('nextPageToken')
+            if not page_token or (max_pages and page_count >= max_pages):
+                return
+
+    def get_all_jobs_json(self, filter: str = None) -> dict:
         # returns {"pipelineJobs": [...]}
-        response_json = _gcloud_http_get_json(self.job_url)
-        self.current_state = response_json
+        return {'pipelineJobs': list(self.list_jobs_json(filter=filter))}
     
     def get_job_url(self, job_name: str) -> str:
         return self.url_prefix + '/' + urllib.parse.quote(job_name)
@@ -127,23 +498,226 @@ class PipelineJobApi:
     def get_job_object(self, job_name: str) -> _PipelineJob:
         return _PipelineJob(api=self, job_name=job_name)
     
-    def get_job_json(self, job_name: str) -> dict:
-        return _gcloud_http_get_json(self.get_job_url(job_name))
+    def get_job_json(self, job_name: str, fields: str = None) -> dict:
+        url = self.get_job_url(job_name)
+        if fields:
+            url += '?' + urllib.parse.urlencode({'fields': fields})
+        return self._get_json(url)
 
     def cancel(self, job_name: str) -> None:
         url = self.get_job_url(job_name) + ':cancel'
-        response_json = _gcloud_http_get_json(url)
+        response_json = self._post_json(url, json={})
         return response_json
     
-    def submit_job(self, pipeline_job_dict: dict, job_name: str) -> _PipelineJob:
+    def _create_job(
+        self,
+        pipeline_job_dict: dict,
+        job_name: str,
+        rate_limiter: _TokenBucketRateLimiter = None,
+        allow_existing: bool = False,
+    ) -> bool:
+        '''Creates the job. Returns whether the job already existed.
+
+        The create request is not idempotent. A retry gets a 409 when the timed out or failed attempt has created the job.
+        A 409 on the first attempt means that the job name is taken, which is an error unless allow_existing is True.
+        In both cases, the existing job is only accepted when it has the submitted spec.
+        '''
         full_job_name = 'projects/{project_id}/pipelineJobs/{job_name}'.format(
             project_id=self.project_id,
             job_name=job_name,
         )
+        # Not modifying the caller's dict since the same job dict can be submitted many times concurrently
+        pipeline_job_dict = {
+            key: value
+            for key, value in pipeline_job_dict.items()
+            if key != _CLIENT_METADATA_KEY
+        }
         pipeline_job_dict['name'] = full_job_name
 
-        _gcloud_http_post_json(
-            url=self.url_prefix,
-            json=pipeline_job_dict,
+        try:
+            response_json = self._post_json(
+                url=self.url_prefix,
+                json=pipeline_job_dict,
+                rate_limiter=rate_limiter,
+                conflict_after_retry_is_success=True,
+            )
+        except requests.HTTPError as ex:
+            if not (allow_existing and ex.response is not None and ex.response.status_code == 409):
+                raise
+            response_json = None
+        if response_json is not None:
+            return False
+
+        submitted_fields = {key: value for key, value in pipeline_job_dict.items() if key != 'name'}
+        existing_job_json = self.get_job_json(job_name, fields=','.join(submitted_fields))
+        if any(existing_job_json.get(key) != value for key, value in submitted_fields.items()):
+            raise RuntimeError('The job {} already exists and has a different spec.'.format(job_name))
+        return True
+
+    @_instrumentation.traced('submit_job')
+    def submit_job(
+        self,
+        pipeline_job_dict: dict,
+        job_name: str,
+        rate_limiter: _TokenBucketRateLimiter = None,
+    ) -> _PipelineJob:
+        self._create_job(
+            pipeline_job_dict=pipeline_job_dict,
+            job_name=job_name,
+            rate_limiter=rate_limiter,
         )
-        return _PipelineJob(api=self, job_name=job_name)   
+        return _PipelineJob(api=self, job_name=job_name)
+
+    def submit_jobs(
+        self,
+        jobs: List[Tuple[dict, str]],
+        max_parallelism: int = 8,
+        requests_per_second: float = 5,
+        burst_size: int = 5,
+    ) -> List['_JobSubmissionResult']:
+        '''Submits many (pipeline_job_dict, job_name) pairs concurrently.
+
+        The submission rate is limited client-side to match the API quota.
+        The transient errors are retried with exponential backoff.
+        Jobs that already exist with the same spec are considered successfully submitted, so a failed batch can be safely re-submitted.
+        Their results have already_existed set. An existing job with a different spec is an error.
+        Returns the per-job results in the same order. The failed results have the error set.
+        '''
+        rate_limiter = _TokenBucketRateLimiter(
+            requests_per_second=requests_per_second,
+            burst_size=burst_size,
+        )
+
+        def submit(pipeline_job_dict: dict, job_name: str) -> _JobSubmissionResult:
+            try:
+                already_existed = self._create_job(
+                    pipeline_job_dict=pipeline_job_dict,
+                    job_name=job_name,
+                    rate_limiter=rate_limiter,
+                    allow_existing=True,
+                )
+                return _JobSubmissionResult(job_name=job_name, job=self.get_job_object(job_name), already_existed=already_existed, error=None)
+            except Exception as ex:
+                return _JobSubmissionResult(job_name=job_name, job=None, already_existed=False, error=ex)
+
+        if not jobs:
+            return []
+        with futures.ThreadPoolExecutor(max_workers=max(1, min(max_parallelism, len(jobs)))) as executor:
+            result_futures = [
+                executor.submit(submit, pipeline_job_dict, job_name)
+                for pipeline_job_dict, job_name in jobs
+            ]
+            return [future.result() for future in result_futures]
+
+
+FIRST_COMPLETED = futures.FIRST_COMPLETED
+ALL_COMPLETED = futures.ALL_COMPLETED
+
+
+_LIST_PAGE_SIZE = 100
+# The listing is paused after this many consecutive ticks that found none of the jobs
+_MAX_CONSECUTIVE_LIST_MISSES = 3
+_MAX_LIST_PAUSE_TICKS = 32
+
+
+@_instrumentation.traced('refresh_jobs')
+def _refresh_jobs(jobs: List[_PipelineJob], filter: str = None, fields: str = None, use_list: bool = True) -> int:
+    '''Refreshes the states of many jobs using the job list API instead of getting each job.
+
+    The project can have many other jobs, so the listing is limited to the pages that could hold the jobs plus one.
+    The jobs that were not listed are fetched one by one. Returns the number of jobs that were found by the listing.
+    '''
+    api = jobs[0].api
+    jobs_to_refresh = {job.job_name: job for job in jobs}
+    listed_job_count = 0
+    if use_list:
+        max_pages = (len(jobs) + _LIST_PAGE_SIZE - 1) // _LIST_PAGE_SIZE + 1
+        for job_json in api.list_jobs_json(filter=filter, page_size=_LIST_PAGE_SIZE, fields=fields, max_pages=max_pages):
+            job_name = job_json.get('name', '').rsplit('/', 1)[-1]
+            job = jobs_to_refresh.pop(job_name, None)
+            if job:
+                job.current_state = job_json
+                listed_job_count += 1
+            if not jobs_to_refresh:
+                break
+    # Getting the jobs that were not listed
+    for job in jobs_to_refresh.values():
+        job.refresh(fields=fields)
+    return listed_job_count
+
+
+def wait_for_all(
+    jobs: List[_PipelineJob],
+    return_when: str = ALL_COMPLETED,
+    timeout: datetime.timedelta = datetime.timedelta.max,
+    min_interval_seconds: float = 5,
+    max_interval_seconds: float = 120,
+    expected_duration: datetime.timedelta = None,
+    filter: str = None,
+    fields: str = _JOB_STATE_FIELDS,
+) -> Tuple[List[_PipelineJob], List[_PipelineJob]]:
+    '''Waits for the jobs to stop. Returns the (done, not_done) lists of jobs like concurrent.futures.wait.
+    On timeout, returns the jobs that are not done yet in not_done.
+
+    The jobs are refreshed with a few list requests per polling tick. The jobs that are not on the first list pages are fetched one by one.
+    The new jobs can take a while to appear in the list. When several consecutive listings do not find any of the jobs,
+    the listing is paused for a growing number of ticks and only the individual requests are used meanwhile.
+    Pass a filter that selects the jobs to make the listing find all of them.
+    The polling interval grows while the jobs are pending or nothing changes,
+    resets when some job changes its state and shrinks near the expected completion time.
+    The intervals are jittered so that many waiters do not poll in sync.
+    '''
+    if not jobs:
+        return [], []
+    if len({id(job.api) for job in jobs}) > 1:
+        raise ValueError('All jobs must belong to the same PipelineJobApi.')
+
+    start_time = datetime.datetime.utcnow()
+    interval_seconds = min_interval_seconds
+    previous_states = {}
+    not_done = jobs
+    tick_number = 0
+    next_list_tick_number = 0
+    consecutive_list_misses = 0
+    while True:
+        use_list = tick_number >= next_list_tick_number
+        try:
+            listed_job_count = _refresh_jobs(not_done, filter=filter, fields=fields, use_list=use_list)
+            if use_list:
+                consecutive_list_misses = consecutive_list_misses + 1 if listed_job_count == 0 else 0
+                pause_ticks = 0
+                if consecutive_list_misses >= _MAX_CONSECUTIVE_LIST_MISSES:
+                    pause_ticks = min(_MAX_LIST_PAUSE_TICKS, 2 ** (consecutive_list_misses - _MAX_CONSECUTIVE_LIST_MISSES + 1))
+                next_list_tick_number = tick_number + 1 + pause_ticks
+        except Exception as ex:
+            logging.warning('Failed to refresh the jobs: {}'.format(ex))
+        tick_number += 1
+
+        job_states = {job.job_name: job.current_state.get('state') for job in jobs}
+        done_job_names = {job_name for job_name, job_state in job_states.items() if job_state and job_state not in _ACTIVE_JOB_STATES}
+        done = [job for job in jobs if job.job_name in done_job_names]
+        not_done = [job for job in jobs if job.job_name not in done_job_names]
+        if not not_done or (done and return_when == FIRST_COMPLETED):
+            return done, not_done
+
+        elapsed_time = datetime.datetime.utcnow() - start_time
+        if elapsed_time > timeout:
+            return done, not_done
+
+        if job_states != previous_states:
+            logging.info('Job states: ' + str(job_states))
+            interval_seconds = min_interval_seconds
+        elif all(job_states[job.job_name] == 'PENDING' for job in not_done):
+            interval_seconds = min(max_interval_seconds, interval_seconds * 2)
+        else:
+            interval_seconds = min(max_interval_seconds, interval_seconds * 1.5)
+        if expected_duration:
+            remaining_seconds = (expected_duration - elapsed_time).total_seconds()
+            if 0 < remaining_seconds < interval_seconds:
+                interval_seconds = max(min_interval_seconds, remaining_seconds)
+        previous_states = job_states
+
+        time.sleep(interval_seconds * random.uniform(0.8, 1.2))
+
+
+_JobSubmissionResult = collections.namedtuple('_JobSubmissionResult', ['job_name', 'job', 'already_existed', 'error'])
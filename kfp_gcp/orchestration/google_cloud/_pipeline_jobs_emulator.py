@@ -0,0 +1,243 @@
+import collections
+import http.server
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+from typing import Iterable
+
+from . import _local_runner
+from . import _run_profiler
+
+
+_JOBS_PATH_PATTERN = re.compile(r'^/v1/projects/(?P<project_id>[^/]+)/pipelineJobs(?:/(?P<job_name>[^/:]+)(?P<cancel>:cancel)?)?$')
+
+
+class _EmulatedJob:
+    '''A submitted job. The job and task states are derived from the elapsed time, so the emulator does not need a background thread.'''
+    def __init__(
+        self,
+        job_json: dict,
+        create_time: float,
+        pending_seconds: float,
+        step_seconds: float,
+        final_state: str,
+    ):
+        self.job_json = job_json
+        self.create_time = create_time
+        self.start_time = create_time + pending_seconds
+        self.final_state = final_state
+        self.cancel_time = None
+        # The steps run as soon as their upstream steps finish
+        self.step_times = collections.OrderedDict()
+        if job_json.get('spec', {}).get('steps'):
+            dependencies = _run_profiler._get_step_dependencies(job_json)
+            for step_name in _run_profiler._get_topological_order(dependencies):
+                step_start_time = max(
+                    (self.step_times[upstream_step][1] for upstream_step in dependencies[step_name] if upstream_step in self.step_times),
+                    default=self.start_time,
+                )
+                self.step_times[step_name] = (step_start_time, step_start_time + step_seconds)
+        self.end_time = max((end_time for _, end_time in self.step_times.values()), default=self.start_time)
+
+    def get_json(self, current_time: float) -> dict:
+        stop_time = min(current_time, self.cancel_time) if self.cancel_time is not None else current_time
+        if stop_time < self.start_time:
+            state = 'PENDING'
+        elif stop_time < self.end_time:
+            state = 'RUNNING'
+        else:
+            state = self.final_state
+        if self.cancel_time is not None and current_time >= self.cancel_time and state in ('PENDING', 'RUNNING'):
+            state = 'CANCELLED'
+
+        task_executions = []
+        for step_name, (step_start_time, step_end_time) in self.step_times.items():
+            if stop_time < step_start_time:
+                if state == 'CANCELLED':
+                    task_executions.append(dict(step=step_name, state='CANCELLED'))
+                continue
+            execution = dict(step=step_name, state='RUNNING', startTime=_local_runner._format_timestamp(step_start_time))
+            if stop_time >= step_end_time:
+                execution.update(state='SUCCEEDED', endTime=_local_runner._format_timestamp(step_end_time))
+            elif state == 'CANCELLED':
+                execution.update(state='CANCELLED', endTime=_local_runner._format_timestamp(self.cancel_time))
+            task_executions.append(execution)
+
+        job_json = dict(
+            self.job_json,
+            state=state,
+            createTime=_local_runner._format_timestamp(self.create_time),
+            updateTime=_local_runner._format_timestamp(current_time),
+            jobDetail=dict(taskExecutions=task_executions),
+        )
+        if state != 'PENDING':
+            job_json['startTime'] = _local_runner._format_timestamp(self.start_time)
+        if state not in ('PENDING', 'RUNNING'):
+            job_json['endTime'] = _local_runner._format_timestamp(min(self.end_time, stop_time))
+        return job_json
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _PipelineJobsEmulator:
+    '''In-process emulator of the v1/projects/*/pipelineJobs API (create, get, list and cancel).
+
+    Every request is delayed by latency_seconds plus a random jitter.
+    A error_rate fraction of the requests fail with one of error_status_codes.
+    The jobs stay PENDING for pending_seconds, then every step runs for step_seconds after its upstream steps.
+    The field masks are ignored and the full jobs are returned.
+    Use endpoint as the PipelineJobApi api_endpoint.
+    '''
+    def __init__(
+        self,
+        latency_seconds: float = 0,
+        latency_jitter_seconds: float = 0,
+        error_rate: float = 0,
+        error_status_codes: Iterable[int] = (429, 503),
+        retry_after_seconds: float = None,
+        pending_seconds: float = 1,
+        step_seconds: float = 1,
+        final_state: str = 'SUCCEEDED',
+        host: str = '127.0.0.1',
+        port: int = 0,
+        random_seed: int = None,
+    ):
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.error_rate = error_rate
+        self.error_status_codes = list(error_status_codes)
+        self.retry_after_seconds = retry_after_seconds
+        self.pending_seconds = pending_seconds
+        self.step_seconds = step_seconds
+        self.final_state = final_state
+        self._random = random.Random(random_seed)
+        self._lock = threading.Lock()
+        # Full job name -> _EmulatedJob. The list API returns the jobs in the creation order.
+        self._jobs = collections.OrderedDict()
+        # (method, status code) -> request count
+        self.request_counts = collections.Counter()
+        self._server = _ThreadingHTTPServer((host, port), self._create_request_handler_class())
+        self._thread = None
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self) -> '_PipelineJobsEmulator':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='pipeline-jobs-emulator', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _handle_request(self, method: str, path: str, body: bytes) -> tuple:
+        '''Returns the (status code, response JSON) pair.'''
+        with self._lock:
+            delay_seconds = self.latency_seconds + self._random.uniform(0, self.latency_jitter_seconds)
+            inject_error = self.error_rate and self._random.random() < self.error_rate
+            error_status_code = self._random.choice(self.error_status_codes) if inject_error else None
+        if delay_seconds:
+            time.sleep(delay_seconds)
+        if error_status_code:
+            return error_status_code, dict(error=dict(code=error_status_code, message='Injected error.'))
+
+        url = urllib.parse.urlsplit(path)
+        query = urllib.parse.parse_qs(url.query)
+        match = _JOBS_PATH_PATTERN.match(url.path)
+        if not match:
+            return 404, dict(error=dict(code=404, message='Not found: ' + url.path))
+        project_id = match.group('project_id')
+        job_name = match.group('job_name') and urllib.parse.unquote(match.group('job_name'))
+        full_job_name = 'projects/{}/pipelineJobs/{}'.format(project_id, job_name)
+        current_time = time.time()
+
+        if method == 'POST' and not job_name:
+            job_json = json.loads(body.decode('utf-8'))
+            full_job_name = job_json.get('name', '')
+            if not full_job_name.startswith('projects/{}/pipelineJobs/'.format(project_id)):
+                return 400, dict(error=dict(code=400, message='Invalid job name: "{}"'.format(full_job_name)))
+            try:
+                job = _EmulatedJob(job_json, current_time, self.pending_seconds, self.step_seconds, self.final_state)
+            except (AttributeError, KeyError, TypeError) as ex:
+                return 400, dict(error=dict(code=400, message='Invalid job: {}'.format(ex)))
+            with self._lock:
+                if full_job_name in self._jobs:
+                    return 409, dict(error=dict(code=409, message='Job already exists: ' + full_job_name))
+                self._jobs[full_job_name] = job
+            return 200, job.get_json(current_time)
+
+        if method == 'GET' and not job_name:
+            page_size = int(query.get('pageSize', ['100'])[0])
+            offset = int(query.get('pageToken', ['0'])[0])
+            prefix = 'projects/{}/pipelineJobs/'.format(project_id)
+            with self._lock:
+                jobs = [job for name, job in self._jobs.items() if name.startswith(prefix)]
+            response_json = dict(pipelineJobs=[job.get_json(current_time) for job in jobs[offset:offset + page_size]])
+            if offset + page_size < len(jobs):
+                response_json['nextPageToken'] = str(offset + page_size)
+            return 200, response_json
+
+        with self._lock:
+            job = self._jobs.get(full_job_name)
+        if job is None:
+            return 404, dict(error=dict(code=404, message='Job not found: ' + full_job_name))
+        if method == 'GET' and not match.group('cancel'):
+            return 200, job.get_json(current_time)
+        if method == 'POST' and match.group('cancel'):
+            with self._lock:
+                if job.cancel_time is None and job.get_json(current_time)['state'] in ('PENDING', 'RUNNING'):
+                    job.cancel_time = current_time
+            return 200, {}
+        return 405, dict(error=dict(code=405, message='Method not allowed.'))
+
+    def _create_request_handler_class(self):
+        emulator = self
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            # Keep-alive connections like the real API
+            protocol_version = 'HTTP/1.1'
+            # The headers and the body are sent separately, so Nagle's algorithm would delay the body until the delayed ACK
+            disable_nagle_algorithm = True
+
+            def _handle(self, method: str):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if not (self.headers.get('Authorization') or '').startswith('Bearer '):
+                    status_code, response_json = 401, dict(error=dict(code=401, message='Missing the access token.'))
+                else:
+                    status_code, response_json = emulator._handle_request(method, self.path, body)
+                with emulator._lock:
+                    emulator.request_counts[(method, status_code)] += 1
+                response_body = json.dumps(response_json).encode('utf-8')
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response_body)))
+                if status_code in (429, 503) and emulator.retry_after_seconds is not None:
+                    self.send_header('Retry-After', str(emulator.retry_after_seconds))
+                self.end_headers()
+                self.wfile.write(response_body)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
@@ -1,28 +1,32 @@
+import copy
 import datetime
+import functools
+import hashlib
 import json
 import logging
 import pathlib
 import re
 import time
-from typing import Callable, Dict, List
+import uuid
+from typing import Callable, Dict, List, Set, Tuple
 
+import kfp
 from kfp import components
 from kfp.components import structures
 from kfp.components import _components
 
+from . import _argument_spilling
+from . import _compilation_cache
+from . import _execution_cache
+from . import _graph_flattening
 from . import _pipeline_jobs_api
 from . import _image_mirroring
+from . import _image_mirror_index
+from . import _instrumentation
+from . import _tool_staging
 
 
-def _generate_command_line(
-    user_command_line: List[str],
-    input_path_uris: Dict[str, str],
-    output_path_uris: Dict[str, str],
-) -> List[str]:
-    if not input_path_uris and not output_path_uris:
-        return user_command_line
-
-    code_lines = '''
+_gcs_copy_download_code = '''
 # Installing wget if it's missing
 if ! which wget && ! which curl; then
   if apt-get update -qq -o=Dpkg::Use-Pty=0; then
@@ -37,24 +41,287 @@ mkdir -p "$bin_dir"
 wget "$gcs_copy_url" --output-document "$gcs_copy_path" --no-verbose || curl "$gcs_copy_url" --location --output "$gcs_copy_path"
 chmod +x "$gcs_copy_path"
 export PATH=$PATH:"$bin_dir"
-'''.split('\n')
+'''
+
+# Copies a single file to or from GCS using the JSON API and the credentials from the metadata server.
+_python_gcs_copy_function_code = '''
+kfp_python_gcs_copy() {
+python3 - "$@" <<'KFP_PYTHON_EOF'
+import json, os, shutil, sys
+from urllib import parse, request
+
+def split_uri(uri):
+    bucket, _, name = uri[len('gs://'):].partition('/')
+    return bucket, parse.quote(name, safe='')
+
+token_request = request.Request(
+    'http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token',
+    headers={'Metadata-Flavor': 'Google'},
+)
+with request.urlopen(token_request) as response:
+    headers = {'Authorization': 'Bearer ' + json.load(response)['access_token']}
+
+source, destination = sys.argv[1:3]
+if source.startswith('gs://'):
+    url = 'https://storage.googleapis.com/storage/v1/b/{}/o/{}?alt=media'.format(*split_uri(source))
+    with request.urlopen(request.Request(url, headers=headers)) as response, open(destination, 'wb') as file:
+        shutil.copyfileobj(response, file, 1024 * 1024)
+else:
+    bucket, name = split_uri(destination)
+    url = 'https://storage.googleapis.com/upload/storage/v1/b/{}/o?uploadType=media&name={}'.format(bucket, name)
+    if os.path.isfile(source):
+        headers['Content-Length'] = str(os.path.getsize(source))
+    with open(source, 'rb') as file:
+        request.urlopen(request.Request(url, data=file, headers=headers, method='POST')).close()
+KFP_PYTHON_EOF
+}
+'''
+
+# Fetches the gcs_copy binary that was staged in the pipeline_root and verifies its checksum.
+_gcs_copy_staged_code = '''
+bin_dir=/tmp/kfp_bin/
+gcs_copy_path="${bin_dir}/gcs_copy"
+mkdir -p "$bin_dir"
+if command -v python3 >/dev/null 2>&1; then
+  kfp_python_gcs_copy "$gcs_copy_uri" "$gcs_copy_path"
+else
+  token_url=http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token
+  token_pattern='s/.*"access_token" *: *"\([^"]*\)".*/\1/'
+  if command -v curl >/dev/null 2>&1; then
+    token=$(curl --silent --fail --header 'Metadata-Flavor: Google' "$token_url" | sed "$token_pattern")
+    curl --silent --fail --location --header "Authorization: Bearer $token" "$gcs_copy_url" --output "$gcs_copy_path"
+  else
+    token=$(wget --quiet --output-document - --header 'Metadata-Flavor: Google' "$token_url" | sed "$token_pattern")
+    wget --quiet --header "Authorization: Bearer $token" "$gcs_copy_url" --output-document "$gcs_copy_path"
+  fi
+fi
+# The binary is never run unverified
+if command -v sha256sum >/dev/null 2>&1; then
+  gcs_copy_actual_sha256=$(sha256sum "$gcs_copy_path" | cut -d ' ' -f 1)
+elif command -v python3 >/dev/null 2>&1; then
+  gcs_copy_actual_sha256=$(python3 -c 'import hashlib, sys; print(hashlib.sha256(open(sys.argv[1], "rb").read()).hexdigest())' "$gcs_copy_path")
+elif command -v openssl >/dev/null 2>&1; then
+  gcs_copy_actual_sha256=$(openssl dgst -sha256 "$gcs_copy_path" | sed 's/.*= *//')
+else
+  echo "Cannot verify the checksum of $gcs_copy_path: sha256sum, python3 and openssl are missing." >&2
+  rm -f "$gcs_copy_path"
+  exit 1
+fi
+if [ "$gcs_copy_actual_sha256" != "$gcs_copy_sha256" ]; then
+  echo "The checksum of $gcs_copy_path is $gcs_copy_actual_sha256 instead of $gcs_copy_sha256." >&2
+  rm -f "$gcs_copy_path"
+  exit 1
+fi
+chmod +x "$gcs_copy_path"
+export PATH=$PATH:"$bin_dir"
+'''
+
+
+def _get_gcs_copy_bootstrap_code(
+    gcs_copy_bootstrap: str = 'download',
+    gcs_copy_uri: str = None,
+    gcs_copy_sha256: str = None,
+) -> str:
+    '''Returns the code that makes gcs_copy available unless the container already has it.
+
+    Modes:
+    download: Downloads the gcs_copy binary from GitHub (installing wget if needed).
+    pipeline_root: Fetches the binary staged by _tool_staging.stage_gcs_copy and verifies its checksum.
+    python: Uses a python3-based gcs_copy shell function. Requires python3 in the container.
+    '''
+    if gcs_copy_bootstrap == 'download':
+        install_code = _gcs_copy_download_code
+    elif gcs_copy_bootstrap == 'python':
+        install_code = _python_gcs_copy_function_code + 'gcs_copy() {\n  kfp_python_gcs_copy "$@"\n}\n'
+    elif gcs_copy_bootstrap == 'pipeline_root':
+        if not gcs_copy_uri or not gcs_copy_sha256:
+            raise ValueError('The "pipeline_root" gcs_copy bootstrap mode requires gcs_copy_uri and gcs_copy_sha256.')
+        install_code = _python_gcs_copy_function_code + ''.join(
+            """{}='{}'\n""".format(name, value.replace("'", "'\\''"))
+            for name, value in [
+                ('gcs_copy_uri', gcs_copy_uri),
+                ('gcs_copy_url', _tool_staging._get_gcs_object_download_url(gcs_copy_uri)),
+                ('gcs_copy_sha256', gcs_copy_sha256),
+            ]
+        ) + _gcs_copy_staged_code
+    else:
+        raise ValueError('Unsupported gcs_copy bootstrap mode: "{}".'.format(gcs_copy_bootstrap))
+    return 'if ! command -v gcs_copy >/dev/null 2>&1; then\n' + install_code + 'fi\n'
+
+
+# The transfers run in background and are waited for in batches.
+# A failed transfer signals the main shell which stops the other transfers and fails the step.
+_parallel_transfer_functions_code = '''
+kfp_pids=""
+trap 'kill $kfp_pids 2>/dev/null; exit 1' USR1
+kfp_transfer() {
+  if ! "$@"; then
+    echo "Failed to copy $2 to $3" >&2
+    kill -USR1 $$
+    exit 1
+  fi
+}
+kfp_wait() {
+  for kfp_pid in $kfp_pids; do
+    wait "$kfp_pid" || { kill $kfp_pids 2>/dev/null; exit 1; }
+  done
+  kfp_pids=""
+}
+'''
+
+
+# The streamed artifacts are named pipes that are transferred while the program runs.
+# The program must read or write each streamed artifact sequentially and only once.
+_streaming_functions_code = '''
+kfp_stream_input() {
+  gcs_copy "$1" "$2" &
+  kfp_copy_pid=$!
+  trap 'kill $kfp_copy_pid 2>/dev/null; exit 1' TERM
+  if ! wait $kfp_copy_pid; then
+    # Closing the pipe so that the program does not wait for the input forever
+    : > "$2"
+    exit 1
+  fi
+}
+kfp_stream_output() {
+  if ! gcs_copy "$1" "$2"; then
+    # Draining the pipe so that the program does not wait for the output forever
+    cat "$1" > /dev/null
+    exit 1
+  fi
+}
+kfp_finish_input_stream() {
+  if kill -0 "$1" 2>/dev/null; then
+    # The program has exited without reading the whole input
+    kill "$1" 2>/dev/null || true
+    wait "$1" || true
+  else
+    wait "$1" || { echo "Failed to stream $2" >&2; exit 1; }
+  fi
+}
+kfp_finish_output_stream() {
+  kfp_unblock_pid=""
+  if kill -0 "$1" 2>/dev/null; then
+    # Opening the pipe for writing unblocks the upload if the program has not opened the output
+    ( : > "$2" ) 2>/dev/null &
+    kfp_unblock_pid=$!
+  fi
+  wait "$1" || { echo "Failed to stream $2" >&2; exit 1; }
+  if [ -n "$kfp_unblock_pid" ]; then
+    kill "$kfp_unblock_pid" 2>/dev/null || true
+  fi
+}
+'''
+
+
+# The codec is chosen at compile time and recorded in the artifact properties, so the consumers do not guess it from the data.
+# Both the producer and the consumer images must have the codec. The step fails before running the program otherwise.
+_compression_functions_code = '''
+if ! command -v "$kfp_compression" >/dev/null 2>&1; then
+  echo "The artifact compression codec $kfp_compression is missing from the image." >&2
+  exit 1
+fi
+kfp_upload_compressed() {
+  case "$kfp_compression" in
+    gzip) gzip -1 -c "$1" > "$1.kfp_compressed" || return 1 ;;
+    zstd) zstd -q -1 -c "$1" > "$1.kfp_compressed" || return 1 ;;
+  esac
+  gcs_copy "$1.kfp_compressed" "$2" && rm -f "$1.kfp_compressed"
+}
+kfp_download_compressed() {
+  gcs_copy "$1" "$2.kfp_compressed" || return 1
+  case "$kfp_compression" in
+    gzip) gzip -d -c "$2.kfp_compressed" > "$2" || return 1 ;;
+    zstd) zstd -q -d -c "$2.kfp_compressed" > "$2" || return 1 ;;
+  esac
+  rm -f "$2.kfp_compressed"
+}
+'''
+
+
+def _generate_command_line(
+    user_command_line: List[str],
+    input_path_uris: Dict[str, str],
+    output_path_uris: Dict[str, str],
+    max_parallel_transfers: int = 1,
+    gcs_copy_bootstrap: str = 'download',
+    gcs_copy_uri: str = None,
+    gcs_copy_sha256: str = None,
+    streaming_paths: List[str] = None,
+    artifact_compression: str = None,
+    compressed_paths: List[str] = None,
+) -> List[str]:
+    if not input_path_uris and not output_path_uris:
+        return user_command_line
+
+    def is_compressed(path: str) -> bool:
+        return path in (compressed_paths or [])
+
+    def is_streamed(path: str) -> bool:
+        # The compressed artifacts are not streamed
+        return not is_compressed(path) and path in (streaming_paths or [])
+
+    code_lines = _get_gcs_copy_bootstrap_code(gcs_copy_bootstrap, gcs_copy_uri, gcs_copy_sha256).split('\n')
     for path in list(input_path_uris.keys()) + list(output_path_uris.keys()):
         #code_lines.append('''mkdir -p "$(dirname "{path}")"'''.format(path=path))
         dir = str(pathlib.PurePosixPath(path).parent)
-        dir = dir.replace("'", "'\''")  # escaping
+        dir = dir.replace("'", "'\\''")  # escaping
         code_lines.append("""mkdir -p '{dir}'""".format(dir=dir))
 
-    for path, uri in input_path_uris.items():
-        # Escaping. Cannot/must not escape URI since it's just a placeholder
-        path = path.replace("'", "'\''")  # escaping
-        code_lines.append("""gcs_copy '{uri}' '{path}'""".format(path=path, uri=uri))
+    if max_parallel_transfers > 1:
+        code_lines.extend(_parallel_transfer_functions_code.split('\n'))
+    if any(is_streamed(path) for path in list(input_path_uris.keys()) + list(output_path_uris.keys())):
+        code_lines.extend(_streaming_functions_code.split('\n'))
+    if any(is_compressed(path) for path in list(input_path_uris.keys()) + list(output_path_uris.keys())):
+        code_lines.append("""kfp_compression='{}'""".format(artifact_compression or 'gzip'))
+        code_lines.extend(_compression_functions_code.split('\n'))
+
+    def add_transfer_lines(transfers: List[Tuple[str, str, str]]):
+        for index, (copy_command, source, destination) in enumerate(transfers):
+            if max_parallel_transfers > 1:
+                code_lines.append("""kfp_transfer {} '{}' '{}' &""".format(copy_command, source, destination))
+                code_lines.append('kfp_pids="$kfp_pids $!"')
+                if (index + 1) % max_parallel_transfers == 0 or index + 1 == len(transfers):
+                    code_lines.append('kfp_wait')
+            else:
+                code_lines.append("""{} '{}' '{}'""".format(copy_command, source, destination))
+
+    # Escaping. Cannot/must not escape URI since it's just a placeholder
+    add_transfer_lines([
+        ('kfp_download_compressed' if is_compressed(path) else 'gcs_copy', uri, path.replace("'", "'\\''"))
+        for path, uri in input_path_uris.items()
+        if not is_streamed(path)
+    ])
+
+    streams = [
+        (path.replace("'", "'\\''"), uri, is_input)
+        for path_uris, is_input in [(input_path_uris, True), (output_path_uris, False)]
+        for path, uri in path_uris.items()
+        if is_streamed(path)
+    ]
+    for index, (path, uri, is_input) in enumerate(streams):
+        code_lines.append("""rm -f '{path}'""".format(path=path))
+        code_lines.append("""mkfifo '{path}'""".format(path=path))
+        if is_input:
+            code_lines.append("""kfp_stream_input '{}' '{}' &""".format(uri, path))
+        else:
+            code_lines.append("""kfp_stream_output '{}' '{}' &""".format(path, uri))
+        code_lines.append('kfp_stream_pid_{}=$!'.format(index))
 
     code_lines.append('''"$0" "$@"''')
 
-    for path, uri in output_path_uris.items():
-        # Escaping. Cannot/must not escape URI since it's just a placeholder
-        path = path.replace("'", "'\''")
-        code_lines.append("""gcs_copy '{path}' '{uri}'""".format(path=path, uri=uri))
+    for index, (path, uri, is_input) in enumerate(streams):
+        code_lines.append("""{} "$kfp_stream_pid_{}" '{}'""".format(
+            'kfp_finish_input_stream' if is_input else 'kfp_finish_output_stream',
+            index,
+            path,
+        ))
+
+    add_transfer_lines([
+        ('kfp_upload_compressed' if is_compressed(path) else 'gcs_copy', path.replace("'", "'\\''"), uri)
+        for path, uri in output_path_uris.items()
+        if not is_streamed(path)
+    ])
 
     full_command_line = [
         'sh', '-e', '-c', ''.join(line + '\n' for line in code_lines)
@@ -70,9 +337,13 @@ def _create_caip_pipeline_job_from_task_spec(
     task_spec: structures.TaskSpec,
     pipeline_root: str,
     pipeline_context: str,
+    command_line_options: dict = None,
 ) -> dict:
     root_component_spec = task_spec.component_ref.spec
-    result_pipeline_spec = _create_caip_pipeline_spec_from_task_spec(task_spec)
+    result_pipeline_spec = _create_caip_pipeline_spec_from_task_spec(
+        task_spec=task_spec,
+        command_line_options=command_line_options,
+    )
     result_pipeline_spec['pipelineContext'] = pipeline_context
 
     result_pipeline_job = dict(
@@ -89,6 +360,7 @@ def _create_caip_pipeline_job_from_task_spec(
 
 def _create_caip_pipeline_spec_from_task_spec(
     task_spec: structures.TaskSpec,
+    command_line_options: dict = None,
 ) -> dict:
     result_pipeline_steps = {}
     result_pipeline_spec = dict(
@@ -99,24 +371,20 @@ def _create_caip_pipeline_spec_from_task_spec(
     root_component_spec = task_spec.component_ref.spec
 
     # Filling in the pipeline arguments
-    root_arguments = task_spec.arguments or {}
-    for input_spec in root_component_spec.inputs or []:
-        if input_spec.name not in root_arguments:
-            if input_spec.default is None:
-                raise ValueError('Missing argument for graph input "{}"'.format(input_spec.name))
-            root_arguments[input_spec.name] = input_spec.default
-
-    for input_name, argument in root_arguments.items():
-        if not isinstance(argument, str):
-            raise TypeError()
+    root_arguments = _fill_in_graph_arguments(root_component_spec, task_spec.arguments)
+    # id(component_spec) -> component digest. The tasks that use the same component usually share the spec object.
+    component_digests = {}
     if isinstance(root_component_spec.implementation, structures.GraphImplementation):
         graph_spec = root_component_spec.implementation.graph
+        # The outputs consumed as values are read by the backend, so they cannot be compressed
+        uncompressed_output_names = _get_value_consumed_output_names(graph_spec) if (command_line_options or {}).get('artifact_compression') else {}
         for task_id, task_spec in graph_spec.tasks.items():
             task_component_spec = task_spec.component_ref.spec
             task_arguments = task_spec.arguments or {}
             resolved_task_arguments = {}
             constant_task_arguments = {}
             reference_task_arguments = {}
+            compressed_input_names = []
             for input_name, argument in task_arguments.items():
                 resolved_argument = None
                 if isinstance(argument, str):
@@ -134,48 +402,33 @@ def _create_caip_pipeline_spec_from_task_spec(
                     )
                     reference_task_arguments[input_name] = resolved_argument
                     constant_task_arguments[input_name] = "{{{{$.inputs['{}'].value}}}}".format(input_name)
+                    producer_component_spec = graph_spec.tasks[argument.task_output.task_id].component_ref.spec
+                    producer_compressed_output_names = _get_compressed_output_names(
+                        producer_component_spec,
+                        command_line_options,
+                        uncompressed_output_names.get(argument.task_output.task_id),
+                    )
+                    if argument.task_output.output_name in producer_compressed_output_names:
+                        compressed_input_names.append(input_name)
                 else:
                     raise TypeError('Unsupported argument: "{}"'.format(argument))
                 resolved_task_arguments[input_name] = resolved_argument
             if isinstance(task_component_spec.implementation, structures.ContainerImplementation):
-                task_container = task_component_spec.implementation.container
-                # Constant arguments are inlined. In future we could preserve them as property arguments
-                resolved_cmd = _components._resolve_command_line_and_paths(
+                component_digest = component_digests.get(id(task_component_spec), '')
+                if component_digest == '':
+                    component_digest = _get_container_component_digest(task_component_spec)
+                    component_digests[id(task_component_spec)] = component_digest
+                result_task_dict = _create_container_task_dict(
                     component_spec=task_component_spec,
-                    arguments=constant_task_arguments,
-                )
-                input_path_uris = {
-                    path: "{{{{$.inputs['{}'].uri}}}}".format(input_name)
-                    for input_name, path in resolved_cmd.input_paths.items()
-                }
-                output_path_uris = {
-                    path: "{{{{$.outputs['{}'].uri}}}}".format(output_name)
-                    for output_name, path in resolved_cmd.output_paths.items()
-                }
-                user_command_line = resolved_cmd.command + resolved_cmd.args
-                full_command_line = _generate_command_line(
-                    user_command_line=user_command_line,
-                    input_path_uris=input_path_uris,
-                    output_path_uris=output_path_uris,
-                )
-                result_container_dict = dict(
-                    image=task_container.image,
-                    command=full_command_line,
-                )
-                result_task_dict = dict(
-                    container=result_container_dict,
-                    inputs=reference_task_arguments,
-                    #execution_properties={},
-                    outputs={
-                        output.name: dict(
-                            artifact=_map_output_spec_to_artifact_spec_dict(output),
-                            outputUriConfig=dict(
-                                filePath=True, # Not directory
-                            ),
-                        )
-                        for output in (task_component_spec.outputs or [])
-                    }
+                    constant_task_arguments=constant_task_arguments,
+                    reference_task_arguments=reference_task_arguments,
+                    component_digest=component_digest,
+                    command_line_options=command_line_options,
+                    compressed_input_names=compressed_input_names,
+                    uncompressed_output_names=uncompressed_output_names.get(task_id),
                 )
+            else:
+                raise TypeError('Unsupported implementation of the task "{}". The nested graphs must be flattened first.'.format(task_id))
             result_pipeline_steps[task_id] = dict(
                 task=result_task_dict,
                 #dependencies=[...],
@@ -183,7 +436,264 @@ def _create_caip_pipeline_spec_from_task_spec(
     return result_pipeline_spec
 
 
-def _map_output_spec_to_artifact_spec_dict(output):
+# (component digest, argument names) -> container task template
+_container_task_templates = {}
+_CONTAINER_TASK_TEMPLATES_MAX_SIZE = 1024
+_SLOT_TOKEN = uuid.uuid4().hex
+_SLOT_PATTERN = re.compile('__kfp_gcp_slot_([0-9]+)_' + _SLOT_TOKEN + '__')
+
+
+def _get_container_component_digest(component_spec: structures.ComponentSpec) -> str:
+    '''Returns the digest of the container component or None if the component command line cannot be templated.'''
+    component_spec_dict = component_spec.to_dict()
+    if _has_value_dependent_conditions(component_spec_dict):
+        return None
+    return _compilation_cache._get_hash(component_spec_dict)
+
+
+def _create_container_task_dict(
+    component_spec: structures.ComponentSpec,
+    constant_task_arguments: Dict[str, str],
+    reference_task_arguments: dict,
+    component_digest: str = None,
+    command_line_options: dict = None,
+    compressed_input_names: List[str] = None,
+    uncompressed_output_names: Set[str] = None,
+) -> dict:
+    if not component_digest:
+        task_template = _create_container_task_template(component_spec, constant_task_arguments, command_line_options, compressed_input_names, uncompressed_output_names)
+        argument_values = []
+    else:
+        # The components are resolved once per set of passed inputs (the isPresent conditions depend on it).
+        # Then the argument values are put in the slots.
+        argument_names = tuple(sorted(constant_task_arguments.keys()))
+        template_key = (
+            component_digest,
+            argument_names,
+            tuple(sorted((command_line_options or {}).items())),
+            tuple(sorted(compressed_input_names or [])),
+            tuple(sorted(uncompressed_output_names or [])),
+        )
+        task_template = _container_task_templates.get(template_key)
+        if task_template is None:
+            slot_arguments = {
+                argument_name: '__kfp_gcp_slot_{}_{}__'.format(index, _SLOT_TOKEN)
+                for index, argument_name in enumerate(argument_names)
+            }
+            task_template = _create_container_task_template(component_spec, slot_arguments, command_line_options, compressed_input_names, uncompressed_output_names)
+            if len(_container_task_templates) >= _CONTAINER_TASK_TEMPLATES_MAX_SIZE:
+                _container_task_templates.clear()
+            _container_task_templates[template_key] = task_template
+        argument_values = [constant_task_arguments[argument_name] for argument_name in argument_names]
+
+    full_command_line = [
+        _SLOT_PATTERN.sub(lambda match: argument_values[int(match.group(1))], part) if '__kfp_gcp_slot_' in part else part
+        for part in task_template['command']
+    ]
+    result_container_dict = dict(
+        image=task_template['image'],
+        command=full_command_line,
+    )
+    result_task_dict = dict(
+        container=result_container_dict,
+        inputs=reference_task_arguments,
+        #execution_properties={},
+        outputs=_copy_json(task_template['outputs']),
+    )
+    return result_task_dict
+
+
+def _copy_json(obj):
+    # Much faster than copy.deepcopy for the JSON-like structures
+    if isinstance(obj, dict):
+        return {key: _copy_json(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_copy_json(item) for item in obj]
+    return obj
+
+
+def _create_container_task_template(
+    component_spec: structures.ComponentSpec,
+    constant_task_arguments: Dict[str, str],
+    command_line_options: dict = None,
+    compressed_input_names: List[str] = None,
+    uncompressed_output_names: Set[str] = None,
+) -> dict:
+    task_container = component_spec.implementation.container
+    # Constant arguments are inlined. In future we could preserve them as property arguments
+    with _instrumentation.span('resolve_command_line'):
+        resolved_cmd = _components._resolve_command_line_and_paths(
+            component_spec=component_spec,
+            arguments=constant_task_arguments,
+        )
+    input_path_uris = {
+        path: "{{{{$.inputs['{}'].uri}}}}".format(input_name)
+        for input_name, path in resolved_cmd.input_paths.items()
+    }
+    output_path_uris = {
+        path: "{{{{$.outputs['{}'].uri}}}}".format(output_name)
+        for output_name, path in resolved_cmd.output_paths.items()
+    }
+    streaming_input_names, streaming_output_names = _get_streaming_artifact_names(component_spec)
+    streaming_paths = [
+        path
+        for input_name, path in resolved_cmd.input_paths.items()
+        if '*' in streaming_input_names or input_name in streaming_input_names
+    ] + [
+        path
+        for output_name, path in resolved_cmd.output_paths.items()
+        if '*' in streaming_output_names or output_name in streaming_output_names
+    ]
+    artifact_compression = (command_line_options or {}).get('artifact_compression')
+    compressed_output_names = _get_compressed_output_names(component_spec, command_line_options, uncompressed_output_names)
+    compressed_paths = [
+        path
+        for input_name, path in resolved_cmd.input_paths.items()
+        if input_name in (compressed_input_names or [])
+    ] + [
+        path
+        for output_name, path in resolved_cmd.output_paths.items()
+        if output_name in compressed_output_names
+    ]
+    user_command_line = resolved_cmd.command + resolved_cmd.args
+    full_command_line = _generate_command_line(
+        user_command_line=user_command_line,
+        input_path_uris=input_path_uris,
+        output_path_uris=output_path_uris,
+        streaming_paths=streaming_paths,
+        compressed_paths=compressed_paths,
+        **(command_line_options or {})
+    )
+    return dict(
+        image=task_container.image,
+        command=full_command_line,
+        outputs={
+            output.name: dict(
+                artifact=_map_output_spec_to_artifact_spec_dict(
+                    output,
+                    compression=artifact_compression if output.name in compressed_output_names else None,
+                ),
+                outputUriConfig=dict(
+                    filePath=True, # Not directory
+                ),
+            )
+            for output in (component_spec.outputs or [])
+        },
+    )
+
+
+_STREAMING_INPUTS_ANNOTATION = 'kfp_gcp.streaming_inputs'
+_STREAMING_OUTPUTS_ANNOTATION = 'kfp_gcp.streaming_outputs'
+
+
+def _get_streaming_artifact_names(component_spec: structures.ComponentSpec) -> Tuple[List[str], List[str]]:
+    '''Returns the names of the inputs and outputs that the component reads or writes sequentially.
+
+    The names are specified as comma-separated lists in the component annotations. "*" selects all.
+    Streaming is only enabled by the component author: a program that reopens or appends to a streamed artifact blocks forever.
+    '''
+    annotations = (component_spec.metadata.annotations if component_spec.metadata else None) or {}
+
+    def get_names(annotation_key: str) -> List[str]:
+        return [name.strip() for name in annotations.get(annotation_key, '').split(',') if name.strip()]
+
+    return get_names(_STREAMING_INPUTS_ANNOTATION), get_names(_STREAMING_OUTPUTS_ANNOTATION)
+
+
+def _get_compressed_output_names(
+    component_spec: structures.ComponentSpec,
+    command_line_options: dict = None,
+    uncompressed_output_names: Set[str] = None,
+) -> List[str]:
+    '''Returns the names of the outputs that are compressed for the transfer. The streamed outputs and uncompressed_output_names are not compressed.'''
+    command_line_options = command_line_options or {}
+    if not command_line_options.get('artifact_compression'):
+        return []
+    _, streaming_output_names = _get_streaming_artifact_names(component_spec)
+    if '*' in streaming_output_names:
+        return []
+    return [
+        output.name
+        for output in component_spec.outputs or []
+        if output.name not in streaming_output_names and output.name not in (uncompressed_output_names or [])
+    ]
+
+
+def _get_value_input_names(component_spec: structures.ComponentSpec) -> Set[str]:
+    '''Returns the names of the container component inputs that are passed by value.'''
+    value_input_names = set()
+
+    def collect(obj):
+        if isinstance(obj, dict):
+            if isinstance(obj.get('inputValue'), str):
+                value_input_names.add(obj['inputValue'])
+            for value in obj.values():
+                collect(value)
+        elif isinstance(obj, list):
+            for item in obj:
+                collect(item)
+
+    container_dict = component_spec.implementation.container.to_dict()
+    collect(container_dict.get('command'))
+    collect(container_dict.get('args'))
+    return value_input_names
+
+
+def _get_value_consumed_output_names(graph_spec: structures.GraphSpec) -> Dict[str, Set[str]]:
+    '''Returns the names of the task outputs that some downstream task consumes by value.'''
+    # id(component_spec) -> value input names. The tasks that use the same component usually share the spec object.
+    value_input_names_cache = {}
+    value_consumed_output_names = {}
+    for task_spec in graph_spec.tasks.values():
+        component_spec = task_spec.component_ref.spec
+        if not isinstance(component_spec.implementation, structures.ContainerImplementation):
+            continue
+        value_input_names = value_input_names_cache.get(id(component_spec))
+        if value_input_names is None:
+            value_input_names = _get_value_input_names(component_spec)
+            value_input_names_cache[id(component_spec)] = value_input_names
+        for input_name, argument in (task_spec.arguments or {}).items():
+            if isinstance(argument, structures.TaskOutputArgument) and input_name in value_input_names:
+                task_output = argument.task_output
+                value_consumed_output_names.setdefault(task_output.task_id, set()).add(task_output.output_name)
+    return value_consumed_output_names
+
+
+def _has_value_dependent_conditions(obj) -> bool:
+    # The argument values used in the conditional placeholders change the command-line structure.
+    # The isPresent conditions only depend on the set of passed arguments.
+    if isinstance(obj, dict):
+        if_structure = obj.get('if')
+        if isinstance(if_structure, dict):
+            condition = if_structure.get('cond')
+            condition_is_static = (
+                condition is None
+                or isinstance(condition, (str, bool, int))
+                or (isinstance(condition, dict) and list(condition.keys()) == ['isPresent'])
+            )
+            if not condition_is_static:
+                return True
+        return any(_has_value_dependent_conditions(value) for value in obj.values())
+    if isinstance(obj, list):
+        return any(_has_value_dependent_conditions(item) for item in obj)
+    return False
+
+
+def _fill_in_graph_arguments(component_spec: structures.ComponentSpec, arguments: Dict[str, str]) -> Dict[str, str]:
+    root_arguments = dict(arguments or {})
+    for input_spec in component_spec.inputs or []:
+        if input_spec.name not in root_arguments:
+            if input_spec.default is None:
+                raise ValueError('Missing argument for graph input "{}"'.format(input_spec.name))
+            root_arguments[input_spec.name] = input_spec.default
+
+    for input_name, argument in root_arguments.items():
+        if not isinstance(argument, str):
+            raise TypeError()
+    return root_arguments
+
+
+def _map_output_spec_to_artifact_spec_dict(output, compression: str = None):
     artifact_type = 'file'
     if output.type:
         output_type = str(output.type).lower()
@@ -203,6 +713,9 @@ def _map_output_spec_to_artifact_spec_dict(output):
     }
     if output.type:
         custom_properties['type_name'] = {'string_value': str(output.type)}
+    if compression:
+        # The consumers decompress the artifact before the component code sees it
+        custom_properties['kfp_gcp.compression'] = {'string_value': compression}
 
     artifact = {
         artifact_type: {},
@@ -211,19 +724,22 @@ def _map_output_spec_to_artifact_spec_dict(output):
     return artifact
 
 
-def compile_pipeline(
-    pipeline_func: Callable,
-    arguments: Dict[str, str],
-    pipeline_root: str,
-    pipeline_context: str = 'Default',
-    #job_name: str = None,
-    #project_id: str = 'managed-pipeline-test',
-) -> dict:
+def _create_component_spec_from_pipeline_func(pipeline_func: Callable) -> structures.ComponentSpec:
     component_factory = components.create_graph_component_from_pipeline_func(
         pipeline_func=pipeline_func,
         embed_component_specs=True,
     )
-    component_spec = component_factory.component_spec
+    # CAIP Pipelines do not support sub-DAGs, so the nested graphs are inlined
+    return _graph_flattening.flatten_graph_component(component_factory.component_spec)
+
+
+def _compile_component_spec(
+    component_spec: structures.ComponentSpec,
+    arguments: Dict[str, str],
+    pipeline_root: str,
+    pipeline_context: str,
+    command_line_options: dict = None,
+) -> dict:
     component_ref = structures.ComponentReference(
         spec=component_spec,
     )
@@ -237,11 +753,204 @@ def compile_pipeline(
         task_spec=task_spec,
         pipeline_root=pipeline_root,
         pipeline_context=pipeline_context,
+        command_line_options=command_line_options,
         #full_job_name=full_job_name,
     )
     return caip_pipeline_job
 
 
+def _get_argument_placeholder_pattern(token: str):
+    return re.compile('__kfp_gcp_argument_([0-9]+)_' + token + '__')
+
+
+def _substitute_argument_placeholders(obj, pattern, argument_values: List[str]):
+    # Returns a new object
+    if isinstance(obj, str):
+        if '__kfp_gcp_argument_' not in obj:
+            return obj
+        return pattern.sub(lambda match: argument_values[int(match.group(1))], obj)
+    if isinstance(obj, dict):
+        return {key: _substitute_argument_placeholders(value, pattern, argument_values) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_substitute_argument_placeholders(item, pattern, argument_values) for item in obj]
+    return obj
+
+
+def _get_component_spec(
+    pipeline_func: Callable,
+    compilation_cache: _compilation_cache._CompiledJobCache = None,
+) -> structures.ComponentSpec:
+    component_spec = compilation_cache.get_component_spec(pipeline_func) if compilation_cache else None
+    if component_spec is None:
+        component_spec = _create_component_spec_from_pipeline_func(pipeline_func)
+        if compilation_cache:
+            compilation_cache.put_component_spec(pipeline_func, component_spec)
+    return component_spec
+
+
+# Incremented when the format of the compilation cache entries changes
+_COMPILATION_CACHE_FORMAT_VERSION = 1
+
+
+@functools.lru_cache()
+def _get_compiler_version() -> str:
+    '''Returns the version of the code that generates the jobs, so that the cached jobs are not reused after an upgrade.
+
+    The digest of the compiler source changes with every change of the generated scripts, even without a package version change.
+    '''
+    source_digest = hashlib.sha256()
+    for module in [_tool_staging]:
+        source_digest.update(pathlib.Path(module.__file__).read_bytes())
+    source_digest.update(pathlib.Path(__file__).read_bytes())
+    return '{}-kfp{}-{}'.format(_COMPILATION_CACHE_FORMAT_VERSION, kfp.__version__, source_digest.hexdigest()[:16])
+
+
+def _compile_pipeline_using_cache(
+    pipeline_func: Callable,
+    arguments: Dict[str, str],
+    pipeline_root: str,
+    pipeline_context: str,
+    compilation_cache: _compilation_cache._CompiledJobCache,
+    command_line_options: dict = None,
+) -> dict:
+    component_spec = _get_component_spec(pipeline_func, compilation_cache)
+    component_spec_dict = component_spec.to_dict()
+    # The job is compiled once with the placeholder arguments which are then replaced with the actual arguments.
+    # This is not possible when the arguments can change the command-line structure.
+    use_template = not _has_value_dependent_conditions(component_spec_dict)
+    cache_key_obj = dict(
+        compiler_version=_get_compiler_version(),
+        component_spec=component_spec_dict,
+        pipeline_root=pipeline_root,
+        pipeline_context=pipeline_context,
+        command_line_options=command_line_options,
+    )
+    if not use_template:
+        cache_key_obj['arguments'] = arguments
+    cache_key = _compilation_cache._get_hash(cache_key_obj)
+
+    cache_entry = compilation_cache.get(cache_key)
+    if cache_entry is None:
+        if use_template:
+            token = uuid.uuid4().hex
+            input_names = [input_spec.name for input_spec in component_spec.inputs or []]
+            template_arguments = {
+                input_name: '__kfp_gcp_argument_{}_{}__'.format(index, token)
+                for index, input_name in enumerate(input_names)
+            }
+            cache_entry = dict(
+                job=_compile_component_spec(component_spec, template_arguments, pipeline_root, pipeline_context, command_line_options),
+                token=token,
+                input_names=input_names,
+            )
+        else:
+            cache_entry = dict(
+                job=_compile_component_spec(component_spec, arguments, pipeline_root, pipeline_context, command_line_options),
+            )
+        compilation_cache.put(cache_key, cache_entry)
+
+    if 'token' not in cache_entry:
+        return copy.deepcopy(cache_entry['job'])
+    resolved_arguments = _fill_in_graph_arguments(component_spec, arguments)
+    argument_values = [resolved_arguments[input_name] for input_name in cache_entry['input_names']]
+    return _substitute_argument_placeholders(
+        cache_entry['job'],
+        _get_argument_placeholder_pattern(cache_entry['token']),
+        argument_values,
+    )
+
+
+@_instrumentation.traced('compile_pipeline')
+def compile_pipeline(
+    pipeline_func: Callable,
+    arguments: Dict[str, str],
+    pipeline_root: str,
+    pipeline_context: str = 'Default',
+    pin_image_digests: bool = False,
+    image_digests: Dict[str, str] = None,
+    image_digest_index_path: str = None,
+    compilation_cache: _compilation_cache._CompiledJobCache = None,
+    max_parallel_transfers: int = 1,
+    gcs_copy_bootstrap: str = 'download',
+    gcs_copy_uri: str = None,
+    gcs_copy_sha256: str = None,
+    artifact_compression: str = None,
+    spill_arguments_larger_than: int = None,
+    execution_cache: _execution_cache._ExecutionCache = None,
+    job_name: str = None,
+    #project_id: str = 'managed-pipeline-test',
+) -> dict:
+    # Options that control the generated command-line wrapper
+    command_line_options = dict(
+        max_parallel_transfers=max_parallel_transfers,
+        gcs_copy_bootstrap=gcs_copy_bootstrap,
+        gcs_copy_uri=gcs_copy_uri,
+        gcs_copy_sha256=gcs_copy_sha256,
+        artifact_compression=artifact_compression,
+    )
+    if artifact_compression not in (None, 'gzip', 'zstd'):
+        raise ValueError('Unsupported artifact compression: "{}". Supported codecs are "gzip" and "zstd".'.format(artifact_compression))
+    if compilation_cache:
+        caip_pipeline_job = _compile_pipeline_using_cache(
+            pipeline_func=pipeline_func,
+            arguments=arguments,
+            pipeline_root=pipeline_root,
+            pipeline_context=pipeline_context,
+            compilation_cache=compilation_cache,
+            command_line_options=command_line_options,
+        )
+    else:
+        component_spec = _get_component_spec(pipeline_func)
+        caip_pipeline_job = _compile_component_spec(
+            component_spec=component_spec,
+            arguments=arguments,
+            pipeline_root=pipeline_root,
+            pipeline_context=pipeline_context,
+            command_line_options=command_line_options,
+        )
+
+    if pin_image_digests:
+        # Pinned digests make the runs reproducible and let the nodes reuse the pulled images.
+        # The execution cache keys use the pinned images, so the results of a moved tag are not reused.
+        caip_pipeline_job = _image_mirroring.pin_container_image_digests(
+            pipeline_job=caip_pipeline_job,
+            image_digests=image_digests,
+            digest_index=_image_mirror_index._ImageDigestIndex(
+                path=image_digest_index_path,
+            ) if image_digest_index_path else None,
+        )
+
+    if execution_cache:
+        component_spec = _get_component_spec(pipeline_func, compilation_cache)
+        caip_pipeline_job = _execution_cache.apply_execution_cache(
+            pipeline_job=caip_pipeline_job,
+            component_spec=component_spec,
+            root_arguments=_fill_in_graph_arguments(component_spec, arguments),
+            pipeline_root=pipeline_root,
+            execution_cache=execution_cache,
+            job_name=job_name,
+        )
+
+    if spill_arguments_larger_than:
+        caip_pipeline_job, spill_report = _argument_spilling.spill_large_arguments(
+            pipeline_job=caip_pipeline_job,
+            pipeline_root=pipeline_root,
+            min_size=spill_arguments_larger_than,
+            bootstrap_code=_get_gcs_copy_bootstrap_code(gcs_copy_bootstrap, gcs_copy_uri, gcs_copy_sha256),
+        )
+        if spill_report.spilled_argument_count:
+            logging.info('Spilled {} large arguments ({} unique). The job payload size was reduced from {} to {} bytes.'.format(
+                spill_report.spilled_argument_count,
+                spill_report.unique_spilled_argument_count,
+                spill_report.original_payload_size,
+                spill_report.payload_size,
+            ))
+
+    _instrumentation.increment('compiled_steps', len(caip_pipeline_job['spec']['steps']))
+    return caip_pipeline_job
+
+
+@_instrumentation.traced('run_pipeline')
 def run_pipeline(
     pipeline_func: Callable,
     arguments: Dict[str, str],
@@ -249,36 +958,73 @@ def run_pipeline(
     pipeline_context: str = 'Default',
     job_name: str = None,
     mirror_images: bool = True,
+    mirror_index_ttl_seconds: float = 24 * 60 * 60,
+    pin_image_digests: bool = False,
+    image_digest_index_path: str = None,
+    compilation_cache: _compilation_cache._CompiledJobCache = None,
+    max_parallel_transfers: int = 1,
+    gcs_copy_bootstrap: str = 'download',
+    gcs_copy_sha256: str = None,
+    artifact_compression: str = None,
+    spill_arguments_larger_than: int = None,
+    execution_cache: _execution_cache._ExecutionCache = None,
     project_id: str = 'managed-pipeline-test',
     api_host: str = 'alpha-ml.googleapis.com',
 ) -> dict:
+    job_api = _pipeline_jobs_api.PipelineJobApi(
+        project_id=project_id,
+        api_host=api_host,
+    )
+    if execution_cache:
+        # Recording the steps of the previous runs that have succeeded since
+        execution_cache.update_pending_executions(job_api)
+
+    gcs_copy_uri = None
+    if gcs_copy_bootstrap == 'pipeline_root':
+        # Staging the tool once instead of downloading it from GitHub in every step.
+        # gcs_copy_sha256 overrides the pinned checksum of the binary.
+        gcs_copy_uri, gcs_copy_sha256 = _tool_staging.stage_gcs_copy(pipeline_root, expected_sha256=gcs_copy_sha256)
+
+    # Setting the job name
+    if not job_name:
+        job_name = 'job-' + datetime.datetime.now().isoformat()
+        job_name = re.sub('[^-a-zA-Z0-9]', '-', job_name.lower()).strip('-')
+
     pipeline_job = compile_pipeline(
         pipeline_func=pipeline_func,
         arguments=arguments,
         pipeline_root=pipeline_root,
         pipeline_context=pipeline_context,
+        pin_image_digests=pin_image_digests,
+        image_digest_index_path=image_digest_index_path,
+        compilation_cache=compilation_cache,
+        max_parallel_transfers=max_parallel_transfers,
+        gcs_copy_bootstrap=gcs_copy_bootstrap,
+        gcs_copy_uri=gcs_copy_uri,
+        gcs_copy_sha256=gcs_copy_sha256,
+        artifact_compression=artifact_compression,
+        spill_arguments_larger_than=spill_arguments_larger_than,
+        execution_cache=execution_cache,
+        job_name=job_name,
     )
+    _argument_spilling.upload_spilled_arguments(pipeline_job)
 
     if mirror_images:
         pipeline_job = _image_mirroring.mirror_and_replace_container_images(
             pipeline_job=pipeline_job,
             mirror_prefix = 'gcr.io/' + project_id + '/mirror/',
             project_id=project_id,
+            mirror_index=_image_mirror_index._ImageMirrorIndex(
+                ttl_seconds=mirror_index_ttl_seconds,
+            ) if mirror_index_ttl_seconds else None,
         )
 
-    # Setting the job name
-    if not job_name:
-        job_name = 'job-' + datetime.datetime.now().isoformat()
-        job_name = re.sub('[^-a-zA-Z0-9]', '-', job_name.lower()).strip('-')
-
-    job_api = _pipeline_jobs_api.PipelineJobApi(
-        project_id=project_id,
-        api_host=api_host,
-    )
     job = job_api.submit_job(
         pipeline_job_dict=pipeline_job,
         job_name=job_name,
     )
+    if execution_cache:
+        execution_cache.add_pending_executions(job_name, pipeline_job)
     logging.info('Submitted job ' + job.job_name)
     try:
         import IPython
@@ -0,0 +1,189 @@
+import collections
+from typing import Dict, List
+
+from . import _pipeline_jobs_api
+
+
+def _get_step_dependencies(pipeline_job: dict) -> Dict[str, List[str]]:
+    '''Returns the upstream steps of every step. The dependencies come from the inputs.step_output references.'''
+    dependencies = collections.OrderedDict()
+    for step_name, step in pipeline_job['spec']['steps'].items():
+        upstream_steps = []
+        for input_dict in (step.get('task', {}).get('inputs') or {}).values():
+            upstream_step = (input_dict.get('step_output') or {}).get('step')
+            if upstream_step and upstream_step not in upstream_steps:
+                upstream_steps.append(upstream_step)
+        dependencies[step_name] = upstream_steps
+    return dependencies
+
+
+def _get_topological_order(dependencies: Dict[str, List[str]]) -> List[str]:
+    order = []
+    visited = set()
+    for root_step in dependencies:
+        if root_step in visited:
+            continue
+        # Iterative DFS since the pipelines can be deeper than the recursion limit
+        stack = [(root_step, iter(dependencies[root_step]))]
+        visited.add(root_step)
+        while stack:
+            step, upstream_iter = stack[-1]
+            upstream_step = next(upstream_iter, None)
+            if upstream_step is None:
+                stack.pop()
+                order.append(step)
+            elif upstream_step not in visited and upstream_step in dependencies:
+                visited.add(upstream_step)
+                stack.append((upstream_step, iter(dependencies[upstream_step])))
+    return order
+
+
+def profile_job(job_json: dict, pipeline_job: dict = None) -> dict:
+    '''Computes the per-step timings, the critical path and the step slack of a finished job.
+
+    job_json is the job returned by PipelineJobApi.get_job_json or a saved copy of it.
+    pipeline_job is the compiled job. It is only needed when job_json has no spec.
+
+    The times are in seconds. The step offsets are relative to the job start.
+    queue: From the moment all upstream steps have finished to the task creation (or start if there is no creation time).
+    startup: From the task creation to the task start.
+    run: From the task start to the task end.
+    The critical path is the chain of steps that determined the job duration.
+    The slack of a step is how much longer the step could have taken without delaying the job.
+    '''
+    pipeline_job = pipeline_job or job_json
+    if 'steps' not in pipeline_job.get('spec', {}):
+        raise ValueError('The job JSON has no spec. Pass the compiled job to get the step dependencies.')
+    dependencies = _get_step_dependencies(pipeline_job)
+    executions = {
+        execution['step']: execution
+        for execution in job_json.get('jobDetail', {}).get('taskExecutions', [])
+    }
+    execution_times = [
+        time
+        for execution in executions.values()
+        for time in [_pipeline_jobs_api._parse_timestamp(execution.get('startTime')), _pipeline_jobs_api._parse_timestamp(execution.get('endTime'))]
+        if time is not None
+    ]
+    job_start_time = (
+        _pipeline_jobs_api._parse_timestamp(job_json.get('startTime'))
+        or _pipeline_jobs_api._parse_timestamp(job_json.get('createTime'))
+        or min(execution_times, default=0)
+    )
+    job_end_time = _pipeline_jobs_api._parse_timestamp(job_json.get('endTime')) or max(execution_times, default=job_start_time)
+
+    steps = collections.OrderedDict()
+    # Earliest finish offsets of the executed steps
+    finish_offsets = {}
+    durations = {}
+    for step_name in _get_topological_order(dependencies):
+        execution = executions.get(step_name, {})
+        create_time = _pipeline_jobs_api._parse_timestamp(execution.get('createTime'))
+        start_time = _pipeline_jobs_api._parse_timestamp(execution.get('startTime'))
+        end_time = _pipeline_jobs_api._parse_timestamp(execution.get('endTime'))
+        upstream_finish_offsets = [finish_offsets[upstream_step] for upstream_step in dependencies[step_name] if upstream_step in finish_offsets]
+        ready_offset = max(upstream_finish_offsets, default=0)
+        step_report = collections.OrderedDict(
+            state=execution.get('state'),
+            dependencies=dependencies[step_name],
+            ready_offset=ready_offset,
+            start_offset=None,
+            end_offset=None,
+            queue_seconds=None,
+            startup_seconds=None,
+            run_seconds=None,
+            slack_seconds=None,
+            critical=False,
+        )
+        if start_time is not None and end_time is not None:
+            start_offset = start_time - job_start_time
+            end_offset = end_time - job_start_time
+            queue_end_offset = create_time - job_start_time if create_time is not None else start_offset
+            step_report.update(
+                start_offset=start_offset,
+                end_offset=end_offset,
+                queue_seconds=max(0, queue_end_offset - ready_offset),
+                startup_seconds=max(0, start_offset - queue_end_offset),
+                run_seconds=end_offset - start_offset,
+            )
+            # The observed step duration includes the waiting after the step became ready
+            durations[step_name] = max(0, end_offset - ready_offset)
+            finish_offsets[step_name] = ready_offset + durations[step_name]
+        steps[step_name] = step_report
+
+    # Latest finish offsets that do not delay the job
+    makespan = max(finish_offsets.values(), default=0)
+    latest_finish_offsets = {}
+    for step_name in reversed(list(steps.keys())):
+        if step_name not in finish_offsets:
+            continue
+        latest_finish_offsets.setdefault(step_name, makespan)
+        latest_start_offset = latest_finish_offsets[step_name] - durations[step_name]
+        for upstream_step in dependencies[step_name]:
+            if upstream_step in finish_offsets:
+                latest_finish_offsets[upstream_step] = min(latest_finish_offsets.get(upstream_step, makespan), latest_start_offset)
+        steps[step_name]['slack_seconds'] = latest_finish_offsets[step_name] - finish_offsets[step_name]
+
+    # Tracing the critical path back from the step that finished last
+    critical_path = []
+    step_name = max(finish_offsets, key=finish_offsets.get, default=None)
+    while step_name is not None:
+        critical_path.append(step_name)
+        steps[step_name]['critical'] = True
+        upstream_steps = [upstream_step for upstream_step in dependencies[step_name] if upstream_step in finish_offsets]
+        step_name = max(upstream_steps, key=finish_offsets.get, default=None)
+    critical_path.reverse()
+
+    return collections.OrderedDict(
+        job_name=job_json.get('name', '').rsplit('/', 1)[-1],
+        state=job_json.get('state'),
+        wall_time_seconds=job_end_time - job_start_time,
+        critical_path=critical_path,
+        critical_path_seconds=makespan,
+        total_queue_seconds=sum(step['queue_seconds'] or 0 for step in steps.values()),
+        total_startup_seconds=sum(step['startup_seconds'] or 0 for step in steps.values()),
+        total_run_seconds=sum(step['run_seconds'] or 0 for step in steps.values()),
+        steps=steps,
+    )
+
+
+def profile_job_by_name(job_api: _pipeline_jobs_api.PipelineJobApi, job_name: str, pipeline_job: dict = None) -> dict:
+    return profile_job(job_api.get_job_json(job_name), pipeline_job)
+
+
+def to_chrome_trace(report: dict) -> dict:
+    '''Converts the profile report to the Chrome trace event format. Open it in chrome://tracing or Perfetto to see the Gantt chart.
+
+    Every step gets its own row with the queue, startup and run phases.
+    '''
+    trace_events = []
+    for thread_id, (step_name, step) in enumerate(report['steps'].items(), 1):
+        trace_events.append(dict(name='thread_name', ph='M', pid=1, tid=thread_id, args=dict(name=step_name)))
+        if step['start_offset'] is None:
+            continue
+        run_start_offset = step['start_offset']
+        startup_start_offset = run_start_offset - step['startup_seconds']
+        queue_start_offset = startup_start_offset - step['queue_seconds']
+        phases = [
+            ('queue', queue_start_offset, step['queue_seconds']),
+            ('startup', startup_start_offset, step['startup_seconds']),
+            ('run', run_start_offset, step['run_seconds']),
+        ]
+        for phase, start_offset, duration in phases:
+            if not duration:
+                continue
+            trace_events.append(dict(
+                name=step_name if phase == 'run' else '{} ({})'.format(step_name, phase),
+                cat=phase + (',critical' if step['critical'] else ''),
+                ph='X',
+                pid=1,
+                tid=thread_id,
+                ts=start_offset * 1e6,
+                dur=duration * 1e6,
+                args=dict(state=step['state'], slack_seconds=step['slack_seconds'], critical=step['critical']),
+            ))
+    return dict(
+        traceEvents=trace_events,
+        displayTimeUnit='ms',
+        otherData=dict(job_name=report['job_name'], state=report['state']),
+    )
@@ -0,0 +1,110 @@
+import hashlib
+import logging
+import os
+import urllib.parse
+from typing import Tuple
+
+import requests
+
+from . import _image_mirror_index
+from . import _pipeline_jobs_api
+
+
+_GCS_COPY_URL = 'https://github.com/Ark-kun/gcs_copy_go/releases/download/v0.2/gcs_copy-linux-amd64'
+# The pinned SHA-256 of the _GCS_COPY_URL release binary. Update it together with the URL.
+# The staging refuses to run until the checksum is pinned here or passed explicitly.
+_GCS_COPY_SHA256 = None
+
+
+def _split_gcs_uri(uri: str) -> Tuple[str, str]:
+    if not uri.startswith('gs://'):
+        raise ValueError('Expected a GCS URI, got "{}"'.format(uri))
+    bucket, _, object_name = uri[len('gs://'):].partition('/')
+    return bucket, object_name
+
+
+def _get_gcs_object_download_url(uri: str) -> str:
+    bucket, object_name = _split_gcs_uri(uri)
+    return 'https://storage.googleapis.com/storage/v1/b/{}/o/{}?alt=media'.format(
+        bucket,
+        urllib.parse.quote(object_name, safe=''),
+    )
+
+
+def _get_file_sha256(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _download_gcs_copy(expected_sha256: str) -> Tuple[str, str]:
+    '''Downloads the gcs_copy binary once to the user cache dir. Returns the local path and the SHA-256 of the binary.
+
+    The downloaded and the cached binaries are both verified against expected_sha256.
+    '''
+    if not expected_sha256:
+        raise ValueError('The expected gcs_copy checksum is not set. Pin _GCS_COPY_SHA256 or pass the SHA-256 of {}.'.format(_GCS_COPY_URL))
+    cache_dir = _image_mirror_index._get_user_cache_dir() / 'bin'
+    local_path = cache_dir / ('gcs_copy-' + hashlib.sha256(_GCS_COPY_URL.encode('utf-8')).hexdigest()[:16])
+    if not local_path.exists():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = local_path.with_name(local_path.name + '.{}.tmp'.format(os.getpid()))
+        with requests.get(_GCS_COPY_URL, stream=True) as response:
+            response.raise_for_status()
+            with temp_path.open('wb') as file:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    file.write(chunk)
+        os.replace(str(temp_path), str(local_path))
+    sha256 = _get_file_sha256(str(local_path))
+    if sha256 != expected_sha256:
+        local_path.unlink()
+        raise RuntimeError('The gcs_copy binary checksum {} does not match the expected checksum {}.'.format(sha256, expected_sha256))
+    return str(local_path), sha256
+
+
+def stage_gcs_copy(
+    pipeline_root: str,
+    expected_sha256: str = None,
+    access_token_provider: _pipeline_jobs_api._CachingAccessTokenProvider = None,
+) -> Tuple[str, str]:
+    '''Uploads the gcs_copy binary to the pipeline_root, so that the pipeline steps do not need to download it from GitHub.
+
+    The binary is verified against expected_sha256, which defaults to the pinned _GCS_COPY_SHA256.
+    The object name contains the binary checksum, so the binary is only uploaded once.
+    Returns the URI of the staged binary and its SHA-256 checksum.
+    '''
+    local_path, sha256 = _download_gcs_copy(expected_sha256 or _GCS_COPY_SHA256)
+    uri = pipeline_root.rstrip('/') + '/kfp_gcp/bin/gcs_copy-' + sha256
+    _upload_gcs_object_if_missing(uri, local_path=local_path, access_token_provider=access_token_provider)
+    return uri, sha256
+
+
+def _upload_gcs_object_if_missing(
+    uri: str,
+    local_path: str = None,
+    data: bytes = None,
+    access_token_provider: _pipeline_jobs_api._CachingAccessTokenProvider = None,
+) -> bool:
+    '''Uploads the file or data to GCS unless the object already exists. Returns whether the object was uploaded.'''
+    bucket, object_name = _split_gcs_uri(uri)
+    access_token_provider = access_token_provider or _pipeline_jobs_api._default_access_token_provider
+    headers = {'Authorization': 'Bearer ' + access_token_provider.get_access_token()}
+    metadata_url = 'https://storage.googleapis.com/storage/v1/b/{}/o/{}'.format(bucket, urllib.parse.quote(object_name, safe=''))
+    response = _pipeline_jobs_api._send_instrumented_request(requests, method='GET', url=metadata_url, headers=headers)
+    if response.status_code == 200:
+        return False
+    if response.status_code != 404:
+        response.raise_for_status()
+
+    logging.info('Uploading ' + uri)
+    upload_url = 'https://storage.googleapis.com/upload/storage/v1/b/{}/o'.format(bucket)
+    upload_headers = dict(headers, **{'Content-Type': 'application/octet-stream'})
+    if local_path:
+        with open(local_path, 'rb') as file:
+            response = _pipeline_jobs_api._send_instrumented_request(requests, method='POST', url=upload_url, params={'uploadType': 'media', 'name': object_name}, headers=upload_headers, data=file)
+    else:
+        response = _pipeline_jobs_api._send_instrumented_request(requests, method='POST', url=upload_url, params={'uploadType': 'media', 'name': object_name}, headers=upload_headers, data=data)
+    response.raise_for_status()
+    return True
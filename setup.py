@@ -35,6 +35,11 @@ setup(
         'kfp_gcp.orchestration',
         'kfp_gcp.orchestration.google_cloud',
     ],
+    entry_points={
+        'console_scripts': [
+            'kfp-gcp = kfp_gcp.orchestration.google_cloud._cli:main',
+        ],
+    },
     classifiers=[
         'Intended Audience :: Developers',
         'Intended Audience :: Education',
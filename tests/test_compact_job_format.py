@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from kfp_gcp.orchestration.google_cloud import _compact_job_format
+
+
+def _create_job(step_count: int = 20) -> dict:
+    '''Returns a job with the repeated scripts, dicts and lists like in the compiled jobs.'''
+    steps = {}
+    for index in range(step_count):
+        steps['step-{}'.format(index)] = dict(task=dict(
+            container=dict(image='python:3.7', command=['sh', '-e', '-c', 'echo the shared bootstrap script', 'prog', str(index)]),
+            inputs={} if index == 0 else dict(data=dict(step_output=dict(step='step-{}'.format(index - 1), output='data'))),
+            outputs=dict(data=dict(artifact=dict(custom_properties={'kfp_gcp.compression': dict(string_value='gzip')}))),
+        ))
+    return dict(
+        displayName='test-job',
+        spec=dict(steps=steps),
+        clientMetadata=dict(flags=[True, 1, 1.0, None, '', []], empty={}),
+        # Literal dicts that look like the references of the format
+        literals=[{'#': 0}, {'@': 1}, {'$v': 2}, {'=': [['#', 3]]}, {'#': 'x', '@': 'y'}],
+    )
+
+
+def test_round_trip():
+    job = _create_job()
+    data = _compact_job_format.serialize_job(job)
+    restored_job = _compact_job_format.deserialize_job(data)
+    assert json.dumps(restored_job) == json.dumps(job)
+    assert len(data) < len(json.dumps(job))
+
+
+def test_round_trip_preserves_value_types():
+    job = dict(values=[True, 1, False, 0, 1.0, None, 'True', '1'] * 2)
+    restored_job = _compact_job_format.deserialize_job(_compact_job_format.serialize_job(job))
+    assert [type(value) for value in restored_job['values']] == [type(value) for value in job['values']]
+    assert restored_job == job
+
+
+def test_repeated_values_are_not_aliased():
+    restored_job = _compact_job_format.deserialize_job(_compact_job_format.serialize_job(_create_job()))
+    steps = restored_job['spec']['steps']
+    steps['step-1']['task']['outputs']['data']['artifact']['custom_properties']['kfp_gcp.compression']['string_value'] = 'zstd'
+    steps['step-1']['task']['container']['command'].append('--flag')
+    assert steps['step-2']['task']['outputs']['data']['artifact']['custom_properties']['kfp_gcp.compression']['string_value'] == 'gzip'
+    assert steps['step-2']['task']['container']['command'][-1] == '2'
+
+
+def test_read_job_file(tmp_path):
+    job = _create_job()
+    compact_path = str(tmp_path / 'job.compact')
+    json_path = str(tmp_path / 'job.json')
+    _compact_job_format.write_job_file(job, compact_path)
+    with open(json_path, 'w') as json_file:
+        json.dump(job, json_file)
+    assert _compact_job_format.read_job_file(compact_path) == job
+    assert _compact_job_format.read_job_file(json_path) == job
+
+
+def test_deserialize_rejects_unknown_data():
+    with pytest.raises(ValueError):
+        _compact_job_format.deserialize_job(b'{}')
@@ -0,0 +1,217 @@
+import collections
+import hashlib
+import http.server
+import json
+import re
+import threading
+import urllib.parse
+import uuid
+
+import pytest
+
+from kfp_gcp.orchestration.google_cloud import _container_registry
+
+
+_IMAGE_MANIFEST_MEDIA_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+_MANIFEST_LIST_MEDIA_TYPE = 'application/vnd.docker.distribution.manifest.list.v2+json'
+
+
+def _get_digest(data: bytes) -> str:
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+class _FakeRegistry:
+    '''In-memory registry that implements the parts of the Docker Registry HTTP API V2 that the image copier uses.'''
+    def __init__(self):
+        # (repository, reference) -> (media type, manifest bytes)
+        self.manifests = {}
+        # (repository, digest) -> blob bytes
+        self.blobs = {}
+        self._uploads = {}
+        # (method, kind) -> request count. The kind is manifests, blobs, uploads or mounts.
+        self.request_counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self._create_request_handler_class())
+        self._thread = None
+
+    @property
+    def host(self) -> str:
+        return '127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_image(self, repository: str, tag: str, layers: list) -> str:
+        '''Adds the image and returns its manifest digest.'''
+        config = json.dumps(dict(repository=repository, tag=tag)).encode('utf-8')
+        descriptors = []
+        for blob in layers + [config]:
+            self.blobs[(repository, _get_digest(blob))] = blob
+            descriptors.append(dict(mediaType='application/octet-stream', digest=_get_digest(blob), size=len(blob)))
+        manifest = dict(schemaVersion=2, mediaType=_IMAGE_MANIFEST_MEDIA_TYPE, config=descriptors[-1], layers=descriptors[:-1])
+        return self.add_manifest(repository, tag, _IMAGE_MANIFEST_MEDIA_TYPE, json.dumps(manifest).encode('utf-8'))
+
+    def add_manifest(self, repository: str, tag: str, media_type: str, manifest: bytes) -> str:
+        digest = _get_digest(manifest)
+        self.manifests[(repository, tag)] = (media_type, manifest)
+        self.manifests[(repository, digest)] = (media_type, manifest)
+        return digest
+
+    def _handle_request(self, method: str, path: str, headers: dict, body: bytes) -> tuple:
+        '''Returns the (status code, headers, body) tuple.'''
+        url = urllib.parse.urlsplit(path)
+        query = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        match = re.match(r'^/v2/(?P<repository>.+)/blobs/uploads/(?P<upload_id>.*)$', url.path)
+        if match:
+            repository = match.group('repository')
+            if method == 'POST':
+                source_key = (query.get('from'), query.get('mount'))
+                if source_key in self.blobs:
+                    self.request_counts[(method, 'mounts')] += 1
+                    self.blobs[(repository, query['mount'])] = self.blobs[source_key]
+                    return 201, {}, b''
+                self.request_counts[(method, 'uploads')] += 1
+                upload_id = uuid.uuid4().hex
+                self._uploads[upload_id] = repository
+                return 202, {'Location': '/v2/{}/blobs/uploads/{}'.format(repository, upload_id)}, b''
+            if method == 'PUT':
+                self.request_counts[(method, 'uploads')] += 1
+                if self._uploads.pop(match.group('upload_id'), None) != repository or _get_digest(body) != query.get('digest'):
+                    return 400, {}, b''
+                self.blobs[(repository, query['digest'])] = body
+                return 201, {'Docker-Content-Digest': query['digest']}, b''
+            return 405, {}, b''
+
+        match = re.match(r'^/v2/(?P<repository>.+)/(?P<kind>manifests|blobs)/(?P<reference>[^/]+)$', url.path)
+        if not match:
+            return 404, {}, b''
+        repository, kind, reference = match.group('repository', 'kind', 'reference')
+        self.request_counts[(method, kind)] += 1
+        if kind == 'manifests' and method == 'PUT':
+            if headers.get('Content-Type') not in (_IMAGE_MANIFEST_MEDIA_TYPE, _MANIFEST_LIST_MEDIA_TYPE):
+                return 400, {}, b''
+            manifest = json.loads(body)
+            referenced_digests = [descriptor['digest'] for descriptor in manifest.get('layers', []) + [manifest.get('config', {})] if descriptor]
+            if any((repository, digest) not in self.blobs for digest in referenced_digests):
+                return 400, {}, b''
+            if any((repository, descriptor['digest']) not in self.manifests for descriptor in manifest.get('manifests', [])):
+                return 400, {}, b''
+            digest = self.add_manifest(repository, reference, headers['Content-Type'], body)
+            return 201, {'Docker-Content-Digest': digest}, b''
+        if kind == 'manifests' and method in ('GET', 'HEAD'):
+            if (repository, reference) not in self.manifests:
+                return 404, {}, b''
+            media_type, manifest = self.manifests[(repository, reference)]
+            return 200, {'Content-Type': media_type, 'Docker-Content-Digest': _get_digest(manifest)}, manifest
+        if kind == 'blobs' and method in ('GET', 'HEAD'):
+            if (repository, reference) not in self.blobs:
+                return 404, {}, b''
+            return 200, {'Docker-Content-Digest': reference}, self.blobs[(repository, reference)]
+        return 405, {}, b''
+
+    def _create_request_handler_class(self):
+        registry = self
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                with registry._lock:
+                    status_code, headers, response_body = registry._handle_request(self.command, self.path, self.headers, body)
+                self.send_response(status_code)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(response_body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(response_body)
+
+            do_GET = do_HEAD = do_POST = do_PUT = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
+
+
+@pytest.fixture
+def source_registry():
+    with _FakeRegistry() as registry:
+        yield registry
+
+
+@pytest.fixture
+def destination_registry():
+    with _FakeRegistry() as registry:
+        yield registry
+
+
+def test_copy_image(source_registry, destination_registry):
+    digest = source_registry.add_image('library/python', '3.7', [b'layer-1', b'layer-2'])
+    _container_registry._ImageCopier().copy_image(
+        source_registry.host + '/library/python:3.7',
+        destination_registry.host + '/mirror/library/python:3.7',
+    )
+    assert destination_registry.manifests[('mirror/library/python', '3.7')] == source_registry.manifests[('library/python', '3.7')]
+    assert destination_registry.blobs[('mirror/library/python', _get_digest(b'layer-2'))] == b'layer-2'
+    assert _container_registry._RegistryClient().get_manifest_digest(destination_registry.host + '/mirror/library/python:3.7') == digest
+
+
+def test_copy_images_transfers_shared_blobs_once(source_registry, destination_registry):
+    source_registry.add_image('first', 'latest', [b'shared-layer', b'first-layer'])
+    source_registry.add_image('second', 'latest', [b'shared-layer', b'second-layer'])
+    _container_registry._ImageCopier().copy_images({
+        source_registry.host + '/first': destination_registry.host + '/mirror/first',
+        source_registry.host + '/second': destination_registry.host + '/mirror/second',
+    })
+    assert source_registry.request_counts[('GET', 'blobs')] == 5
+    assert destination_registry.request_counts[('POST', 'mounts')] == 1
+    assert destination_registry.blobs[('mirror/second', _get_digest(b'shared-layer'))] == b'shared-layer'
+    assert ('mirror/second', 'latest') in destination_registry.manifests
+
+
+def test_copy_image_within_registry_mounts_blobs(source_registry):
+    source_registry.add_image('alpine', 'latest', [b'layer'])
+    _container_registry._ImageCopier().copy_image(source_registry.host + '/alpine', source_registry.host + '/mirror/alpine')
+    assert source_registry.request_counts[('GET', 'blobs')] == 0
+    assert source_registry.request_counts[('POST', 'mounts')] == 2
+    assert ('mirror/alpine', 'latest') in source_registry.manifests
+
+
+def test_copy_image_skips_existing_image(source_registry, destination_registry):
+    source_registry.add_image('alpine', 'latest', [b'layer'])
+    image_copier = _container_registry._ImageCopier()
+    image_copier.copy_image(source_registry.host + '/alpine', destination_registry.host + '/alpine')
+    destination_registry.request_counts.clear()
+    source_registry.request_counts.clear()
+
+    _container_registry._ImageCopier().copy_image(source_registry.host + '/alpine', destination_registry.host + '/alpine')
+    assert source_registry.request_counts[('GET', 'blobs')] == 0
+    assert destination_registry.request_counts[('PUT', 'manifests')] == 0
+
+
+def test_copy_manifest_list(source_registry, destination_registry):
+    child_manifests = []
+    for platform in ['amd64', 'arm64']:
+        digest = source_registry.add_image('multi', platform, [platform.encode('utf-8')])
+        child_manifests.append(dict(
+            mediaType=_IMAGE_MANIFEST_MEDIA_TYPE,
+            digest=digest,
+            size=len(source_registry.manifests[('multi', digest)][1]),
+            platform=dict(os='linux', architecture=platform),
+        ))
+    manifest_list = json.dumps(dict(schemaVersion=2, mediaType=_MANIFEST_LIST_MEDIA_TYPE, manifests=child_manifests)).encode('utf-8')
+    source_registry.add_manifest('multi', 'latest', _MANIFEST_LIST_MEDIA_TYPE, manifest_list)
+
+    _container_registry._ImageCopier().copy_image(source_registry.host + '/multi', destination_registry.host + '/multi')
+    assert destination_registry.manifests[('multi', 'latest')] == (_MANIFEST_LIST_MEDIA_TYPE, manifest_list)
+    for child_manifest in child_manifests:
+        assert ('multi', child_manifest['digest']) in destination_registry.manifests
+    assert destination_registry.blobs[('multi', _get_digest(b'arm64'))] == b'arm64'
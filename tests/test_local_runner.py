@@ -0,0 +1,108 @@
+import gzip
+
+import pytest
+from kfp import components
+
+from kfp_gcp.orchestration.google_cloud import _local_runner
+from kfp_gcp.orchestration.google_cloud import _pipeline_runner
+
+
+_PRODUCE_COMPONENT_TEXT = '''
+name: Produce
+inputs:
+- {name: text, type: String}
+outputs:
+- {name: data}
+implementation:
+  container:
+    image: alpine
+    command: [sh, -c, 'mkdir -p "$(dirname "$1")"; echo "$0" > "$1"', {inputValue: text}, {outputPath: data}]
+'''
+
+_CONSUME_COMPONENT_TEXT = '''
+name: Consume
+inputs:
+- {name: data}
+outputs:
+- {name: result}
+implementation:
+  container:
+    image: alpine
+    command: [sh, -c, 'mkdir -p "$(dirname "$1")"; cat "$0" > "$1"; echo consumed >> "$1"', {inputPath: data}, {outputPath: result}]
+'''
+
+_STREAMING_ANNOTATIONS_TEXT = '''
+metadata:
+  annotations:
+    kfp_gcp.streaming_outputs: data
+'''
+
+produce_op = components.load_component_from_text(_PRODUCE_COMPONENT_TEXT)
+produce_streamed_op = components.load_component_from_text(_PRODUCE_COMPONENT_TEXT.replace('name: Produce\n', 'name: Produce streamed\n' + _STREAMING_ANNOTATIONS_TEXT))
+consume_op = components.load_component_from_text(_CONSUME_COMPONENT_TEXT)
+
+
+def _run_locally(pipeline_func, local_root: str, **compile_kwargs) -> _local_runner._LocalPipelineJob:
+    pipeline_job = _pipeline_runner.compile_pipeline(pipeline_func, {}, 'gs://test-bucket/pipeline-root', **compile_kwargs)
+    job = _local_runner.run_pipeline_job_locally(pipeline_job, local_root=str(local_root))
+    job.wait_for_completion(interval_seconds=0.1)
+    return job
+
+
+def _read_output(job: _local_runner._LocalPipelineJob, step_name: str, output_name: str) -> str:
+    with open(job.get_output_uri(step_name, output_name), 'rb') as output_file:
+        data = output_file.read()
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    return data.decode('utf-8')
+
+
+def _text_pipeline(text: str):
+    def pipeline():
+        consume_op(data=produce_op(text=text).outputs['data'])
+    return pipeline
+
+
+def test_run_locally(tmp_path):
+    job = _run_locally(_text_pipeline('hello'), tmp_path)
+    assert job.current_state['state'] == 'SUCCEEDED'
+    assert _read_output(job, 'Consume', 'result') == 'hello\nconsumed\n'
+
+
+@pytest.mark.parametrize('compile_kwargs', [
+    dict(spill_arguments_larger_than=16),
+    dict(max_parallel_transfers=4),
+    dict(artifact_compression='gzip'),
+    dict(spill_arguments_larger_than=16, max_parallel_transfers=4, artifact_compression='gzip'),
+])
+def test_wrappers(tmp_path, compile_kwargs):
+    # The user text that looks like the wrapper paths must not be rewritten
+    text = 'a long argument with /tmp/outputs-not and /var/tmp/inputs/data ' * 4
+    job = _run_locally(_text_pipeline(text), tmp_path, **compile_kwargs)
+    assert job.current_state['state'] == 'SUCCEEDED'
+    assert _read_output(job, 'Consume', 'result') == text + '\nconsumed\n'
+
+
+def test_spilled_arguments_are_not_inlined_in_the_job():
+    text = 'x' * 1000
+    pipeline_job = _pipeline_runner.compile_pipeline(_text_pipeline(text), {}, 'gs://test-bucket/pipeline-root', spill_arguments_larger_than=100)
+    assert text not in str(pipeline_job['spec'])
+
+
+def test_streaming_output(tmp_path):
+    def pipeline():
+        consume_op(data=produce_op(text='buffered').outputs['data'])
+        consume_op(data=produce_streamed_op(text='streamed').outputs['data'])
+
+    pipeline_job = _pipeline_runner.compile_pipeline(pipeline, {}, 'gs://test-bucket/pipeline-root')
+    streaming_steps = {
+        step_name for step_name, step in pipeline_job['spec']['steps'].items()
+        if 'mkfifo' in step['task']['container']['command'][3]
+    }
+    assert streaming_steps == {'Produce streamed'}
+
+    job = _local_runner.run_pipeline_job_locally(pipeline_job, local_root=str(tmp_path))
+    job.wait_for_completion(interval_seconds=0.1)
+    assert job.current_state['state'] == 'SUCCEEDED'
+    results = sorted(_read_output(job, step_name, 'result') for step_name in pipeline_job['spec']['steps'] if step_name.startswith('Consume'))
+    assert results == ['buffered\nconsumed\n', 'streamed\nconsumed\n']
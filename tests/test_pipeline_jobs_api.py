@@ -0,0 +1,120 @@
+import datetime
+
+import pytest
+import requests
+
+from kfp_gcp.orchestration.google_cloud import _pipeline_jobs_api
+from kfp_gcp.orchestration.google_cloud import _pipeline_jobs_emulator
+
+
+def _create_job(command_text: str = 'hello') -> dict:
+    return dict(
+        displayName='test-job',
+        spec=dict(steps=dict(
+            produce=dict(task=dict(container=dict(image='alpine', command=['echo', command_text]), inputs={}, outputs={})),
+            consume=dict(task=dict(
+                container=dict(image='alpine', command=['cat']),
+                inputs=dict(data=dict(step_output=dict(step='produce', output='data'))),
+                outputs={},
+            )),
+        )),
+    )
+
+
+class _FlakyCreateEmulator(_pipeline_jobs_emulator._PipelineJobsEmulator):
+    '''Creates the job, but fails the create response, so that the client retries the create request and gets 409.'''
+    fail_next_create = False
+
+    def _handle_request(self, method: str, path: str, body: bytes) -> tuple:
+        status_code, response_json = super()._handle_request(method, path, body)
+        if method == 'POST' and status_code == 200 and self.fail_next_create:
+            self.fail_next_create = False
+            return 503, dict(error=dict(code=503, message='Injected error.'))
+        return status_code, response_json
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(_pipeline_jobs_api, '_get_retry_delay_seconds', lambda *args, **kwargs: 0)
+
+
+@pytest.fixture
+def emulator():
+    with _FlakyCreateEmulator(pending_seconds=0.2, step_seconds=0.2) as emulator:
+        yield emulator
+
+
+@pytest.fixture
+def api(emulator):
+    return _pipeline_jobs_api.PipelineJobApi(
+        project_id='test-project',
+        api_endpoint=emulator.endpoint,
+        access_token_provider=_pipeline_jobs_api._CachingAccessTokenProvider(get_token=lambda: 'token'),
+    )
+
+
+def test_submit_jobs(api):
+    results = api.submit_jobs([(_create_job(), 'job-1'), (_create_job(), 'job-2')])
+    assert [result.job_name for result in results] == ['job-1', 'job-2']
+    assert [result.error for result in results] == [None, None]
+    assert [result.already_existed for result in results] == [False, False]
+    assert api.get_job_json('job-2')['displayName'] == 'test-job'
+
+
+def test_submit_jobs_resubmission(api):
+    api.submit_jobs([(_create_job(), 'job-1')])
+    results = api.submit_jobs([(_create_job(), 'job-1'), (_create_job('changed'), 'job-2'), (_create_job(), 'job-3')])
+    assert results[0].error is None and results[0].already_existed
+    assert results[1].error is None and not results[1].already_existed
+
+    results = api.submit_jobs([(_create_job(), 'job-2')])
+    assert isinstance(results[0].error, RuntimeError)
+    assert results[0].job is None
+
+
+def test_submit_job_retried_create(api, emulator):
+    emulator.fail_next_create = True
+    job = api.submit_job(_create_job(), 'job-1')
+    assert job.job_name == 'job-1'
+    assert emulator.request_counts[('POST', 409)] == 1
+
+    # Without a retry, the conflict means that the name is already taken
+    with pytest.raises(requests.HTTPError):
+        api.submit_job(_create_job(), 'job-1')
+
+
+def test_wait_for_all(api):
+    jobs = [result.job for result in api.submit_jobs([(_create_job(), 'job-{}'.format(index)) for index in range(5)])]
+    done, not_done = _pipeline_jobs_api.wait_for_all(jobs, min_interval_seconds=0.1, max_interval_seconds=0.2)
+    assert not_done == []
+    assert [job.job_name for job in done] == [job.job_name for job in jobs]
+    assert {job.current_state['state'] for job in done} == {'SUCCEEDED'}
+
+
+def test_wait_for_all_timeout(api):
+    jobs = [api.submit_job(_create_job(), 'job-1')]
+    done, not_done = _pipeline_jobs_api.wait_for_all(jobs, timeout=datetime.timedelta(seconds=0.05), min_interval_seconds=0.01)
+    assert done == []
+    assert not_done == jobs
+
+
+def test_wait_for_all_first_completed(api):
+    finished_job = api.submit_job(_create_job(), 'job-1')
+    finished_job.wait_for_completion(interval_seconds=0.1)
+    running_job = api.submit_job(_create_job(), 'job-2')
+    done, not_done = _pipeline_jobs_api.wait_for_all(
+        [finished_job, running_job],
+        return_when=_pipeline_jobs_api.FIRST_COMPLETED,
+        min_interval_seconds=0.01,
+    )
+    assert done == [finished_job]
+    assert not_done == [running_job]
+
+
+def test_cancel(api):
+    job = api.submit_job(_create_job(), 'job-1')
+    api.cancel('job-1')
+    done, not_done = _pipeline_jobs_api.wait_for_all([job], min_interval_seconds=0.1)
+    assert done == [job]
+    assert job.current_state['state'] == 'CANCELLED'
+    assert {execution['state'] for execution in job.current_state['jobDetail']['taskExecutions']} == {'CANCELLED'}